@@ -21,6 +21,11 @@ import os
 from argparse import ArgumentParser
 
 from .package import Package
+from .util import parse_size
+from .backend import BACKENDS, SubprocessBackend
+from .repo import RETRY_DELAY, TIMEOUT
+from .capture import LogCapture
+from .server import Server
 
 
 def parse_args(argv):
@@ -47,6 +52,50 @@ def make_arg_parser(prog):
                 'with a `"dev": true` field, signalling they are only '
                 'required for development of the enclosing package.')
 
+    p.add_argument('--cache-dir', metavar='DIR',
+            help=
+                'The directory of Puck\'s user-level cache. Defaults to '
+                '`$PUCK_CACHE_DIR`, or else `$XDG_CACHE_HOME/puck`, or else '
+                '`~/.cache/puck`.')
+
+    p.add_argument('--backend', choices=sorted(BACKENDS),
+            default=SubprocessBackend.name,
+            help=
+                'How Git is run: `subprocess` runs `git` for every '
+                'operation; `batch` answers read-only queries, like listing '
+                'tags and resolving commits, by reading refs directly and '
+                'through one long-lived `git cat-file` process per '
+                'dependency. Defaults to `subprocess`.')
+
+    p.add_argument('--capture', action='store_true',
+            help=
+                'Write the output of each dependency\'s update or command to '
+                'its own log file in `{}/{}`, instead of the terminal. The '
+                'terminal shows a status line of the running jobs, and the '
+                'log of any job that fails.'
+                .format(Package.DEPS_DIR, LogCapture.LOGS_DIR))
+    p.add_argument('--compress-logs', action='store_true',
+            help=
+                'Compress the log files written by `--capture` with gzip.')
+    p.add_argument('--log-format', choices=['text', 'jsonl'],
+            default='text',
+            help=
+                'With `jsonl`, log every event as a line of JSON instead of '
+                'as text, and capture the output of dependencies as with '
+                '`--capture`. Defaults to `text`.')
+
+    p.add_argument('--no-server', action='store_true',
+            help=
+                'Run in this process, even if a `puck serve` server is '
+                'running for the enclosing package.')
+
+    p.add_argument('--trace', metavar='FILE',
+            help=
+                'Time every Git call, dependency update, command execution '
+                'and manifest load, write the timings to FILE in the Chrome '
+                'trace-event format, and print a summary of the slowest '
+                'dependencies and subprocesses at the end.')
+
     subs = p.add_subparsers()
 
     up = subs.add_parser('update', aliases=['u'],
@@ -55,13 +104,74 @@ def make_arg_parser(prog):
                 'the enclosing package, and all dependencies of '
                 'dependencies, into a `{}` directory in the enclosing '
                 'package\'s root directory. Then, checks out the specified '
-                'version (if any) of each dependency.'
-                .format(Package.DEPS_DIR))
+                'version (if any) of each dependency, and records the '
+                'checked-out commits in a `{}` file. The whole tree is '
+                'resolved, and checked for conflicts, from Git objects '
+                'before any dependency is checked out.'
+                .format(Package.DEPS_DIR, Package.LOCK_PATH))
     up.set_defaults(sub='update')
+    up.add_argument('--dry-run', action='store_true',
+            help=
+                'Only fetch the dependencies, and print the commit each '
+                'would be checked out to, without checking any out or '
+                'writing `{}`. New dependencies are kept in `{}/{}` for the '
+                'next update.'
+                .format(Package.LOCK_PATH, Package.DEPS_DIR,
+                        Package.STAGING_DIR))
     up.add_argument('-f', '--no-verify', action='store_true',
             help=
                 'Do not verify (e.g. `git tag --verify`) the chosen tag for '
                 'dependencies specified with a tag pattern.')
+    up.add_argument('-m', '--mirror', action='store_true',
+            help=
+                'Fetch each dependency repository into a bare mirror in the '
+                'user-level cache, and clone and fetch the dependency '
+                'directories from those mirrors, so that a repository is only '
+                'downloaded once for all packages.')
+    up.add_argument('--cache-max-size', type=parse_size, metavar='SIZE',
+            help=
+                'After updating, evict the least recently used mirrors until '
+                'the mirror cache is at most SIZE (e.g. `500M`, `5G`).')
+    up.add_argument('-s', '--shallow', action='store_true',
+            help=
+                'Clone dependencies that don\'t have their own `"clone"` '
+                'options with a history depth of one. Tags and references '
+                'outside of that history are fetched when needed.')
+    up.add_argument('--prune', action='store_true',
+            help=
+                'After updating, remove the checkouts in `{}` that are no '
+                'longer dependencies, like `puck prune`.'
+                .format(Package.DEPS_DIR))
+    up.add_argument('--frozen', action='store_true',
+            help=
+                'Check out every dependency to the commit recorded for it in '
+                '`{}`, without resolving tags or references, and without '
+                'fetching if that commit is already present. Fails if the '
+                'lock file is missing an entry or is out of date.'
+                .format(Package.LOCK_PATH))
+    up.add_argument('--resume', action='store_true',
+            help=
+                'Don\'t fetch the dependencies again that the last update '
+                'to fail had already fetched and resolved, provided their '
+                'specifications are unchanged, but check them out to the '
+                'commits chosen then.')
+    up.add_argument('--retries', type=int, default=2, metavar='N',
+            help=
+                'Retry a clone or fetch that timed out or failed because of '
+                'the network up to N times, waiting {} second(s) before the '
+                'first retry and twice as long before each one after it '
+                '(default: %(default)s). Other failures aren\'t retried.'
+                .format(RETRY_DELAY))
+    up.add_argument('--timeout', type=float, default=TIMEOUT,
+                    metavar='SECONDS',
+            help=
+                'Stop and retry any clone or fetch that takes longer than '
+                'SECONDS, or 0 for no limit (default: %(default)s).')
+    up.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+            help=
+                'Fetch and check out up to N independent dependencies '
+                'concurrently. Dependency conflicts are still detected and '
+                'reported in the same order regardless of N.')
 
     xp = subs.add_parser('execute', aliases=['x'],
             description=
@@ -83,6 +193,141 @@ def make_arg_parser(prog):
     xp.add_argument('-r', '--root', action='store_true',
             help=
                 'Also execute the command for the enclosing package.')
+    xp.add_argument('-i', '--incremental', action='store_true',
+            help=
+                'Skip executing the command for packages whose checked-out '
+                'commit, modified files, command handler, environment and '
+                'dependencies haven\'t changed since the command last '
+                'succeeded for them.')
+    xp.add_argument('--no-output-cache', action='store_true',
+            help=
+                'Always execute the command, rather than restoring the '
+                'outputs that packages declare for it from the user-level '
+                'cache.')
+    xp.add_argument('--cache-max-size', type=parse_size, metavar='SIZE',
+            help=
+                'After executing, evict the least recently used outputs '
+                'until the output cache is at most SIZE (e.g. `500M`).')
+    xp.add_argument('-j', '--jobs', type=int, metavar='N',
+            help=
+                'Execute the command for up to N dependencies concurrently. '
+                'A dependency is executed as soon as the command has been '
+                'executed for all of its own dependencies. With N above 1, '
+                'Puck also acts as a GNU make jobserver for N jobs, which '
+                'the `make` processes run by the handlers share with it '
+                'through `MAKEFLAGS`. When Puck is run by `make` with a '
+                'jobserver, it joins that one instead, and N defaults to '
+                'its number of jobs.')
+    xp.add_argument('--no-jobserver', action='store_true',
+            help=
+                'Don\'t create or join a GNU make jobserver.')
+    xp.add_argument('--explain-schedule', action='store_true',
+            help=
+                'Instead of executing the command, report its predicted '
+                'critical path, and how long executing it would take with '
+                '`--jobs` and with other numbers of jobs, from how long '
+                'each package\'s command took in earlier executions.')
+    xp.add_argument('-w', '--watch', action='store_true',
+            help=
+                'After executing, keep watching the checkouts of the '
+                'dependencies (and of the enclosing package, with `--root`) '
+                'until interrupted, and execute the command again for those '
+                'that change and for the dependencies that depend on them. '
+                'An execution still in progress when more changes are made '
+                'is cancelled and restarted. Changes to `{}` files are only '
+                'picked up by restarting.'
+                .format(Package.JSON_PATH))
+    xp.add_argument('--poll', action='store_true',
+            help=
+                'With `--watch`, poll the checkouts for changes rather than '
+                'using inotify, e.g. on network file systems.')
+
+    gp = subs.add_parser('graph',
+            description=
+                'Prints the dependency graph of the enclosing package, as '
+                'read from the dependency directories, in Graphviz DOT or '
+                'JSON format. Development dependencies are drawn dashed.')
+    gp.set_defaults(sub='graph')
+    gp.add_argument('-f', '--format', choices=['dot', 'json'], default='dot')
+
+    lp = subs.add_parser('list', aliases=['l'],
+            description=
+                'Prints the path of every dependency in the dependency tree '
+                'of the enclosing package, breadth-first.')
+    lp.set_defaults(sub='list')
+
+    sp = subs.add_parser('status', aliases=['st'],
+            description=
+                'Prints the state of the checkout of every dependency in the '
+                'dependency tree of the enclosing package, as read from the '
+                'dependency directories, without fetching: whether it\'s '
+                'missing, has changed or untracked files, has a detached '
+                '`HEAD`, is ahead of or behind its upstream branch, or isn\'t '
+                'checked out to the commit recorded in `{}` or to the latest '
+                'commit of its tag pattern or reference.'
+                .format(Package.LOCK_PATH))
+    sp.set_defaults(sub='status')
+    sp.add_argument('-f', '--format', choices=['table', 'json'],
+                    default='table')
+    sp.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                    metavar='N',
+            help=
+                'Read up to N checkouts concurrently (default: the number of '
+                'CPUs).')
+
+    pp = subs.add_parser('prune',
+            description=
+                'Removes the Git checkouts in the `{}` directory that are no '
+                'longer in the dependency tree of the enclosing package. '
+                'With `--no-dev`, the paths recorded in `{}` are kept too.'
+                .format(Package.DEPS_DIR, Package.LOCK_PATH))
+    pp.set_defaults(sub='prune')
+    pp.add_argument('-a', '--archive', action='store_true',
+            help=
+                'Move orphaned checkouts into `{}/{}` instead of removing '
+                'them.'
+                .format(Package.DEPS_DIR, Package.ARCHIVE_DIR))
+    pp.add_argument('-f', '--force', action='store_true',
+            help=
+                'Also prune checkouts with uncommitted changes to their '
+                'tracked files.')
+    pp.add_argument('-g', '--gc', action='store_true',
+            help=
+                'Run `git gc --auto` in each of the remaining checkouts.')
+    pp.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+            help=
+                'Run `git gc` in up to N checkouts at once.')
+
+    sp = subs.add_parser('serve',
+            description=
+                'Serves the invocations of Puck in the enclosing package '
+                'until interrupted, over a Unix socket at `{}/{}`. While it '
+                'runs, `puck` passes its arguments and output files to the '
+                'server, which keeps the parsed `{}` files, the Git backend '
+                '(as chosen with `--backend`) and the resolved dependency '
+                'tree in memory between invocations.'
+                .format(Package.DEPS_DIR, Server.SOCKET_PATH,
+                        Package.JSON_PATH))
+    sp.set_defaults(sub='serve')
+    sp.add_argument('--stop', action='store_true',
+            help=
+                'Stop the running server.')
+
+    cp = subs.add_parser('cache',
+            description=
+                'Lists the mirror repositories in the user-level cache used '
+                'by `update --mirror`, and the cached outputs of commands, '
+                'from most to least recently used, or evicts the least '
+                'recently used of them.')
+    cp.set_defaults(sub='cache')
+    cp.add_argument('action', choices=['list', 'evict'], nargs='?',
+                    default='list')
+    cp.add_argument('-s', '--max-size', type=parse_size, default=0,
+                    metavar='SIZE',
+            help=
+                'With `evict`, only evict mirrors until they take at most '
+                'SIZE, and likewise for outputs. The default is to evict '
+                'everything.')
 
     return p
 
@@ -0,0 +1,301 @@
+
+# Copyright 2014  Malcolm Inglis <http://minglis.id.au>
+#
+# This file is part of Puck.
+#
+# Puck is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Puck is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Puck. If not, see <https://gnu.org/licenses/>.
+
+
+import threading
+from subprocess import Popen, PIPE, CalledProcessError, DEVNULL
+
+from .util import default_caller, call_method
+
+
+class SubprocessBackend:
+
+    '''
+    Performs the Git operations needed by a `Repo` by running a `git`
+    subprocess for each of them. Other backends may override any of these
+    methods, e.g. to answer read-only queries without forking.
+    '''
+
+    name = 'subprocess'
+
+    def __init__(self, observers=None, caller=None):
+        self.observers = observers or list()
+        self.caller = caller or default_caller
+
+    def __str__(self):
+        return '{}()'.format(self.__class__.__name__)
+
+    def event(self, event, *args, **kwargs):
+        for o in self.observers:
+            o.notify(event, *args, **kwargs)
+
+    call = call_method
+
+    def close(self):
+        pass
+
+    def invalidate(self, path):
+        '''
+        Signals that the refs or objects of the repository at the given path
+        may have changed.
+        '''
+        pass
+
+    def clone(self, source, path, args=(), timeout=None):
+        self.call(['git', 'clone'] + list(args) + [source, str(path)],
+                  cwd='.', timeout=timeout, errors=True)
+
+    def fetch(self, path, source=None, refspecs=(), args=(), quiet=False,
+                    timeout=None):
+        self.call(['git', 'fetch'] + list(args)
+                  + ([source] if source else []) + list(refspecs),
+                  cwd=path, timeout=timeout, errors=True,
+                  **(dict(stderr=DEVNULL) if quiet else dict()))
+
+    def set_remote_url(self, path, remote, url):
+        self.call(['git', 'remote', 'set-url', remote, url], cwd=path)
+
+    def track_branch(self, path, remote, branch):
+        # lets `git checkout <branch>` create it from a single-branch clone
+        self.call(['git', 'remote', 'set-branches', '--add', remote, branch],
+                  cwd=path)
+
+    def list_remote_tags(self, path, remote='origin', timeout=None):
+        refs = self.call(['git', 'ls-remote', '--tags', '--refs', remote],
+                         cwd=path, output=True, timeout=timeout,
+                         errors=True).splitlines()
+        return [r.split('\t', 1)[1][len('refs/tags/'):] for r in refs]
+
+    def list_tags(self, path):
+        '''
+        Returns `(name, object ID, commit ID)` for each of the repository's
+        tags.
+        '''
+        output = self.call(['git', 'for-each-ref',
+                            '--format=%(refname:strip=2)%00%(objectname)'
+                                     '%00%(*objectname)',
+                            'refs/tags'], cwd=path, output=True)
+        tags = []
+        for line in output.splitlines():
+            name, obj, peeled = line.split('\0')
+            tags.append((name, obj, peeled or obj))
+        return tags
+
+    def resolve(self, path, rev):
+        '''
+        Returns the ID of the commit that the given revision refers to, or
+        `None` if there isn't one.
+        '''
+        try:
+            return self.call(['git', 'rev-parse', '--verify', '--quiet',
+                              rev + '^{commit}'],
+                             cwd=path, output=True).strip()
+        except CalledProcessError:
+            return None
+
+    def read_file(self, path, rev, name):
+        '''
+        Returns the contents of the named file at the given revision, or
+        `None` if there isn't one.
+        '''
+        try:
+            return self.call(['git', 'cat-file', 'blob',
+                              '{}:{}'.format(rev, name)],
+                             cwd=path, output=True, stderr=DEVNULL)
+        except CalledProcessError:
+            return None
+
+    def status(self, path):
+        '''
+        Returns the checked-out commit (or `None` before the first commit),
+        the checked-out branch (or `None` if the `HEAD` is detached), the
+        number of commits ahead of and behind its upstream branch (or `None`
+        without one), and the number of changed tracked files and of
+        untracked files, from a single `git status`.
+        '''
+        output = self.call(['git', '-c', 'core.untrackedCache=true',
+                            'status', '--porcelain=v2', '--branch', '-z',
+                            '--no-renames'],
+                           cwd=path, output=True)
+        commit = branch = ab = None
+        changed = untracked = 0
+        for entry in filter(None, output.split('\0')):
+            if entry.startswith('# branch.oid '):
+                commit = entry.split()[2]
+            elif entry.startswith('# branch.head '):
+                branch = entry.split()[2]
+            elif entry.startswith('# branch.ab '):
+                ab = tuple(abs(int(n)) for n in entry.split()[2:4])
+            elif entry.startswith('?'):
+                untracked += 1
+            elif not entry.startswith('#'):
+                changed += 1
+        return (None if commit == '(initial)' else commit,
+                None if branch == '(detached)' else branch,
+                ab, changed, untracked)
+
+    def list_sparse_checkout(self, path):
+        '''
+        Returns the directories that a sparse working tree is restricted to,
+        or `None` if the working tree isn't sparse.
+        '''
+        try:
+            return self.call(['git', 'sparse-checkout', 'list'], cwd=path,
+                             output=True, stderr=DEVNULL).splitlines()
+        except CalledProcessError:
+            return None
+
+    def sparse_checkout(self, path, dirs):
+        '''
+        Restricts the working tree to the given directories in cone mode, or
+        restores the whole working tree if there are none.
+        '''
+        if dirs:
+            self.call(['git', 'sparse-checkout', 'set', '--cone'] + list(dirs),
+                      cwd=path)
+        else:
+            self.call(['git', 'sparse-checkout', 'disable'], cwd=path)
+
+    def verify_tag(self, path, tag):
+        self.call(['git', 'tag', '--verify', tag], cwd=path)
+
+    def checkout(self, path, rev, force=False):
+        self.call(['git', 'checkout'] + (['--force'] if force else [])
+                  + [rev], cwd=path)
+        self.invalidate(path)
+
+    def merge(self, path, rev):
+        self.call(['git', 'merge', '--no-edit', rev], cwd=path)
+        self.invalidate(path)
+
+
+class BatchBackend(SubprocessBackend):
+
+    '''
+    Answers read-only queries without forking a process for each of them:
+    tags are read straight from the repository's ref files, and revisions
+    are resolved by one long-lived `git cat-file --batch-check` process per
+    repository, which is restarted after the repository changes.
+    '''
+
+    name = 'batch'
+
+    def __init__(self, observers=None, caller=None):
+        super().__init__(observers=observers, caller=caller)
+        self.processes = dict()     # str(path) -> (Popen, Lock)
+        self.lock = threading.Lock()
+
+    def close(self):
+        with self.lock:
+            processes, self.processes = self.processes, dict()
+        for process, _ in processes.values():
+            process.stdin.close()
+            process.wait()
+
+    def invalidate(self, path):
+        with self.lock:
+            entry = self.processes.pop(str(path), None)
+        if entry:
+            entry[0].stdin.close()
+            entry[0].wait()
+
+    def batch_process(self, path):
+        with self.lock:
+            entry = self.processes.get(str(path))
+            if entry is None:
+                args = ['git', 'cat-file', '--batch-check']
+                self.event('call', args=args, cwd=str(path))
+                try:
+                    entry = (Popen(args, cwd=str(path), stdin=PIPE,
+                                   stdout=PIPE, universal_newlines=True),
+                             threading.Lock())
+                finally:
+                    self.event('call-end', args=args, cwd=str(path))
+                self.processes[str(path)] = entry
+            return entry
+
+    def batch_check(self, path, names):
+        '''
+        Returns the `cat-file --batch-check` output line for each of the
+        given object names.
+        '''
+        process, lock = self.batch_process(path)
+        lines = []
+        with lock:
+            for name in names:
+                process.stdin.write(name + '\n')
+                process.stdin.flush()
+                lines.append(process.stdout.readline().rstrip('\n'))
+        return lines
+
+    def resolve(self, path, rev):
+        if '\n' in rev or ' ' in rev:
+            return super().resolve(path, rev)
+        line = self.batch_check(path, [rev + '^{commit}'])[0]
+        fields = line.split()
+        if len(fields) == 3 and fields[1] == 'commit':
+            return fields[0]
+        return None
+
+    def git_dir(self, path):
+        git_dir = path / '.git'
+        if git_dir.is_file():
+            text = git_dir.read_text().strip()
+            if text.startswith('gitdir:'):
+                git_dir = path / text[len('gitdir:'):].strip()
+        return git_dir
+
+    def list_tags(self, path):
+        git_dir = self.git_dir(path)
+        # linked worktrees and the reftable format keep refs elsewhere
+        if not git_dir.is_dir() or any((git_dir / f).exists()
+                                       for f in ('commondir', 'reftable')):
+            return super().list_tags(path)
+        refs = dict()   # name -> [object ID, commit ID or None]
+        packed = git_dir / 'packed-refs'
+        if packed.exists():
+            name = None
+            for line in packed.read_text().splitlines():
+                if line.startswith('^') and name:
+                    refs[name][1] = line[1:]
+                elif not line.startswith('#'):
+                    obj, ref = line.split(' ', 1)
+                    name = (ref[len('refs/tags/'):]
+                            if ref.startswith('refs/tags/') else None)
+                    if name:
+                        refs[name] = [obj, None]
+        tags_dir = git_dir / 'refs' / 'tags'
+        for f in (tags_dir.glob('**/*') if tags_dir.is_dir() else ()):
+            obj = f.read_text().strip() if f.is_file() else ''
+            if obj and not obj.startswith('ref:'):
+                refs[f.relative_to(tags_dir).as_posix()] = [obj, None]
+        unpeeled = [name for name, (_, commit) in refs.items()
+                         if commit is None]
+        lines = self.batch_check(path, [refs[name][0] + '^{commit}'
+                                        for name in unpeeled])
+        for name, line in zip(unpeeled, lines):
+            fields = line.split()
+            if len(fields) == 3 and fields[1] == 'commit':
+                refs[name][1] = fields[0]
+            else:
+                del refs[name]  # e.g. a tag whose object is missing
+        return [(name, obj, commit) for name, (obj, commit) in refs.items()]
+
+
+BACKENDS = {b.name: b for b in (SubprocessBackend, BatchBackend)}
+
@@ -0,0 +1,111 @@
+
+# Copyright 2014  Malcolm Inglis <http://minglis.id.au>
+#
+# This file is part of Puck.
+#
+# Puck is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Puck is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Puck. If not, see <https://gnu.org/licenses/>.
+
+
+import os
+import gzip
+import shutil
+import threading
+from pathlib import Path
+
+from .util import default_caller
+
+
+class LogCapture:
+
+    '''
+    Captures the output of each dependency's subprocesses, and of the
+    messages logged while it's being updated or executed, into its own log
+    file in the dependencies directory, instead of interleaving it on the
+    terminal. A thread has one log open at a time, between the begin and end
+    events of the job it's running. The jobs of the same dependency in one
+    invocation (e.g. planning and then checking it out) share its log.
+    '''
+
+    LOGS_DIR = Path('.puck-logs')
+    ROOT_LOG = '.root'      # the log of the root package's commands
+
+    def __init__(self, compress=False, caller=None):
+        self.compress = compress
+        self.inner_caller = caller or default_caller
+        self.deps_dir = None
+        self.logs_dir = None
+        self.local = threading.local()
+        self.begun = set()          # the paths of the logs begun so far
+
+    def __str__(self):
+        return '{}(logs_dir={})'.format(self.__class__.__name__,
+                                        self.logs_dir)
+
+    def open(self, deps_dir):
+        self.deps_dir = deps_dir
+        self.logs_dir = deps_dir / self.__class__.LOGS_DIR
+
+    def log_path(self, path):
+        '''
+        Returns the path of the log for the package at the given path.
+        '''
+        rel = os.path.relpath(str(path), str(self.deps_dir))
+        if rel.startswith(os.pardir):
+            rel = self.__class__.ROOT_LOG
+        return self.logs_dir / (rel + '.log')
+
+    def file(self):
+        stack = getattr(self.local, 'stack', None)
+        return stack[-1][1] if stack else None
+
+    def begin(self, path):
+        if not self.logs_dir:
+            return
+        log_path = self.log_path(path)
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        append = log_path in self.begun
+        self.begun.add(log_path)
+        self.local.__dict__.setdefault('stack', []).append(
+            (log_path, log_path.open('a' if append else 'w'), append))
+
+    def end(self):
+        '''
+        Closes the log of the current thread's job, and returns its path and
+        contents.
+        '''
+        stack = getattr(self.local, 'stack', None)
+        if not stack:
+            return None, ''
+        log_path, f, append = stack.pop()
+        f.close()
+        text = log_path.read_text(errors='replace')
+        if self.compress:
+            # a gzip file may hold several members, read as one
+            with log_path.open('rb') as src, \
+                    gzip.open(str(log_path) + '.gz',
+                              'ab' if append else 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            log_path.unlink()
+            log_path = Path(str(log_path) + '.gz')
+        return log_path, text
+
+    def caller(self, args, output=False, **kwargs):
+        f = self.file()
+        if f:
+            f.flush()
+            kwargs.setdefault('stderr', f)
+            if not output:
+                kwargs.setdefault('stdout', f)
+        return self.inner_caller(args, output=output, **kwargs)
+
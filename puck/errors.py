@@ -45,3 +45,13 @@ class FailedRepoCloneError(PuckError):
     exit_code = 7
 
 
+class StaleLockError(PuckError):
+    exit_code = 8
+
+
+class ServerError(PuckError):
+    exit_code = 9
+
+
+class UnresolvedRefError(PuckError):
+    exit_code = 10
@@ -0,0 +1,150 @@
+
+# Copyright 2014  Malcolm Inglis <http://minglis.id.au>
+#
+# This file is part of Puck.
+#
+# Puck is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Puck is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Puck. If not, see <https://gnu.org/licenses/>.
+
+
+import os
+import re
+import select
+import threading
+
+from .util import default_caller
+
+
+AUTH_REGEX = re.compile(r'--jobserver-(?:auth|fds)=(?:fifo:(\S+)|(\d+),(\d+))')
+JOBS_REGEX = re.compile(r'(?:^|\s)-j(\d*)(?=\s|$)')
+
+def advertised(env):
+    return bool(AUTH_REGEX.search(env.get('MAKEFLAGS', '')))
+
+def strip_jobserver(makeflags):
+    '''
+    Returns the given `MAKEFLAGS` without the job count and jobserver, which
+    don't change what a build produces.
+    '''
+    return ' '.join(w for w in makeflags.split()
+                    if not (JOBS_REGEX.fullmatch(w) or AUTH_REGEX.match(w)))
+
+
+class Jobserver:
+
+    '''
+    A GNU make jobserver: a pipe (or fifo) holding one token for each job
+    that may run besides the one that every participant implicitly holds.
+    Puck either creates one for `puck execute --jobs N`, or joins the one it
+    inherits from a parent `make` through `MAKEFLAGS`. Each job that Puck
+    runs beyond its first takes a token, and the `make` processes run by
+    the command handlers take their tokens from the same pipe, so that no
+    more than N jobs run in total.
+    '''
+
+    POLL_INTERVAL = 0.05
+
+    @classmethod
+    def create(cls, jobs, caller=None):
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b'+' * (jobs - 1))
+        return cls(read_fd, write_fd, jobs=jobs, owned=True, caller=caller)
+
+    @classmethod
+    def from_env(cls, env, caller=None):
+        '''
+        Returns the jobserver advertised by `MAKEFLAGS` in the given
+        environment, or `None` if there isn't one that's usable.
+        '''
+        makeflags = env.get('MAKEFLAGS', '')
+        m = AUTH_REGEX.search(makeflags)
+        if not m:
+            return None
+        jobs = JOBS_REGEX.search(makeflags)
+        jobs = int(jobs.group(1)) if jobs and jobs.group(1) else None
+        try:
+            if m.group(1):
+                fd = os.open(m.group(1), os.O_RDWR)
+                return cls(fd, fd, jobs=jobs, owned=True, inherited=True,
+                           caller=caller)
+            read_fd, write_fd = int(m.group(2)), int(m.group(3))
+            os.fstat(read_fd)
+            os.fstat(write_fd)
+        except OSError:
+            return None # e.g. the parent didn't pass it down with `+`
+        return cls(read_fd, write_fd, jobs=jobs, inherited=True,
+                   caller=caller)
+
+    def __init__(self, read_fd, write_fd, jobs=None, owned=False,
+                       inherited=False, caller=None):
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        self.jobs = jobs            # the total, if known
+        self.owned = owned
+        self.inherited = inherited  # whether `MAKEFLAGS` advertises it
+        self.inner_caller = caller or default_caller
+        self.lock = threading.Lock()
+        self.implicit = True        # whether the implicit token is free
+
+    def __str__(self):
+        return '{}(jobs={})'.format(self.__class__.__name__, self.jobs)
+
+    def environ(self, env):
+        '''
+        Returns the given environment, with `MAKEFLAGS` advertising this
+        jobserver.
+        '''
+        env = dict(os.environ if env is None else env)
+        if not self.inherited:
+            env['MAKEFLAGS'] = ' '.join(filter(None, [
+                strip_jobserver(env.get('MAKEFLAGS', '')),
+                '-j{}'.format(self.jobs) if self.jobs else '-j',
+                '--jobserver-auth={},{}'.format(self.read_fd,
+                                                self.write_fd)]))
+        return env
+
+    def caller(self, args, **kwargs):
+        kwargs.setdefault('pass_fds', (self.read_fd, self.write_fd))
+        return self.inner_caller(args, **kwargs)
+
+    def acquire(self):
+        '''
+        Waits for a token, and returns it, or `None` for the implicit one.
+        '''
+        while True:
+            with self.lock:
+                if self.implicit:
+                    self.implicit = False
+                    return None
+            # the pipe is shared with other processes, so it's left blocking
+            # and polled, to also notice when the implicit token is freed
+            readable, _, _ = select.select([self.read_fd], [], [],
+                                           self.__class__.POLL_INTERVAL)
+            if readable:
+                try:
+                    return os.read(self.read_fd, 1)
+                except InterruptedError:
+                    continue
+
+    def release(self, token):
+        if token is None:
+            with self.lock:
+                self.implicit = True
+        else:
+            os.write(self.write_fd, token)
+
+    def close(self):
+        if self.owned:
+            os.close(self.read_fd)
+            if self.write_fd != self.read_fd:
+                os.close(self.write_fd)
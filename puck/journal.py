@@ -0,0 +1,99 @@
+
+# Copyright 2014  Malcolm Inglis <http://minglis.id.au>
+#
+# This file is part of Puck.
+#
+# Puck is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Puck is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Puck. If not, see <https://gnu.org/licenses/>.
+
+
+import json
+import hashlib
+import threading
+from pathlib import Path
+from collections import namedtuple
+
+
+# the target an update resolved for a dependency, and the digest of the
+# dependency's manifest at that target
+Checkpoint = namedtuple('Checkpoint', ['target', 'manifest'])
+
+
+def json_digest(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+class UpdateJournal:
+
+    '''
+    Records each dependency that an update has fetched and resolved, in a
+    file in the dependencies directory that a line is appended to as each
+    one is planned, and that's removed once the update succeeds. An update
+    resumed after a failure can then skip fetching the dependencies whose
+    specification is unchanged since they were recorded.
+    '''
+
+    JSONL_PATH = Path('.puck-update.jsonl')
+
+    def __init__(self, deps_dir):
+        self.path = deps_dir / self.__class__.JSONL_PATH
+        self.entries = None     # (dependency path, spec digest) -> Checkpoint
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return '{}(path={})'.format(self.__class__.__name__, self.path)
+
+    def load(self):
+        # must be called with the lock held
+        if self.entries is None:
+            self.entries = dict()
+            try:
+                with self.path.open() as f:
+                    lines = f.readlines()
+            except FileNotFoundError:
+                lines = []
+            for line in lines:
+                try:
+                    e = json.loads(line)
+                except ValueError:
+                    continue # e.g. the last line, if writing it was cut off
+                self.entries[(e['path'], e['spec'])] = Checkpoint(
+                    tuple(e['target']), e['manifest'])
+        return self.entries
+
+    def get(self, path, spec):
+        '''
+        Returns the `Checkpoint` recorded for the dependency at the given
+        path with the given specification, or `None` if there isn't one.
+        '''
+        with self.lock:
+            return self.load().get((str(path), spec))
+
+    def record(self, path, spec, target, manifest):
+        checkpoint = Checkpoint(tuple(target), json_digest(manifest))
+        line = json.dumps({'path': str(path), 'spec': spec,
+                           'target': list(checkpoint.target),
+                           'manifest': checkpoint.manifest}, sort_keys=True)
+        with self.lock:
+            self.load()[(str(path), spec)] = checkpoint
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open('a') as f:
+                f.write(line + '\n')
+
+    def clear(self):
+        with self.lock:
+            self.entries = dict()
+            try:
+                self.path.unlink()
+            except FileNotFoundError:
+                pass
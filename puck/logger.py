@@ -17,41 +17,173 @@
 # along with Puck. If not, see <https://gnu.org/licenses/>.
 
 
+import json
+import time
+import shutil
+import threading
+
+from .package import Package
+from .status import format_table
+from .util import format_size
+
+
 class Logger:
 
-    def __init__(self, outfile, errfile, on_err=None):
+    JOBS = {'plan': 'plan', 'plan-end': 'plan',
+            'update': 'update', 'update-end': 'update',
+            'execute': 'execute', 'execute-end': 'execute'}
+
+    def __init__(self, outfile, errfile, on_err=None, capture=None,
+                       calls=True):
         self.outfile = outfile
         self.errfile = errfile
+        self.capture = capture      # a `LogCapture` for dependency output
+        self.lock = threading.Lock()
+        self.running = dict()       # thread ident -> the label of its job
+        self.finished = 0
+        self.status = ''            # the status line shown on `errfile`
         self.dispatch = {
             'no-package-json':      self.log_no_package_json,
             'execute':              self.log_execute,
             'no-command-handler':   self.log_no_command_handler,
+            'up-to-date':           self.log_up_to_date,
             'call':                 self.log_call,
+            'plan':                 self.log_plan,
+            'planned-update':       self.log_planned_update,
             'update':               self.log_update,
             'no-matching-tags':     self.log_no_matching_tags,
             'missing-dependency':   self.log_missing_dependency,
-            'dependency-conflict':  self.log_dependency_conflict
+            'dependency-conflict':  self.log_dependency_conflict,
+            'stale-lock':           self.log_stale_lock,
+            'unresolved-ref':       self.log_unresolved_ref,
+            'cached-mirror':        self.log_cached_mirror,
+            'evict-mirror':         self.log_evict_mirror,
+            'restore-outputs':      self.log_restore_outputs,
+            'cached-outputs':       self.log_cached_outputs,
+            'evict-outputs':        self.log_evict_outputs,
+            'probe-url':            self.log_probe_url,
+            'prune-dependency':     self.log_prune_dependency,
+            'serve':                self.log_serve,
+            'serve-request':        self.log_serve_request,
+            'server-running':       self.log_server_running,
+            'no-server':            self.log_no_server,
+            'dirty-orphan':         self.log_dirty_orphan,
+            'watch':                self.log_watch,
+            'watch-changes':        self.log_watch_changes,
+            'watch-cancel':         self.log_watch_cancel,
+            'watch-idle':           self.log_watch_idle,
+            'schedule':             self.log_schedule,
+            'retry':                self.log_retry,
+            'resume-dependency':    self.log_resume_dependency,
+            'list-dependency':      self.log_list_dependency,
+            'dependency-graph':     self.log_dependency_graph,
+            'dependency-status':    self.log_dependency_status,
+            'load-manifest':        self.log_nothing,
+            'call-end':             self.log_nothing,
+            'plan-end':             self.log_nothing,
+            'update-end':           self.log_nothing,
+            'execute-end':          self.log_nothing,
+            'load-manifest-end':    self.log_nothing
         }
+        if not calls:
+            # e.g. the queries behind a report, which would be mixed into it
+            self.dispatch['call'] = self.log_nothing
 
     def __str__(self):
         return '{}(outfile={}, errfile={})'.format(self.__class__.__name__,
                                                    self.outfile, self.errfile)
 
     def out(self, *args, **kwargs):
-        if self.outfile:
-            print(*args, file=self.outfile, **kwargs)
+        log = self.capture.file() if self.capture else None
+        if log:
+            print(*args, file=log, **kwargs)
+        else:
+            self.write(self.outfile, *args, **kwargs)
 
     def err(self, *args, exitcode=1, **kwargs):
-        if self.errfile:
-            print(*args, file=self.errfile, **kwargs)
+        log = self.capture.file() if self.capture else None
+        if log:
+            print(*args, file=log, **kwargs)
+        self.write(self.errfile, *args, **kwargs)
+
+    def write(self, f, *args, **kwargs):
+        if f:
+            with self.lock:
+                self.show_status('')
+                print(*args, file=f, **kwargs)
+                f.flush()
+                self.show_status(self.status_line())
+
+    def close(self):
+        with self.lock:
+            self.show_status('')
 
     def notify(self, event, **kwargs):
+        if self.capture and event in self.__class__.JOBS:
+            self.track(event, **kwargs)
         self.dispatch.get(event, self.log_default)(event, **kwargs)
 
+    def track(self, event, dependency=None, package=None, command=None,
+                    failed=False):
+        '''
+        Opens the log of a dependency's job when it begins, and reports on
+        the job when it ends, dumping its log if it failed.
+        '''
+        path = dependency.full_path if dependency else package.path
+        label = '{} ({})'.format(path, self.__class__.JOBS[event])
+        if not event.endswith('-end'):
+            self.capture.begin(path)
+            with self.lock:
+                self.running[threading.get_ident()] = label
+                self.show_status(self.status_line())
+            return
+        log_path, text = self.capture.end()
+        with self.lock:
+            self.running.pop(threading.get_ident(), None)
+            self.finished += 1
+        if failed:
+            self.log_failed_job(label, log_path, text)
+        else:
+            self.log_finished_job(label)
+
+    def is_tty(self):
+        return bool(self.errfile and self.errfile.isatty())
+
+    def status_line(self):
+        if not (self.capture and self.running and self.is_tty()):
+            return ''
+        line = '### {} done, running: {}'.format(
+                   self.finished, ', '.join(sorted(self.running.values())))
+        width = shutil.get_terminal_size().columns - 1
+        return line if len(line) <= width else line[:width - 3] + '...'
+
+    def show_status(self, line):
+        # must be called with the lock held
+        if line != self.status and self.is_tty():
+            self.errfile.write('\r\033[K' + line)
+            self.errfile.flush()
+            self.status = line
+
+    def log_finished_job(self, label):
+        if self.is_tty():
+            with self.lock:
+                self.show_status(self.status_line())
+        else:
+            self.write(self.outfile, '### {}: done'.format(label))
+
+    def log_failed_job(self, label, log_path, text):
+        if log_path is None:
+            return
+        self.write(self.errfile, '### {}: failed; its log `{}` follows:\n{}'
+                                   .format(label, log_path, text.rstrip()))
+
     def log_default(self, event, **kwargs):
         self.err('WARNING: event `{}` received: kwargs={}'
                    .format(event, kwargs))
 
+    def log_nothing(self, event, **kwargs):
+        pass # e.g. the end of an action, which is only of use to a `Tracer`
+
     def log_no_package_json(self, event):
         self.err('ERROR: no `{}` found in all directories up to the home '
                  'directory.'
@@ -65,6 +197,15 @@ class Logger:
         self.err('ERROR: conflict between dependencies at path `{}`'
                    .format(path))
 
+    def log_stale_lock(self, event, dependency):
+        self.err('ERROR: `{}` has no up-to-date entry for the dependency at '
+                 'path `{}`; run `puck update` without `--frozen` first.'
+                   .format(Package.LOCK_PATH, dependency.path))
+
+    def log_unresolved_ref(self, event, dependency, rev):
+        self.err('ERROR: `{}` doesn\'t name a commit in the repository of the '
+                 'dependency at path `{}`.'.format(rev, dependency.path))
+
     def log_execute(self, event, package, command):
         self.out('### {}: executing command `{}`...'
                    .format(package.path, command))
@@ -73,10 +214,43 @@ class Logger:
         self.out('### {}: no handler for command `{}`'
                    .format(package.path, command))
 
+    def log_up_to_date(self, event, package, command):
+        self.out('### {}: command `{}` is up to date'
+                   .format(package.path, command))
+
     def log_call(self, event, args, cwd=None):
-        if cwd:
-            self.out('[{}]'.format(cwd), end=' ')
-        self.out(args if isinstance(args, str) else ' '.join(args))
+        self.out(('[{}] '.format(cwd) if cwd else '')
+                 + (args if isinstance(args, str) else ' '.join(args)))
+
+    def log_plan(self, event, dependency):
+        self.out('\n### Resolving dependency at: {}'
+                   .format(dependency.full_path))
+
+    def log_planned_update(self, event, dependency, target):
+        commit = target.commit[:12] if target.commit else 'unknown commit'
+        if target.head is None:
+            plan = 'clone, and check out {} at {}'.format(target.rev
+                                                          or 'HEAD', commit)
+        elif target.rev is None:
+            plan = 'keep {}'.format(target.head[:12])
+        elif target.commit == target.head:
+            plan = 'up to date at {} ({})'.format(target.rev, commit)
+        else:
+            plan = 'check out {} at {} (from {})'.format(target.rev, commit,
+                                                         target.head[:12])
+            if target.merge:
+                plan += ', and merge its upstream branch'
+        self.out('### {}: {}'.format(dependency.full_path, plan))
+
+    def log_resume_dependency(self, event, dependency, target):
+        self.out('### {}: resuming at {} ({}), as planned by the last update'
+                   .format(dependency.full_path, target.rev or 'HEAD',
+                           target.commit[:12] if target.commit
+                           else 'unknown commit'))
+
+    def log_retry(self, event, path, attempt, retries, delay):
+        self.err('WARNING: fetching into {} failed; retrying in {:g} s '
+                 '(retry {} of {}).'.format(path, delay, attempt, retries))
 
     def log_update(self, event, dependency):
         self.out('\n### Updating dependency at: {}'
@@ -86,5 +260,131 @@ class Logger:
         self.err('WARNING: no matching tags in package {} for pattern `{}`.'
                    .format(path, pattern))
 
+    def log_cached_mirror(self, event, path, url, size):
+        self.out('{:>8}  {}  ({})'.format(format_size(size), url, path.name))
+
+    def log_evict_mirror(self, event, path, size):
+        self.out('### Evicting mirror {} ({})'
+                   .format(path.name, format_size(size)))
+
+    def log_restore_outputs(self, event, package, command):
+        self.out('### {}: restored the outputs of command `{}` from the cache'
+                   .format(package.path, command))
+
+    def log_cached_outputs(self, event, path, size):
+        self.out('{:>8}  outputs  ({})'.format(format_size(size), path.name))
+
+    def log_evict_outputs(self, event, path, size):
+        self.out('### Evicting outputs {} ({})'
+                   .format(path.name, format_size(size)))
+
+    def log_serve(self, event, path):
+        self.out('### Serving on: {}'.format(path))
+
+    def log_serve_request(self, event, argv):
+        self.out('### Serving: puck {}'.format(' '.join(argv[1:])))
+
+    def log_server_running(self, event, path):
+        self.err('ERROR: a server is already running on `{}`.'.format(path))
+
+    def log_list_dependency(self, event, dependency):
+        self.out(dependency.path)
+
+    def log_dependency_graph(self, event, graph, name, as_json):
+        self.out(json.dumps(graph.to_json(), indent=4, sort_keys=True)
+                 if as_json else graph.to_dot(name=name))
+
+    def log_dependency_status(self, event, statuses, as_json):
+        self.out(json.dumps({p: s.to_json() for p, s in statuses.items()},
+                            indent=4, sort_keys=True)
+                 if as_json else format_table(list(statuses.values())))
+
+    def log_no_server(self, event, path):
+        self.err('ERROR: no server is running on `{}`.'.format(path))
+
+    def log_watch(self, event, paths, method):
+        self.out('### Watching {} checkouts for changes ({})'
+                   .format(len(paths), method))
+
+    def log_watch_changes(self, event, paths):
+        self.out('### Changed: {}'.format(', '.join(map(str, paths))))
+
+    def log_watch_cancel(self, event):
+        self.out('### Cancelling the execution in progress')
+
+    def log_watch_idle(self, event):
+        self.out('### Waiting for changes')
+
+    def log_schedule(self, event, command, jobs, path, unknown, times):
+        self.out('### Predicted critical path of command `{}`: {:.3f} s'
+                   .format(command, sum(s for _, s in path)))
+        for package, seconds in path:
+            self.out('{:>9.3f} s  {}'.format(seconds, package.path))
+        if unknown:
+            self.out('### No timing history for {} package(s), which are '
+                     'predicted to take the mean time of the others'
+                       .format(len(unknown)))
+        self.out('### Predicted time with:')
+        for n, seconds in times:
+            self.out('{:>9.3f} s  {} job{}{}'.format(
+                         seconds, n, '' if n == 1 else 's',
+                         '  (--jobs)' if n == jobs else ''))
+
+    def log_prune_dependency(self, event, path, target=None):
+        if target:
+            self.out('### Archiving orphaned dependency at: {} to: {}'
+                       .format(path, target))
+        else:
+            self.out('### Removing orphaned dependency at: {}'.format(path))
+
+    def log_dirty_orphan(self, event, path):
+        self.err('WARNING: not pruning orphaned dependency at {}, because '
+                 'it has uncommitted changes; pass `--force` to prune it '
+                 'anyway.'
+                   .format(path))
+
+    def log_probe_url(self, event, url, latency):
+        self.out('### Probed {}: {}'
+                   .format(url, 'failed' if latency is None
+                                else '{:.0f} ms'.format(latency * 1000)))
+
+
+class JsonlLogger(Logger):
+
+    '''
+    Logs every event as a line of JSON on `outfile`, with the time it was
+    received and the thread it was received on, for other programs to read.
+    '''
+
+    def notify(self, event, **kwargs):
+        if self.capture and event in self.__class__.JOBS:
+            self.track(event, **kwargs)
+        record = {'event': event, 'time': round(time.time(), 6),
+                  'thread': threading.get_ident()}
+        record.update((k, self.encode(v)) for k, v in kwargs.items())
+        self.write(self.outfile, json.dumps(record, default=self.jsonable,
+                                            separators=(',', ':')))
+
+    def encode(self, value):
+        # e.g. a `DependencyGraph`, or a `DependencyStatus`, which would
+        # otherwise be encoded as a plain list
+        if hasattr(value, 'to_json'):
+            return value.to_json()
+        elif isinstance(value, dict):
+            return {k: self.encode(v) for k, v in value.items()}
+        return value
+
+    def jsonable(self, value):
+        # e.g. a `Package` or `Dependency`, which is identified by its path
+        return str(getattr(value, 'path', value))
+
+    def is_tty(self):
+        return False
 
+    def log_finished_job(self, label):
+        pass # the end event was already logged
 
+    def log_failed_job(self, label, log_path, text):
+        if log_path is not None:
+            self.notify('failed-job-log', job=label, log=log_path,
+                        output=text)
@@ -20,28 +20,206 @@
 from pathlib import Path
 
 from .args import parse_args
-from .logger import Logger
-from .errors import PuckError
+from .logger import Logger, JsonlLogger
+from .errors import PuckError, ServerError, DependencyConflictError
 from .package import Package
+from .repo import RetryPolicy, RETRY_DELAY
+from .mirror import MirrorCache
+from .snapshot import ManifestCache
+from .backend import BACKENDS
+from .urlstats import UrlStats
+from .trace import Tracer
+from .capture import LogCapture
+from .outputs import OutputCache
+from .server import Server, request
+from .watch import Watch
+from .jobserver import Jobserver, advertised
+from .timings import TimingStore
 
 
-def main(argv, env, cwd, outfile=None, errfile=None):
+def main(argv, env, cwd, outfile=None, errfile=None, server=None):
 
     args = parse_args(argv)
-    logger = Logger(outfile, errfile)
+    # a watch never ends, so it's never given to a server to run
+    watch = Watch() if args.sub == 'execute' and args.watch else None
+    jobserver = None
+    # a jobserver inherited from `make` is only usable by this process
+    inherit = (server is None and args.sub == 'execute'
+               and not args.no_jobserver and advertised(env))
+    if (server is None and not args.no_server and args.sub != 'serve'
+            and not watch and not inherit):
+        code = request(cwd, argv, env, outfile, errfile)
+        if code is not None:
+            return code
+    spawn = server.redirect if server else watch.caller if watch else None
+    capture = (LogCapture(compress=args.compress_logs, caller=spawn)
+               if args.capture or args.log_format == 'jsonl' else None)
+    caller = capture.caller if capture else spawn
+    if args.sub == 'execute':
+        if not args.no_jobserver:
+            jobserver = ((Jobserver.from_env(env, caller=caller) if inherit
+                          else None)
+                         or (Jobserver.create(args.jobs, caller=caller)
+                             if (args.jobs or 1) > 1 else None))
+            caller = jobserver.caller if jobserver else caller
+        args.jobs = args.jobs or (jobserver and jobserver.jobs) or 1
+    logger = (JsonlLogger if args.log_format == 'jsonl' else Logger)(
+                  outfile, errfile, capture=capture,
+                  calls=args.sub != 'status')
+    tracer = Tracer() if args.trace else None
+    timings = TimingStore() if args.sub == 'execute' else None
+    observers = ([logger] + ([tracer] if tracer else [])
+                 + ([watch] if watch else [])
+                 + ([timings] if timings else []))
+    if watch:
+        watch.observers = observers
+    if server:
+        # the objects kept by the server report to this invocation
+        server.begin(observers, caller)
+        observers, caller = server.observers, server.caller
+    cache_dir = Path(args.cache_dir or MirrorCache.default_path(env))
+    mirrors = MirrorCache(cache_dir, observers=observers, caller=caller)
+    url_stats = UrlStats(cache_dir, observers=observers)
+    outputs = OutputCache(cache_dir, observers=observers)
+    backend = (server.backend if server else
+               BACKENDS[args.backend](observers=observers, caller=caller))
 
     try:
-        package = Package.from_path(Path(cwd), observers=[logger])
-        if args.sub == 'update':
-            package.update(verify=not args.no_verify, dev=not args.no_dev)
+        if args.sub == 'cache':
+            if args.action == 'evict':
+                mirrors.evict(args.max_size)
+                outputs.evict(args.max_size)
+            else:
+                mirrors.list()
+                outputs.list()
+            return 0
+        elif args.sub == 'serve' and args.stop:
+            if request(cwd, stop=True) is None:
+                root = Package.root_path(Path(cwd)) or cwd
+                logger.notify('no-server', path=Server.socket_path_for(root))
+                raise ServerError()
+            return 0
+        manifests = server.manifests if server else ManifestCache()
+        manifests.begin()
+        package = Package.from_path(Path(cwd), observers=observers,
+                                    mirrors=(mirrors if args.sub == 'update'
+                                                        and args.mirror
+                                             else None),
+                                    manifests=manifests,
+                                    backend=backend,
+                                    url_stats=url_stats,
+                                    retry=(RetryPolicy(args.retries,
+                                                       RETRY_DELAY,
+                                                       args.timeout or None)
+                                           if args.sub == 'update'
+                                           else None),
+                                    caller=caller)
+        if not manifests.snapshot_path:
+            manifests.open(package.deps_dir)
+        if capture:
+            capture.open(package.deps_dir)
+        if timings and (package.dependencies or package.deps_dir.exists()):
+            timings.open(package.deps_dir, package.path)
+        if args.sub == 'update' and args.dry_run:
+            graph = package.plan(verify=not args.no_verify,
+                                 dev=not args.no_dev, jobs=args.jobs,
+                                 lock=(package.read_lock() if args.frozen
+                                       else None),
+                                 shallow=args.shallow)
+            for dep in graph:
+                package.event('planned-update', dependency=dep,
+                              target=dep.target)
+            if graph.conflicts:
+                raise DependencyConflictError()
+        elif args.sub == 'update':
+            lock = package.read_lock()
+            graph = package.update(verify=not args.no_verify,
+                                   dev=not args.no_dev, jobs=args.jobs,
+                                   lock=lock if args.frozen else None,
+                                   shallow=args.shallow, resume=args.resume)
+            if not args.frozen:
+                package.write_lock(graph, keep=lock if args.no_dev else None)
+            if args.prune:
+                package.prune(prune_keep(package, graph, args.no_dev))
+            if args.cache_max_size is not None:
+                mirrors.evict(args.cache_max_size)
+            if server:
+                server.invalidate()
+        elif args.sub == 'execute' and args.explain_schedule:
+            package.explain_schedule(
+                args.command, timings,
+                graph=(server.graph(package, dev=not args.no_dev)
+                       if server else None),
+                root=args.root, dev=not args.no_dev, jobs=args.jobs)
+        elif args.sub == 'execute' and watch:
+            watch.run(package, args.command, env=env, check=args.check,
+                      root=args.root, dev=not args.no_dev, jobs=args.jobs,
+                      incremental=args.incremental, polling=args.poll,
+                      cache=None if args.no_output_cache else outputs,
+                      jobserver=jobserver, timings=timings)
         elif args.sub == 'execute':
             package.execute(args.command, env=env, check=args.check,
-                            root=args.root, dev=not args.no_dev)
+                            graph=(server.graph(package, dev=not args.no_dev)
+                                   if server else None),
+                            root=args.root, dev=not args.no_dev,
+                            jobs=args.jobs, jobserver=jobserver,
+                            timings=timings, incremental=args.incremental,
+                            cache=None if args.no_output_cache else outputs)
+            if args.cache_max_size is not None:
+                outputs.evict(args.cache_max_size)
+        elif args.sub == 'graph':
+            graph = (server.graph(package, dev=not args.no_dev) if server
+                     else package.graph(dev=not args.no_dev))
+            package.event('dependency-graph', graph=graph,
+                          name=package.path.resolve().name,
+                          as_json=args.format == 'json')
+        elif args.sub == 'prune':
+            package.prune(prune_keep(package,
+                                     package.graph(dev=not args.no_dev),
+                                     args.no_dev),
+                          archive=args.archive, force=args.force,
+                          gc=args.gc, jobs=args.jobs)
+        elif args.sub == 'status':
+            statuses = package.status(dev=not args.no_dev, jobs=args.jobs)
+            package.event('dependency-status',
+                          statuses={str(s.path): s for s in statuses},
+                          as_json=args.format == 'json')
+        elif args.sub == 'list':
+            for dep in (server.graph(package, dev=not args.no_dev) if server
+                        else package.graph(dev=not args.no_dev)):
+                package.event('list-dependency', dependency=dep)
+        elif args.sub == 'serve':
+            try:
+                Server(package.path, backend=args.backend,
+                       observers=observers).serve()
+            except KeyboardInterrupt:
+                pass
+
+        manifests.save()
 
     except PuckError as e:
         # error event was logged before the exception was raised
         return e.exit_code
     else:
         return 0
+    finally:
+        if not server:
+            backend.close()
+        if jobserver:
+            jobserver.close()
+        if timings:
+            timings.save()
+        url_stats.save()
+        if tracer:
+            tracer.write(Path(args.trace))
+            if args.log_format == 'jsonl':
+                logger.notify('trace-summary', **tracer.summarize())
+            else:
+                tracer.summary(logger.out)
+        logger.close()
 
 
+def prune_keep(package, graph, no_dev):
+    # development dependencies that weren't updated are still locked
+    return ([d.path for d in graph]
+            + ([Path(p) for p in package.read_lock()] if no_dev else []))
@@ -0,0 +1,143 @@
+
+# Copyright 2014  Malcolm Inglis <http://minglis.id.au>
+#
+# This file is part of Puck.
+#
+# Puck is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Puck is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Puck. If not, see <https://gnu.org/licenses/>.
+
+
+import os
+import re
+import fcntl
+import shutil
+import hashlib
+from pathlib import Path
+from contextlib import contextmanager
+
+from .util import default_caller, call_method
+
+
+CONFIG_URL_REGEX = re.compile(r'^\s*url\s*=\s*(.*?)\s*$', re.MULTILINE)
+
+
+class MirrorCache:
+
+    '''
+    A user-level directory of bare mirror repositories, one per repository
+    URL, shared by every package that is updated with it. Dependencies are
+    cloned from and fetched from their mirror, so each URL is only
+    downloaded once across all of the packages on a machine.
+    '''
+
+    MIRRORS_DIR = Path('mirrors')
+
+    @classmethod
+    def default_path(cls, env):
+        if env.get('PUCK_CACHE_DIR'):
+            return Path(env['PUCK_CACHE_DIR'])
+        return Path(env.get('XDG_CACHE_HOME')
+                    or os.path.expanduser('~/.cache')) / 'puck'
+
+    def __init__(self, path, observers=None, caller=None):
+        self.path = (Path(os.path.abspath(str(path)))
+                     / self.__class__.MIRRORS_DIR)
+        self.observers = observers or list()
+        self.caller = caller or default_caller
+
+    def __str__(self):
+        return '{}(path={})'.format(self.__class__.__name__, str(self.path))
+
+    def event(self, event, *args, **kwargs):
+        for o in self.observers:
+            o.notify(event, *args, **kwargs)
+
+    call = call_method
+
+    def mirror_path(self, url):
+        return self.path / (hashlib.sha1(url.encode()).hexdigest() + '.git')
+
+    @contextmanager
+    def locked(self, mirror, blocking=True):
+        '''
+        Holds an exclusive lock on the given mirror, shared with other
+        threads and other Puck processes, and yields whether it was acquired.
+        '''
+        self.path.mkdir(parents=True, exist_ok=True)
+        with mirror.with_suffix('.lock').open('w') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking
+                                                else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+            else:
+                yield True
+
+    def update(self, url):
+        '''
+        Creates or fetches into the mirror of the given URL, marking it as
+        recently used, and returns its path.
+        '''
+        mirror = self.mirror_path(url)
+        with self.locked(mirror):
+            if mirror.is_dir():
+                self.call(['git', 'fetch', '--prune', 'origin'], cwd=mirror,
+                          errors=True)
+            else:
+                self.call(['git', 'clone', '--mirror', url, str(mirror)],
+                          cwd='.', errors=True)
+            os.utime(str(mirror))
+        return mirror
+
+    def entries(self):
+        '''
+        Returns `(path, size, mtime)` for every mirror in the cache, from
+        least to most recently used.
+        '''
+        if not self.path.is_dir():
+            return []
+        return sorted(((m, dir_size(m), m.stat().st_mtime)
+                       for m in self.path.glob('*.git') if m.is_dir()),
+                      key=lambda e: e[2])
+
+    def url(self, mirror):
+        m = CONFIG_URL_REGEX.search((mirror / 'config').read_text())
+        return m.group(1) if m else None
+
+    def list(self):
+        for mirror, size, mtime in reversed(self.entries()):
+            self.event('cached-mirror', path=mirror, url=self.url(mirror),
+                       size=size)
+
+    def evict(self, max_size=0):
+        '''
+        Removes the least recently used mirrors until the cache holds at most
+        `max_size` bytes. Mirrors in use by another process are skipped.
+        '''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for mirror, size, _ in entries:
+            if total <= max_size:
+                break
+            with self.locked(mirror, blocking=False) as acquired:
+                if not acquired:
+                    continue
+                self.event('evict-mirror', path=mirror, size=size)
+                shutil.rmtree(str(mirror))
+            total -= size
+
+
+def dir_size(path):
+    return sum(f.stat().st_size for f in path.glob('**/*') if f.is_file())
+
+
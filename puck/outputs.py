@@ -0,0 +1,138 @@
+
+# Copyright 2014  Malcolm Inglis <http://minglis.id.au>
+#
+# This file is part of Puck.
+#
+# Puck is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Puck is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Puck. If not, see <https://gnu.org/licenses/>.
+
+
+import os
+import json
+import tarfile
+import hashlib
+from pathlib import Path
+
+from .util import replacing
+from .stamps import StampStore, stable_env
+
+
+class OutputCache:
+
+    '''
+    A user-level directory of the outputs of commands, shared by every
+    package that is executed with it. The outputs that a package declares
+    for a command are archived under a key that digests everything they
+    depend on: the package's commit, the command's handler and declared
+    outputs, its environment, and the keys of the package's dependencies.
+    Executing the command again with the same key anywhere on the machine
+    restores the archived outputs instead.
+    '''
+
+    OUTPUTS_DIR = Path('outputs')
+
+    # variables that differ between workspaces without affecting outputs
+    IGNORED_ENV = StampStore.IGNORED_ENV | frozenset(['DEPS_DIR'])
+
+    def __init__(self, path, observers=None):
+        self.path = (Path(os.path.abspath(str(path)))
+                     / self.__class__.OUTPUTS_DIR)
+        self.observers = observers or list()
+
+    def __str__(self):
+        return '{}(path={})'.format(self.__class__.__name__, str(self.path))
+
+    def event(self, event, *args, **kwargs):
+        for o in self.observers:
+            o.notify(event, *args, **kwargs)
+
+    def key(self, commit, handler, outputs, env, inputs, sparse=None):
+        env = stable_env(env, self.__class__.IGNORED_ENV)
+        value = [commit, handler, outputs, env, inputs]
+        if sparse:
+            value.append(sparse)
+        return hashlib.sha256(json.dumps(value).encode()).hexdigest()
+
+    def entry_path(self, key):
+        return self.path / (key + '.tar')
+
+    def restore(self, key, dest):
+        '''
+        Extracts the outputs archived under the given key into `dest`, and
+        returns whether there were any.
+        '''
+        entry = self.entry_path(key)
+        try:
+            tar = tarfile.open(str(entry))
+        except (OSError, tarfile.TarError):
+            return False
+        with tar:
+            if hasattr(tarfile, 'data_filter'):
+                tar.extractall(str(dest), filter='data')
+            else:
+                tar.extractall(str(dest))
+        os.utime(str(entry))
+        return True
+
+    def store(self, key, src, patterns):
+        '''
+        Archives the files and directories in `src` matching the given glob
+        patterns under the given key.
+        '''
+        src = src.resolve()
+        paths = set()
+        for pattern in patterns:
+            for path in src.glob(pattern):
+                rel = os.path.relpath(str(path.resolve()), str(src))
+                if not rel.startswith(os.pardir):
+                    paths.add(rel)
+        self.path.mkdir(parents=True, exist_ok=True)
+        entry = self.entry_path(key)
+        with replacing(entry) as tmp_path, \
+                tarfile.open(str(tmp_path), 'w') as tar:
+            for rel in sorted(paths):
+                tar.add(str(src / rel), arcname=rel)
+
+    def entries(self):
+        '''
+        Returns `(path, size, mtime)` for every archive in the cache, from
+        least to most recently used.
+        '''
+        if not self.path.is_dir():
+            return []
+        return sorted(((e, st.st_size, st.st_mtime)
+                       for e, st in ((e, e.stat())
+                                     for e in self.path.glob('*.tar'))),
+                      key=lambda e: e[2])
+
+    def list(self):
+        for entry, size, mtime in reversed(self.entries()):
+            self.event('cached-outputs', path=entry, size=size)
+
+    def evict(self, max_size=0):
+        '''
+        Removes the least recently used archives until the cache holds at
+        most `max_size` bytes.
+        '''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for entry, size, _ in entries:
+            if total <= max_size:
+                break
+            self.event('evict-outputs', path=entry, size=size)
+            try:
+                entry.unlink()
+            except FileNotFoundError:
+                pass # evicted by another process
+            total -= size
+
@@ -19,14 +19,25 @@
 
 import os
 import re
+import json
+import math
+import shutil
+import hashlib
 from pathlib import Path
+from subprocess import CalledProcessError, DEVNULL
 from shlex import split as shell_split
-from collections import ChainMap
+from collections import ChainMap, namedtuple
 
-from .repo import Repo
+from .repo import Repo, is_commit_id, branch_refspec, tag_refspec
+from .scheduler import Scheduler
+from .stamps import StampStore
+from .journal import UpdateJournal, json_digest
+from .status import DependencyStatus
 from .errors import (NoPackageJsonError, MissingDependencyError,
-                     DependencyConflictError, DuplicatePathError)
-from .util import load_json, derive_path, default_caller, call_method
+                     DependencyConflictError, DuplicatePathError,
+                     StaleLockError, UnresolvedRefError)
+from .util import (load_json, dump_json, derive_path, default_caller,
+                   call_method, parallel_map)
 
 
 class Package:
@@ -37,7 +48,10 @@ class Package:
     '''
 
     JSON_PATH = Path('Package.json')
+    LOCK_PATH = Path('Package.lock')
     DEPS_DIR  = Path('deps')
+    ARCHIVE_DIR = Path('.puck-archive')
+    STAGING_DIR = Path('.puck-staging')
 
     @classmethod
     def from_path(cls, path, **kwargs):
@@ -46,32 +60,71 @@ class Package:
                                  json_path=path / cls.JSON_PATH,
                                  **kwargs)
         except FileNotFoundError as e:
-            if path.parent == path:
+            # `.` is its own parent, so walk up from the absolute path
+            parent = path.absolute().parent
+            if parent == path.absolute():
                 raise NoPackageJsonError()
             else:
-                return cls.from_path(path.parent, **kwargs)
+                return cls.from_path(parent, **kwargs)
 
     @classmethod
-    def from_json(cls, path, json_path, require_json=True, **kwargs):
-        jsond = (load_json(json_path)
-                 if require_json or json_path.exists() else
-                 dict())
+    def root_path(cls, path):
+        '''
+        Returns the nearest of the given path and its parents that has a
+        `Package.json` file, like `from_path` finds it, or `None`.
+        '''
+        while not (path / cls.JSON_PATH).exists():
+            parent = path.absolute().parent
+            if parent == path.absolute():
+                return None
+            path = parent
+        return path
+
+    @classmethod
+    def from_json(cls, path, json_path, require_json=True, manifests=None,
+                       **kwargs):
+        observers = kwargs.get('observers') or list()
+        for o in observers:
+            o.notify('load-manifest', path=json_path)
+        try:
+            jsond = (manifests.load(json_path) if manifests else
+                     load_json(json_path))
+        except FileNotFoundError:
+            if require_json:
+                raise
+            jsond = dict()
+        finally:
+            for o in observers:
+                o.notify('load-manifest-end', path=json_path)
+        return cls.from_json_value(path, jsond, manifests=manifests,
+                                   **kwargs)
+
+    @classmethod
+    def from_json_value(cls, path, jv, **kwargs):
         return cls(path,
-                   dependencies = jsond.get('dependencies'),
-                   commands     = jsond.get('commands'),
+                   dependencies = jv.get('dependencies'),
+                   commands     = jv.get('commands'),
+                   outputs      = jv.get('outputs'),
                    **kwargs)
 
     def __init__(self, path, deps_dir=None, dependencies=None, commands=None,
-                       observers=None, caller=None):
+                       outputs=None, observers=None, caller=None, mirrors=None,
+                       manifests=None, backend=None, url_stats=None,
+                       retry=None):
         self.path = path
         assert self.path.is_dir()
         self.caller = caller or default_caller
-        self.commands = commands or dict()
+        self.commands = dict(commands or dict())
+        self.outputs = dict(outputs or dict())  # command -> glob patterns
+        self.sparse = None          # the directories of a sparse checkout
         self.observers = observers or list()
+        self.mirrors = mirrors
+        self.manifests = manifests
+        self.backend = backend
+        self.url_stats = url_stats
+        self.retry = retry
         self.deps_dir = deps_dir or self.path / self.__class__.DEPS_DIR
-        self.dependencies = [Dependency(self.deps_dir,
-                                        observers=self.observers,
-                                        caller=self.caller, **d)
+        self.dependencies = [self.make_dependency(d)
                              for d in (dependencies or set())]
 
     def __str__(self):
@@ -83,33 +136,387 @@ class Package:
 
     call = call_method
 
-    def apply_deps(self, f, dev=False):
-        for dep in self.dependencies:
-            if not dev and dep.dev: continue
-            f(dep)
-
-    def update(self, updated=None, verify=True, dev=False):
-        updated = updated or []
-        self.apply_deps(lambda d: d.update(updated, verify=verify),
-                        dev=dev)
-
-    def execute(self, command, executed=None, check=False, env=None,
-                      root=True, dev=False):
-        executed = executed or []
-        self.apply_deps(lambda d: d.execute(command, executed,
-                                            check=check, env=env),
-                        dev=dev)
+    def make_dependency(self, jv):
+        dep = Dependency(self.deps_dir,
+                         observers=self.observers,
+                         caller=self.caller,
+                         mirrors=self.mirrors,
+                         manifests=self.manifests,
+                         backend=self.backend,
+                         url_stats=self.url_stats,
+                         retry=self.retry, **jv)
+        dep.spec = jv
+        return dep
+
+    def selected_deps(self, dev=False):
+        return [d for d in self.dependencies if dev or not d.dev]
+
+    @property
+    def lock_path(self):
+        return self.path / self.__class__.LOCK_PATH
+
+    def read_lock(self):
+        return load_json(self.lock_path) if self.lock_path.exists() else dict()
+
+    def write_lock(self, deps, keep=None):
+        '''
+        Writes the `Package.lock` file recording the commit checked out for
+        each of the given updated dependencies. Entries of `keep` (e.g. the
+        previous lock) are kept for paths that weren't updated.
+        '''
+        lock = dict(keep or dict())
+        lock.update((str(d.path), d.lock_entry()) for d in deps)
+        dump_json(self.lock_path, lock)
+
+    def plan(self, verify=True, dev=False, jobs=1, lock=None,
+                   shallow=False, journal=None):
+        '''
+        Resolves the updated dependency tree one level at a time without
+        changing any working tree, returning the planned `DependencyGraph`
+        with every conflict found in it. The dependencies of each level are
+        checked for conflicts in declaration order, and then fetched by up to
+        `jobs` concurrent workers, which choose the commit each would be
+        checked out to and read its package from that commit. If a `lock` is
+        given, every dependency is planned to be checked out to its locked
+        commit instead of resolving its tag or reference. If `shallow`,
+        dependencies without their own clone options are cloned with a depth
+        of one. Each planned dependency is recorded in the `UpdateJournal`, if
+        one is given, and those already recorded in it aren't fetched again.
+        '''
+        def plan_level(deps):
+            commits = [None if lock is None else d.locked_commit(lock)
+                       for d in deps]
+            parallel_map(lambda dc: dc[0].plan_self(verify=verify,
+                                                    commit=dc[1],
+                                                    shallow=shallow,
+                                                    journal=journal),
+                         zip(deps, commits), jobs=jobs)
+        return DependencyGraph.build(self, dev=dev, visit=plan_level,
+                                     strict=False)
+
+    def update(self, verify=True, dev=False, jobs=1, lock=None,
+                     shallow=False, resume=False):
+        '''
+        Plans the update of the dependency tree, and then, provided there
+        are no conflicts, checks every dependency out to its planned commit
+        with up to `jobs` concurrent workers, returning the updated
+        `DependencyGraph`. Nothing in the `deps` directory is checked out if
+        the plan fails. Until the update succeeds, the planned dependencies
+        are kept in a journal, and if `resume`, those planned by the last
+        update to fail aren't fetched and resolved again.
+        '''
+        journal = UpdateJournal(self.deps_dir)
+        if not resume:
+            journal.clear()
+        graph = self.plan(verify=verify, dev=dev, jobs=jobs, lock=lock,
+                          shallow=shallow, journal=journal)
+        if graph.conflicts:
+            raise DependencyConflictError()
+        parallel_map(lambda d: d.checkout_self(), list(graph), jobs=jobs)
+        shutil.rmtree(str(self.deps_dir / self.__class__.STAGING_DIR),
+                      ignore_errors=True)
+        journal.clear()
+        if self.manifests:
+            self.graph(dev=dev)     # snapshots the checked-out tree
+        return graph
+
+    def graph(self, dev=False):
+        '''
+        Returns the dependency graph read from the dependency directories,
+        restoring it from the snapshot in the `ManifestCache` if none of the
+        manifests it was built from has changed, or else building it and
+        storing its snapshot.
+        '''
+        if self.manifests is None:
+            return DependencyGraph.build(self, dev=dev)
+        snapshot = self.manifests.graph(dev)
+        if snapshot is not None:
+            return DependencyGraph.restore(self, snapshot, self.manifests)
+        graph = DependencyGraph.build(self, dev=dev)
+        self.manifests.store_graph(
+            dev, graph.to_snapshot(),
+            [self.path / self.JSON_PATH]
+            + [d.full_path / self.JSON_PATH for d in graph])
+        return graph
+
+    def status(self, dev=False, jobs=1):
+        '''
+        Returns the `DependencyStatus` of each dependency in the tree, in
+        breadth-first order, gathered by up to `jobs` concurrent workers
+        without fetching. The tree is read from the checkouts that exist, so
+        the dependencies of a missing dependency aren't included.
+        '''
+        def load_existing(deps):
+            parallel_map(lambda d: d.load_package(),
+                         [d for d in deps if d.full_path.is_dir()],
+                         jobs=jobs)
+        graph = DependencyGraph.build(self, dev=dev, visit=load_existing,
+                                      strict=False)
+        lock = self.read_lock()
+        return parallel_map(lambda d: d.status(lock), list(graph), jobs=jobs)
+
+    def orphans(self, keep):
+        '''
+        Returns the paths of the Git checkouts in the dependencies directory
+        that aren't one of the dependency paths to `keep`, and don't contain
+        one of them.
+        '''
+        keep = set(str(p) for p in keep)
+        orphans = []
+        def walk(rel):
+            entries = sorted(os.scandir(str(self.deps_dir / rel)),
+                             key=lambda e: e.name)
+            for entry in entries:
+                if (entry.name.startswith('.')
+                        or not entry.is_dir(follow_symlinks=False)):
+                    continue # e.g. Puck's own files, like the stamps
+                path = (Path(rel) / entry.name).as_posix()
+                if path in keep:
+                    continue
+                elif any(k.startswith(path + '/') for k in keep):
+                    walk(path)
+                elif (Path(entry.path) / '.git').exists():
+                    orphans.append(Path(path))
+        if self.deps_dir.is_dir():
+            walk('')
+        return orphans
+
+    def prune(self, keep, archive=False, force=False, gc=False, jobs=1):
+        '''
+        Removes the checkouts in the dependencies directory that aren't
+        dependency paths to `keep`, or moves them into its `.puck-archive`
+        directory if `archive`. Checkouts with uncommitted changes to their
+        tracked files are skipped unless `force`. If `gc`, `git gc --auto` is
+        then run in up to `jobs` of the kept checkouts at once. Returns the
+        paths that were pruned.
+        '''
+        pruned = []
+        for path in self.orphans(keep):
+            full_path = self.deps_dir / path
+            if not force and self.call(['git', 'status', '--porcelain',
+                                        '--untracked-files=no'],
+                                       cwd=full_path, output=True).strip():
+                self.event('dirty-orphan', path=full_path)
+                continue
+            target = (self.deps_dir / self.__class__.ARCHIVE_DIR / path
+                      if archive else None)
+            if target:
+                if target.exists():
+                    shutil.rmtree(str(target))
+                target.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(str(full_path), str(target))
+            else:
+                shutil.rmtree(str(full_path))
+            self.event('prune-dependency', path=full_path, target=target)
+            pruned.append(path)
+        lock = self.read_lock()
+        if any(str(p) in lock for p in pruned):
+            dump_json(self.lock_path, {k: v for k, v in lock.items()
+                                            if Path(k) not in pruned})
+        if gc:
+            kept = [self.deps_dir / p for p in sorted(set(map(str, keep)))
+                    if (self.deps_dir / p / '.git').exists()]
+            parallel_map(lambda p: self.call(['git', 'gc', '--auto',
+                                              '--quiet'], cwd=p),
+                         kept, jobs=jobs)
+        return pruned
+
+    def execute(self, command, graph=None, check=False, env=None, root=True,
+                      dev=False, jobs=1, incremental=False, cache=None,
+                      paths=None, jobserver=None, timings=None):
+        '''
+        Executes the command for each dependency in the tree once, after it
+        has been executed for all of that dependency's own dependencies, and
+        then for this package if `root`. Up to `jobs` dependencies are
+        executed concurrently, those on the critical path predicted by
+        `timings` first. If `incremental`, packages whose stamp is unchanged
+        are skipped. Declared outputs are restored from `cache` instead of
+        executing the command when they're cached. If `paths` are given, only
+        the dependencies at those paths are executed.
+        '''
+        graph = graph or self.graph(dev=dev)
+        if jobserver:
+            env = jobserver.environ(env)
+        plan = graph.plan(env=env)
+        stamps = StampStore(self.deps_dir, command) if incremental else None
+        if not (command in self.outputs
+                or any(command in d.package.outputs for d in graph)):
+            cache = None
+        try:
+            costs = (timings.costs({p: d.package
+                                    for p, (d, _, _) in plan.items()},
+                                   command)
+                     if timings and jobs > 1 else None)
+            keys = execute_plan(plan, command, check=check, jobs=jobs,
+                                stamps=stamps, cache=cache, paths=paths,
+                                jobserver=jobserver, costs=costs)
+            key = (self.output_key(command, cache, env,
+                                   [keys.get(p) for p in graph.roots])
+                   if root and cache and command in self.outputs else None)
+            if root and stamps:
+                self.execute_stamped(command, stamps, '.',
+                                     [stamps.get(str(p)) for p in graph.roots],
+                                     check=check, env=env, cache=cache,
+                                     cache_key=key)
+            elif root:
+                self.execute_cached(command, cache, key, check=check,
+                                    env=env)
+        finally:
+            if stamps:
+                stamps.save()
+
+    def explain_schedule(self, command, timings, graph=None, root=True,
+                               dev=False, jobs=1, paths=None):
+        '''
+        Reports the critical path of executing the command, and how long
+        executing it would take with `jobs` and with other numbers of jobs,
+        as predicted from the `TimingStore`, without executing it.
+        '''
+        graph = graph or self.graph(dev=dev)
+        plan = graph.plan()
+        packages = {p: d.package for p, (d, _, _) in plan.items()
+                    if paths is None or p in paths}
+        requires = {p: r for p, (_, _, r) in plan.items()}
         if root:
-            self.execute_self(command, check=check, env=env)
+            # the root's command is executed after all the others
+            packages[None] = self
+            requires[None] = [p for p in packages if p is not None]
+        costs = timings.costs(packages, command)
+        critical = Scheduler(jobs).critical_path(packages, requires, costs)
+        length = sum(costs[k] for k in critical)
+
+        def predict(n):
+            return (n, round(Scheduler(n).predict(packages, requires, costs),
+                             3))
+        # double the jobs until they'd no longer make a difference
+        times = [predict(1)]
+        while (times[-1][0] < len(packages)
+               and not math.isclose(times[-1][1], round(length, 3))):
+            times.append(predict(times[-1][0] * 2))
+        if jobs not in dict(times):
+            times = sorted(times + [predict(jobs)])
+        self.event('schedule', command=command, jobs=jobs,
+                   path=[(packages[k], costs[k]) for k in critical],
+                   unknown=[p for p in packages.values()
+                            if timings.estimate(p, command) is None],
+                   times=times)
 
     def execute_self(self, command, check=False, env=None):
         if command in self.commands.keys():
             self.event('execute', package=self, command=command)
             c = self.commands[command]
-            self.call(c, shell=True, cwd=self.path, check=check, env=env)
+            failed = True
+            try:
+                result = self.call(c, shell=True, cwd=self.path, check=check,
+                                   env=env)
+                failed = bool(result)
+                return result
+            finally:
+                self.event('execute-end', package=self, command=command,
+                           failed=failed)
         else:
             self.event('no-command-handler', package=self, command=command)
 
+    def execute_stamped(self, command, stamps, key, inputs, check=False,
+                              env=None, cache=None, cache_key=None):
+        '''
+        Executes the command unless this package's stamp is the one recorded
+        under `key` in `stamps`, and records the new stamp if it succeeds.
+        '''
+        def stamp():
+            return stamps.stamp(self.tree_state(), self.commands.get(command),
+                                os.environ if env is None else env, inputs)
+        before = stamp()
+        if before is not None and before == stamps.get(key):
+            self.event('up-to-date', package=self, command=command)
+            return
+        stamps.set(key, None)
+        result = self.execute_cached(command, cache, cache_key, check=check,
+                                     env=env)
+        if not result:
+            stamps.set(key, stamp())
+        return result
+
+    def execute_cached(self, command, cache, key, check=False, env=None):
+        '''
+        Restores this package's declared outputs for the command from the
+        cache if they're stored under `key`. Otherwise, executes the command,
+        and stores its outputs under `key` if it succeeds.
+        '''
+        cached = key and cache and command in self.outputs
+        if cached and cache.restore(key, self.path):
+            self.event('restore-outputs', package=self, command=command)
+            return
+        result = self.execute_self(command, check=check, env=env)
+        if cached and not result and command in self.commands:
+            cache.store(key, self.path, self.outputs[command])
+        return result
+
+    def output_key(self, command, cache, env, inputs):
+        '''
+        Returns the key of this package's outputs for the command in the
+        cache, or `None` if they can't be cached because this package or one
+        of its dependencies has uncommitted changes to tracked files.
+        '''
+        if None in inputs:
+            return None
+        try:
+            head = self.call(['git', 'rev-parse', 'HEAD'], cwd=self.path,
+                             output=True, stderr=DEVNULL).strip()
+            status = self.call(['git', 'status', '--porcelain',
+                                '--untracked-files=no', '--', '.']
+                               + self.exclude_deps_pathspec(),
+                               cwd=self.path, output=True, stderr=DEVNULL)
+        except CalledProcessError:
+            return None
+        if status:
+            return None
+        return cache.key(head, self.commands.get(command),
+                         self.outputs.get(command),
+                         os.environ if env is None else env, inputs,
+                         sparse=self.sparse)
+
+    def tree_state(self):
+        '''
+        Returns the checked-out commit and a digest of the status, size and
+        modification time of every modified or untracked file, followed by
+        the directories of a sparse checkout, or `None` if this package isn't
+        in a Git working tree.
+        '''
+        try:
+            top, head = self.call(['git', 'rev-parse', '--show-toplevel',
+                                   'HEAD'],
+                                  cwd=self.path, output=True,
+                                  stderr=DEVNULL).splitlines()
+            status = self.call(['git', 'status', '--porcelain', '-z',
+                                '--no-renames', '--untracked-files=all',
+                                '--', '.'] + self.exclude_deps_pathspec(),
+                               cwd=self.path, output=True, stderr=DEVNULL)
+        except CalledProcessError:
+            return None
+        digest = hashlib.sha1(status.encode())
+        for entry in filter(None, status.split('\0')):
+            path = Path(top, entry[3:])
+            if path.is_file():
+                st = path.stat()
+                digest.update('{} {}'.format(st.st_mtime_ns, st.st_size)
+                                .encode())
+        return [head, digest.hexdigest()] + ([self.sparse] if self.sparse
+                                             else [])
+
+    def exclude_deps_pathspec(self):
+        try:
+            deps_dir = self.deps_dir.relative_to(self.path)
+        except ValueError:
+            return []
+        return [':(exclude){}'.format(deps_dir)]
+
+
+# the revision a dependency is planned to be checked out to (or `None` if
+# no tag matched), its commit, whether the upstream branch is merged after
+# checking it out, and the commit that was checked out when it was planned
+Target = namedtuple('Target', ['rev', 'commit', 'merge', 'head'])
+
 
 class Dependency:
 
@@ -121,25 +528,47 @@ class Dependency:
     '''
 
     def __init__(self, deps_dir, repo, path=None, ref=None, tag=None,
-                       dev=False, env=None, commands=None, observers=None,
-                       caller=None):
+                       dev=False, env=None, commands=None, outputs=None,
+                       clone=None, sparse=None, observers=None, caller=None,
+                       mirrors=None, manifests=None, backend=None,
+                       url_stats=None, retry=None):
         self.deps_dir  = deps_dir
         self.caller    = caller or default_caller
+        self.mirrors   = mirrors
+        self.manifests = manifests
+        self.backend   = backend
+        self.url_stats = url_stats
+        self.retry     = retry
         self.repo      = Repo.from_json_value(repo, observers=observers,
-                                              caller=self.caller)
+                                              caller=self.caller,
+                                              mirrors=mirrors,
+                                              backend=backend,
+                                              url_stats=url_stats,
+                                              retry=retry)
         self.path      = Path(path or derive_path(self.repo.urls[0]))
         self.ref       = ref    # e.g. a commit, branch, or tag
         self.tag       = tag    # tag pattern like 'v3.*'
         self.dev       = dev
         self.env       = env or dict()
         self.commands  = commands or dict()
+        self.outputs   = outputs or dict()
+        self.clone     = clone  # e.g. {"depth": 1, "filter": "blob:none"}
+        self.sparse    = (sorted(set(p.strip('/') for p in sparse))
+                          if sparse else None)  # e.g. ["lib", "tools/gen"]
         self.observers = observers or list()
+        self.spec      = None   # the JSON value it was declared with
         self.package   = None
+        self.target    = None   # the `Target` chosen by the last plan
+        self.commit    = None   # the commit checked out by the last update
 
     @property
     def full_path(self):
         return self.deps_dir / self.path
 
+    @property
+    def staging_path(self):
+        return self.deps_dir / Package.STAGING_DIR / self.path
+
     def __str__(self):
         return '{}(path={})'.format(self.__class__.__name__, str(self.path))
 
@@ -154,57 +583,444 @@ class Dependency:
             and self.tag      == other.tag
             and (self.tag or (self.ref == other.ref))
             and self.env      == other.env
-            and self.commands == other.commands)
-
-    def path_done(self, deps):
-        for d in deps:
-            if d.path == self.path:
-                if not self.same(d):
-                    self.event('dependency-conflict', path=self.path)
-                    raise DependencyConflictError()
-                return True
-        return False
+            and self.commands == other.commands
+            and self.sparse   == other.sparse)
 
     def load_package(self, force=False):
         if (not self.package) or force:
             if not self.full_path.exists():
                 self.event('missing-dependency', dependency=self)
                 raise MissingDependencyError()
-            self.package = Package.from_path(self.full_path,
-                                             deps_dir     = self.deps_dir,
-                                             require_json = False,
-                                             observers    = self.observers)
-            self.package.commands.update(self.commands)
-
-    def update_repo(self, verify=True):
-        self.repo.get_latest(self.full_path)
+            self.set_package(Package.from_path(self.full_path,
+                                               require_json=False,
+                                               **self.package_kwargs()))
+
+    def package_kwargs(self):
+        return dict(deps_dir  = self.deps_dir,
+                    observers = self.observers,
+                    caller    = self.caller,
+                    mirrors   = self.mirrors,
+                    manifests = self.manifests,
+                    backend   = self.backend,
+                    url_stats = self.url_stats,
+                    retry     = self.retry)
+
+    def set_package(self, package):
+        self.package = package
+        self.package.commands.update(self.commands)
+        self.package.outputs.update(self.outputs)
+        self.package.sparse = self.sparse
+
+    def lock_entry(self):
+        entry = {'repo': self.repo.url, 'commit': self.commit}
         if self.tag:
-            self.repo.checkout_tag(self.full_path, self.tag, verify=verify)
+            entry['tag'] = self.tag
+        if self.ref:
+            entry['ref'] = self.ref
+        return entry
+
+    def locked(self, lock):
+        '''
+        Returns the commit recorded for this dependency's path in `lock`,
+        provided the entry was locked with this dependency's configuration,
+        or else `None`.
+        '''
+        entry = lock.get(str(self.path))
+        if not (entry
+                and entry.get('repo') in self.repo.urls
+                and entry.get('tag') == self.tag
+                and entry.get('ref') == self.ref):
+            return None
+        return entry.get('commit')
+
+    def locked_commit(self, lock):
+        commit = self.locked(lock)
+        if not commit:
+            self.event('stale-lock', dependency=self)
+            raise StaleLockError()
+        return commit
+
+    def status(self, lock):
+        '''
+        Returns the `DependencyStatus` of this dependency's checkout from one
+        `git status`, and one more Git call to find the commit of its tag or
+        reference, if it has one.
+        '''
+        path = self.full_path
+        if not (path / '.git').exists():
+            return DependencyStatus(self.path, path, None, None, None, 0, 0,
+                                    None, None)
+        if self.tag:
+            tag = self.repo.tag_index(path).latest(self.tag)
+            target = (tag.name, tag.commit) if tag else None
         elif self.ref:
-            self.repo.checkout(self.full_path, self.ref)
+            target = (self.ref, self.repo.checkout_commit(path, self.ref))
         else:
-            self.repo.checkout(self.full_path, 'master')
-            self.repo.call(['git', 'pull'], cwd=self.full_path)
+            target = None   # the upstream branch is checked out
+        return DependencyStatus(self.path, path,
+                                *self.repo.backend.status(path),
+                                locked=self.locked(lock), target=target)
 
-    def update(self, updated, verify=True):
-        if self.path_done(updated):
-            return
+    def fetch_repo(self, path, commit=None, clone=None):
+        '''
+        Clones this dependency's repository to the given path without a
+        working tree, or fetches only what's needed to check out its target
+        into the existing clone, if anything.
+        '''
+        if not path.is_dir():
+            self.repo.get_latest(path, clone=clone, checkout=False)
+        elif commit or is_commit_id(self.ref):
+            if not self.repo.has_commit(path, commit or self.ref):
+                self.repo.get_latest(path, clone=clone)
+        elif self.tag:
+            # clones with truncated history fetch the chosen tag later
+            if not self.repo.truncated(clone):
+                self.repo.get_latest(path, clone=clone,
+                                     refspecs=[tag_refspec(self.tag)])
+        elif self.ref:
+            # tags don't move, so one that's present is up to date
+            if not self.repo.has_tag(path, self.ref):
+                self.repo.get_latest(path, clone=clone,
+                                     refspecs=[branch_refspec(self.ref)])
+        else:
+            self.repo.get_latest(path, clone=clone,
+                                 refspecs=[branch_refspec('master')])
+
+    def resolve_target(self, path, verify=True, commit=None, clone=None):
+        if commit:
+            rev = self.repo.fetch_ref(path, commit, clone=clone)
+        elif self.tag:
+            rev = self.repo.resolve_tag(path, self.tag, verify=verify,
+                                        clone=clone)
+        elif self.ref:
+            rev = self.repo.fetch_ref(path, self.ref, clone=clone)
+        else:
+            return Target('master',
+                          self.repo.checkout_commit(path, 'origin/master'),
+                          True, None)
+        return Target(rev, (self.repo.checkout_commit(path, rev) if rev
+                            else self.repo.rev_parse(path)), False, None)
+
+    def plan_self(self, verify=True, commit=None, shallow=False,
+                        journal=None):
+        '''
+        Fetches this dependency's target without changing its working tree,
+        and chooses the commit to check out, reading its package from the
+        `Package.json` at that commit. A dependency without a clone yet is
+        cloned without a working tree into the staging directory. If the
+        `UpdateJournal` has a target for this dependency with the same
+        specification, and the clone still has it, it's chosen without
+        fetching; otherwise, the chosen target is recorded in the journal.
+        '''
+        self.event('plan', dependency=self)
+        failed = True
+        try:
+            exists = self.full_path.is_dir()
+            path = self.full_path if exists else self.staging_path
+            clone = self.clone or ({'depth': 1} if shallow else None)
+            spec = json_digest([self.repo.urls, self.tag, self.ref, commit,
+                                clone, verify])
+            target = (self.journaled_target(path, journal, spec)
+                      if journal else None)
+            resumed = target is not None
+            if not resumed:
+                self.fetch_repo(path, commit=commit, clone=clone)
+                target = self.resolve_target(path, verify=verify,
+                                             commit=commit, clone=clone)
+            if target.rev and not target.commit:
+                self.event('unresolved-ref', dependency=self, rev=target.rev)
+                raise UnresolvedRefError()
+            self.target = target._replace(
+                head=self.repo.rev_parse(path) if exists else None)
+            manifest = self.repo.read_file(path, target.commit or 'HEAD',
+                                           Package.JSON_PATH)
+            if journal and not resumed:
+                journal.record(self.path, spec, target, manifest)
+            self.set_package(Package.from_json_value(
+                path, json.loads(manifest) if manifest else dict(),
+                **self.package_kwargs()))
+            failed = False
+        finally:
+            self.event('plan-end', dependency=self, failed=failed)
+
+    def journaled_target(self, path, journal, spec):
+        '''
+        Returns the target recorded in the journal for this dependency with
+        the given specification, or `None` if there isn't one, or the clone at
+        the given path doesn't have it as it was recorded.
+        '''
+        saved = journal.get(self.path, spec)
+        if saved is None:
+            return None
+        target = Target(*saved.target)
+        if not (target.commit and path.is_dir()
+                and self.repo.has_commit(path, target.commit)
+                and json_digest(self.repo.read_file(path, target.commit,
+                                                    Package.JSON_PATH))
+                    == saved.manifest):
+            return None
+        self.event('resume-dependency', dependency=self, target=target)
+        return target
+
+    def checkout_self(self):
+        '''
+        Checks this dependency out to the target chosen by `plan_self`,
+        first moving its clone into place if it was staged.
+        '''
         self.event('update', dependency=self)
-        self.update_repo(verify=verify)
-        self.load_package(force=True)
-        updated.append(self)
-        self.package.update(updated=updated, verify=verify)
+        failed = True
+        try:
+            staged = not self.full_path.is_dir()
+            if staged:
+                self.full_path.parent.mkdir(parents=True, exist_ok=True)
+                self.staging_path.rename(self.full_path)
+                self.repo.invalidate(self.staging_path)
+            self.repo.sparse_checkout(self.full_path, self.sparse)
+            # a staged clone has an empty working tree, so nothing is lost
+            # by forcing its checkout
+            rev = self.target.rev or ('HEAD' if staged else None)
+            if rev:
+                self.repo.checkout(self.full_path, rev, force=staged)
+            if self.target.merge:
+                self.repo.merge_upstream(self.full_path)
+            self.commit = self.repo.rev_parse(self.full_path)
+            self.load_package(force=True)
+            failed = False
+        finally:
+            self.event('update-end', dependency=self, failed=failed)
 
-    def execute(self, command, executed, check=False, env=None):
-        if self.path_done(executed):
-            return
-        self.load_package()
-        executed.append(self)
-        self.package.execute(command,
-                       executed=executed,
-                       check=check,
-                       env=ChainMap({'DEPS_DIR': str(self.deps_dir.resolve())},
-                                    self.env,
-                                    env or dict()))
+    def execute_env(self, env=None):
+        return ChainMap({'DEPS_DIR': str(self.deps_dir.resolve())},
+                        self.env,
+                        env or dict())
+
+    def execute_self(self, command, check=False, env=None, stamps=None,
+                           inputs=(), cache=None, keys=()):
+        '''
+        Executes the command for this dependency's package, and returns the
+        key of its outputs in the cache, or `None` if the command failed.
+        '''
+        key = (self.package.output_key(command, cache, env, keys)
+               if cache else None)
+        if stamps is None:
+            result = self.package.execute_cached(command, cache, key,
+                                                 check=check, env=env)
+        else:
+            result = self.package.execute_stamped(command, stamps,
+                                                  str(self.path), inputs,
+                                                  check=check, env=env,
+                                                  cache=cache, cache_key=key)
+        return None if result else key
+
+
+class DependencyGraph:
+
+    '''
+    The resolved dependency tree of a root package, built once per
+    invocation. It maps each dependency path to the dependency at that path
+    and to the paths of that dependency's own dependencies, and records the
+    paths that are only required by the root's development dependencies and
+    any conflicts that were found while building it.
+    '''
+
+    @classmethod
+    def build(cls, package, dev=False, visit=None, strict=True):
+        '''
+        Builds the graph of the given root package breadth-first. The new
+        dependencies of each level are passed to `visit` (which loads their
+        packages by default) before their own dependencies are added. Unless
+        `strict`, conflicts are only recorded, and the graph is built from
+        the first of the conflicting dependencies.
+        '''
+        graph = cls()
+        level = package.selected_deps(dev=dev)
+        graph.roots = unique(d.path for d in level)
+        while level:
+            fresh = [d for d in level if graph.add(d, strict=strict)]
+            if visit:
+                visit(fresh)
+            else:
+                for d in fresh:
+                    d.load_package()
+            # a dependency that `visit` leaves without a package, e.g.
+            # because it's missing, has no dependencies of its own
+            for d in fresh:
+                graph.edges[d.path] = (unique(c.path for c in
+                                              d.package.selected_deps())
+                                       if d.package else [])
+            level = [c for d in fresh if d.package
+                       for c in d.package.selected_deps()]
+        graph.dev = graph.nodes.keys() - graph.reachable(
+                        unique(d.path for d in package.selected_deps(dev=dev)
+                               if not d.dev))
+        return graph
+
+    @classmethod
+    def restore(cls, package, snapshot, manifests):
+        '''
+        Rebuilds the graph of the given root package from its snapshot (see
+        `to_snapshot`), with the packages of its dependencies read from the
+        manifests cached in the `ManifestCache`, without walking the tree.
+        '''
+        graph = cls()
+        graph.roots = [Path(p) for p in snapshot['roots']]
+        for spec in snapshot['nodes']:
+            dep = package.make_dependency(spec)
+            dep.set_package(Package.from_json_value(
+                dep.full_path,
+                manifests.cached(dep.full_path / Package.JSON_PATH),
+                **dep.package_kwargs()))
+            graph.nodes[dep.path] = dep
+        graph.edges = {Path(p): [Path(e) for e in es]
+                       for p, es in snapshot['edges']}
+        graph.dev = set(Path(p) for p in snapshot['dev'])
+        return graph
+
+    def __init__(self):
+        self.roots = []             # paths of the root's dependencies
+        self.nodes = dict()         # path -> Dependency
+        self.edges = dict()         # path -> [path]
+        self.dev = set()            # paths only required for development
+        self.conflicts = []         # (path, Dependency, Dependency)
+
+    def __str__(self):
+        return '{}(nodes={})'.format(self.__class__.__name__, len(self))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.nodes.values())
+
+    def __contains__(self, path):
+        return path in self.nodes
+
+    def __getitem__(self, path):
+        return self.nodes[path]
+
+    def add(self, dep, strict=True):
+        '''
+        Adds the given dependency if its path is new to the graph, returning
+        whether it was added. Records a conflict if a dependency with a
+        different configuration was already added at that path, and raises
+        a conflict error if `strict`.
+        '''
+        existing = self.nodes.get(dep.path)
+        if existing is None:
+            self.nodes[dep.path] = dep
+            return True
+        if not dep.same(existing):
+            self.conflicts.append((dep.path, existing, dep))
+            dep.event('dependency-conflict', path=dep.path)
+            if strict:
+                raise DependencyConflictError()
+        return False
+
+    def to_snapshot(self):
+        '''
+        Returns a JSON value from which `restore` can rebuild this graph:
+        its roots, the declaration of each dependency, its edges and its
+        development dependencies.
+        '''
+        return {'roots': [str(p) for p in self.roots],
+                'nodes': [d.spec for d in self],
+                'edges': [[str(p), [str(e) for e in es]]
+                          for p, es in self.edges.items()],
+                'dev': sorted(str(p) for p in self.dev)}
+
+    def reachable(self, paths):
+        seen = set(paths)
+        queue = list(seen)
+        while queue:
+            for p in self.edges.get(queue.pop(), ()):
+                if p not in seen:
+                    seen.add(p)
+                    queue.append(p)
+        return seen
+
+    def plan(self, env=None):
+        '''
+        Returns an ordered mapping of each path in depth-first post-order to
+        its dependency, the environment to execute it with, and the paths
+        that must be executed before it. Each dependency's environment
+        extends that of its parent in the depth-first traversal.
+        '''
+        plan = dict()
+        seen = set()
+        def enter(path, parent_env):
+            seen.add(path)
+            return (path, self.nodes[path].execute_env(parent_env),
+                    iter(self.edges[path]))
+        for root in self.roots:
+            if root in seen:
+                continue
+            stack = [enter(root, env)]
+            while stack:
+                path, path_env, children = stack[-1]
+                for child in children:
+                    if child not in seen:
+                        stack.append(enter(child, path_env))
+                        break
+                else:
+                    stack.pop()
+                    # dependencies that are still on the stack are ancestors
+                    # in a cycle, which are executed afterwards
+                    plan[path] = (self.nodes[path], path_env,
+                                  [p for p in self.edges[path] if p in plan])
+        return plan
+
+    def to_json(self):
+        return {
+            'roots': [str(p) for p in self.roots],
+            'nodes': {str(p): {'repo': d.repo.urls,
+                               'tag': d.tag,
+                               'ref': d.ref,
+                               'dev': p in self.dev,
+                               'dependencies': [str(e) for e in
+                                                self.edges[p]]}
+                      for p, d in self.nodes.items()}
+        }
+
+    def to_dot(self, name='root'):
+        lines = ['digraph dependencies {',
+                 '    {} [shape=box];'.format(json.dumps(name))]
+        lines.extend('    {}{};'.format(json.dumps(str(p)),
+                                        ' [style=dashed]' if p in self.dev
+                                        else '')
+                     for p in self.nodes)
+        lines.extend('    {} -> {};'.format(json.dumps(name),
+                                            json.dumps(str(p)))
+                     for p in self.roots)
+        lines.extend('    {} -> {};'.format(json.dumps(str(p)),
+                                            json.dumps(str(e)))
+                     for p, es in self.edges.items() for e in es)
+        lines.append('}')
+        return '\n'.join(lines)
+
+
+def unique(xs):
+    return list(dict.fromkeys(xs))
+
+
+def execute_plan(plan, command, check=False, jobs=1, stamps=None,
+                 cache=None, paths=None, jobserver=None, costs=None):
+    '''
+    Executes the plan of a `DependencyGraph`, or only its given `paths`,
+    returning the key of each executed path's outputs in the cache. The
+    predicted `costs` of the paths, if given, guide the order they're
+    executed in.
+    '''
+    keys = dict()
+    def execute(path):
+        dep, env, requires = plan[path]
+        keys[path] = dep.execute_self(
+            command, check=check, env=env, stamps=stamps,
+            inputs=[stamps.get(str(p)) for p in requires] if stamps else (),
+            cache=cache, keys=[keys.get(p) for p in requires])
+    Scheduler(jobs, jobserver=jobserver).run(
+        (p for p in plan if paths is None or p in paths),
+        {path: requires for path, (_, _, requires) in plan.items()},
+        execute, costs=costs)
+    return keys
 
 
@@ -18,12 +18,100 @@
 
 
 import os
-from subprocess import check_call, check_output, CalledProcessError
+import re
+import time
+import shutil
+from fnmatch import fnmatchcase
+from collections import namedtuple
+from subprocess import CalledProcessError, TimeoutExpired
 
-from .util import default_caller, call_method
+from .util import default_caller, call_method, absolute_url, version_key
+from .backend import SubprocessBackend
 from .errors import RepoVerificationError, FailedRepoCloneError
 
 
+COMMIT_ID_REGEX = re.compile(r'[0-9a-f]{40}|[0-9a-f]{64}')
+
+def is_commit_id(s):
+    return bool(s and COMMIT_ID_REGEX.fullmatch(s))
+
+
+def branch_refspec(branch):
+    return '+refs/heads/{0}:refs/remotes/origin/{0}'.format(branch)
+
+
+def tag_refspec(pattern):
+    '''
+    Returns a refspec fetching the tags matching the given pattern, or all
+    tags if the pattern can't be expressed as a refspec.
+    '''
+    if pattern.count('*') > 1 or any(c in pattern for c in '?[\\'):
+        pattern = '*'
+    return 'refs/tags/{0}:refs/tags/{0}'.format(pattern)
+
+
+Tag = namedtuple('Tag', ['name', 'object', 'commit'])
+
+
+# how many times a failed network operation is retried, the seconds to wait
+# before the first retry (doubling for each one after it), and the seconds
+# that each Git subprocess talking to a remote may take, if limited
+RetryPolicy = namedtuple('RetryPolicy', ['retries', 'delay', 'timeout'])
+
+NO_RETRY = RetryPolicy(0, 0, None)
+RETRY_DELAY = 1
+TIMEOUT = 600
+
+# what Git and curl report when the network or the remote fails in a way that
+# may not happen again
+TRANSIENT_ERROR_REGEX = re.compile(
+    r'could not resolve host|temporary failure in name resolution'
+    r'|connection (?:timed out|reset|refused)|operation timed out'
+    r'|network is unreachable|early eof|hung up unexpectedly'
+    r'|unexpected disconnect|rpc failed|returned error: 5\d\d'
+    r'|gnutls_handshake|ssl_(?:connect|read)|transfer closed',
+    re.IGNORECASE)
+
+def is_transient(error):
+    '''
+    Returns whether the given error from a Git subprocess may go away by
+    trying again: a timeout, or a network failure according to the error
+    output it was raised with.
+    '''
+    if isinstance(error, TimeoutExpired):
+        return True
+    return bool(isinstance(error, CalledProcessError) and error.stderr
+                and TRANSIENT_ERROR_REGEX.search(error.stderr))
+
+
+class TagIndex:
+
+    '''
+    The tags of a clone, with the IDs of their tag objects and of the
+    commits they point to, sorted from the lowest to the highest version.
+    '''
+
+    def __init__(self, tags):
+        self.tags = sorted(tags, key=lambda t: version_key(t.name))
+        self.by_name = {t.name: t for t in self.tags}
+
+    def __str__(self):
+        return '{}(tags={})'.format(self.__class__.__name__, len(self.tags))
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def get(self, name):
+        return self.by_name.get(name)
+
+    def matching(self, pattern):
+        return [t for t in self.tags if fnmatchcase(t.name, pattern)]
+
+    def latest(self, pattern):
+        tags = self.matching(pattern)
+        return tags[-1] if tags else None
+
+
 class Repo:
 
     @classmethod
@@ -33,10 +121,17 @@ class Repo:
         else:
             return cls(urls=[jv], **kwargs)
 
-    def __init__(self, urls, observers=None, caller=None):
+    def __init__(self, urls, observers=None, caller=None, mirrors=None,
+                 backend=None, url_stats=None, retry=None):
         self.urls = [os.path.expanduser(url) for url in urls]
         self.observers = observers or list()
         self.caller = caller or default_caller
+        self.mirrors = mirrors
+        self.url_stats = url_stats
+        self.retry = retry or NO_RETRY
+        self.backend = backend or SubprocessBackend(observers=self.observers,
+                                                    caller=self.caller)
+        self.tag_indexes = dict()   # str(path) -> TagIndex
 
     @property
     def url(self):
@@ -48,42 +143,284 @@ class Repo:
 
     call = call_method
 
-    def get_latest(self, path):
-        cloned = False
-        for url in self.urls:
+    def retrying(self, path, f):
+        '''
+        Returns the result of `f()`, calling it again after a delay that
+        doubles each time while it times out or fails because of the network,
+        up to the retry policy's number of retries. Other failures, like a
+        missing reference or a rejected login, won't go away by retrying, so
+        they're raised at once.
+        '''
+        delay = self.retry.delay
+        for attempt in range(self.retry.retries):
             try:
-                if path.is_dir():
-                    self.call(['git', 'fetch'], cwd=path)
-                else:
-                    self.call(['git', 'clone', url, str(path)], cwd='.')
-            except CalledProcessError:
-                continue # try another URL
-            cloned = True
-            break # stop trying to clone from URLS
-        if not cloned:
+                return f()
+            except (CalledProcessError, TimeoutExpired) as e:
+                if not is_transient(e):
+                    raise
+                self.event('retry', path=path, attempt=attempt + 1,
+                           retries=self.retry.retries, delay=delay)
+                time.sleep(delay)
+                delay *= 2
+        return f()
+
+    def truncated(self, clone):
+        '''
+        Returns whether clones made with the given options may be missing
+        some of the repository's history and tags.
+        '''
+        return bool(clone and not self.mirrors
+                          and (clone.get('depth')
+                               or clone.get('single-branch')))
+
+    def clone_args(self, clone):
+        args = []
+        if clone and clone.get('depth'):
+            args += ['--depth', str(clone['depth'])]
+        if clone and clone.get('filter'):
+            args += ['--filter=' + clone['filter']]
+        if clone and clone.get('single-branch'):
+            args += ['--single-branch']
+        return args
+
+    def is_shallow(self, path):
+        return (path / '.git' / 'shallow').exists()
+
+    def is_sparse(self, path):
+        # the file is kept after a sparse checkout is disabled
+        return (path / '.git' / 'info' / 'sparse-checkout').exists()
+
+    def sparse_checkout(self, path, dirs):
+        '''
+        Restricts the clone's working tree to the given directories (and the
+        files at its top level), or restores the whole working tree if there
+        are none, unless it's already checked out that way.
+        '''
+        if not self.is_sparse(path):
+            if dirs:
+                self.backend.sparse_checkout(path, dirs)
+        elif self.backend.list_sparse_checkout(path) != (dirs or None):
+            self.backend.sparse_checkout(path, dirs)
+
+    def fetch_args(self, path, clone):
+        # keep the history of shallow clones truncated to the same depth
+        if clone and clone.get('depth') and self.is_shallow(path):
+            return ['--depth', str(clone['depth'])]
+        return []
+
+    def failover(self, path, f):
+        '''
+        Returns `f(url)` for the first of the repository's URLs for which it
+        doesn't fail with a Git error or time out, trying the fastest healthy
+        URL according to `url_stats` first. If every URL fails and any of
+        them timed out or failed because of the network, they're all tried
+        again according to the retry policy; otherwise, the last URL's error
+        is raised. Each URL that
+        failed is recorded in `url_stats` once, however many times it was
+        tried.
+        '''
+        urls = [absolute_url(url) for url in self.urls]
+        if self.url_stats:
+            urls = self.url_stats.order(urls)
+        failed = set()
+        def attempt():
+            error = transient = None
+            for url in urls:
+                try:
+                    return url, f(url)
+                except (CalledProcessError, TimeoutExpired) as e:
+                    error = e
+                    if is_transient(e):
+                        transient = e
+                failed.add(url)
+                # try another URL
+            raise transient or error
+        fetched = None
+        try:
+            fetched, result = self.retrying(path, attempt)
+            return result
+        finally:
+            if self.url_stats:
+                for url in urls:
+                    if url in failed and url != fetched:
+                        self.url_stats.record(url, failed=True)
+                if fetched and len(urls) > 1:
+                    self.url_stats.record(fetched)
+
+    def get_latest(self, path, clone=None, refspecs=None, checkout=True):
+        '''
+        Clones the repository to the given path, or fetches into it if it
+        already exists, failing over between its URLs. The `clone` options
+        of a dependency, if any, can make the clone shallow (`depth`),
+        partial (`filter`) or `single-branch`; they're ignored when cloning
+        from a mirror, which is already local. If `refspecs` are given, only
+        those are fetched into an existing clone, unless the remote doesn't
+        have them. If not `checkout`, a new clone's working tree is left
+        empty.
+        '''
+        self.invalidate(path)
+        existed = path.is_dir()
+        def get_latest_from(url):
+            if not existed and path.is_dir():
+                # e.g. a clone that timed out
+                shutil.rmtree(str(path))
+            self.get_latest_from(path, url, clone=clone, refspecs=refspecs,
+                                 checkout=checkout)
+        try:
+            self.failover(path, get_latest_from)
+        except (CalledProcessError, TimeoutExpired):
             raise FailedRepoCloneError()
 
+    def get_latest_from(self, path, url, clone=None, refspecs=None,
+                              checkout=True):
+        # Local clones hard-link the mirror's objects rather than borrowing
+        # them through alternates, so evicting a mirror can't break a
+        # checkout that was made from it.
+        source = str(self.mirrors.update(url)) if self.mirrors else url
+        args = [] if checkout else ['--no-checkout']
+        if path.is_dir():
+            self.fetch(path, source, clone=clone, refspecs=refspecs)
+        elif self.mirrors:
+            self.backend.clone(source, path, args=args)
+            self.backend.set_remote_url(path, 'origin', url)
+        else:
+            self.backend.clone(source, path,
+                               args=self.clone_args(clone) + args,
+                               timeout=self.retry.timeout)
+
+    def fetch(self, path, source, clone=None, refspecs=None):
+        args = self.fetch_args(path, clone)
+        timeout = self.retry.timeout
+        if refspecs:
+            try:
+                self.backend.fetch(path, source, refspecs, args=args,
+                                   quiet=True, timeout=timeout)
+                return
+            except CalledProcessError:
+                pass # e.g. a reference that isn't a branch, so fetch it all
+        self.backend.fetch(path, source,
+                           ['+refs/heads/*:refs/remotes/origin/*'],
+                           args=args + ['--tags'], timeout=timeout)
+
+    def merge_upstream(self, path):
+        # like `git pull`, but the upstream branch was already fetched
+        self.invalidate(path)
+        self.backend.merge(path, '@{upstream}')
+
+    def tag_index(self, path):
+        '''
+        Returns the index of the clone's tags, listing them through the
+        backend the first time it's needed after the refs last changed.
+        '''
+        index = self.tag_indexes.get(str(path))
+        if index is None:
+            index = TagIndex(Tag(*t) for t in self.backend.list_tags(path))
+            self.tag_indexes[str(path)] = index
+        return index
+
+    def invalidate(self, path):
+        self.tag_indexes.pop(str(path), None)
+        self.backend.invalidate(path)
+
+    def has_tag(self, path, tag):
+        return tag in self.tag_index(path)
+
     def tag_list(self, path, pattern):
-        return self.call(['git', 'tag', '--list', pattern], cwd=path,
-                         output=True).splitlines()
+        return [t.name for t in self.tag_index(path).matching(pattern)]
 
     def tag_verify(self, path, tag):
         try:
-            self.call(['git', 'tag', '--verify', tag], cwd=path)
+            self.backend.verify_tag(path, tag)
         except CalledProcessError:
             raise RepoVerificationError()
 
-    def checkout_tag(self, path, pattern, verify=True):
-        tags = self.tag_list(path, pattern)
-        if tags:
-            tag = max(tags)
-            if verify:
-                self.tag_verify(path, tag)
-            self.checkout(path, tag)
+    def remote_tag_list(self, path, pattern):
+        tags = self.failover(path, lambda url: self.backend.list_remote_tags(
+                                 path, url, timeout=self.retry.timeout))
+        return sorted((t for t in tags if fnmatchcase(t, pattern)),
+                      key=version_key)
+
+    def fetch_tag(self, path, tag, clone=None):
+        self.invalidate(path)
+        self.failover(path, lambda url: self.backend.fetch(
+                                path, url, ['tag', tag],
+                                args=self.fetch_args(path, clone),
+                                timeout=self.retry.timeout))
+
+    def resolve_tag(self, path, pattern, verify=True, clone=None):
+        '''
+        Returns the highest tag matching the given pattern, or `None` if there
+        isn't one. Clones with truncated history list the remote's tags
+        instead, and fetch the chosen tag if they don't have it yet.
+        '''
+        if self.truncated(clone):
+            tags = self.remote_tag_list(path, pattern)
         else:
+            tags = self.tag_list(path, pattern)
+        if not tags:
             self.event('no-matching-tags', path=path, pattern=pattern)
+            return None
+        tag = tags[-1]
+        if self.truncated(clone) and not self.has_tag(path, tag):
+            self.fetch_tag(path, tag, clone=clone)
+        if verify:
+            self.tag_verify(path, tag)
+        return tag
+
+    def checkout(self, path, s, force=False):
+        self.backend.checkout(path, s, force=force)
+
+    def fetch_ref(self, path, ref, clone=None):
+        '''
+        Returns the revision to check out for the given reference. If a clone
+        with truncated history has neither it nor a branch of that name
+        fetched from `origin`, it's fetched first (a branch into its
+        remote-tracking ref, which `origin` is then set to track), failing
+        over between the repository's URLs. Each URL falls back to fetching
+        the whole history if it won't serve the reference directly (e.g. a
+        commit that isn't at the tip of a branch).
+        '''
+        if not (self.truncated(clone)
+                and not self.checkout_commit(path, ref)):
+            return ref
+        self.invalidate(path)
+        timeout = self.retry.timeout
+        def fetch_from(url):
+            try:
+                if is_commit_id(ref):
+                    self.backend.fetch(path, url, [ref],
+                                       args=self.fetch_args(path, clone),
+                                       timeout=timeout)
+                else:
+                    self.backend.fetch(path, url, [branch_refspec(ref)],
+                                       args=self.fetch_args(path, clone),
+                                       quiet=True, timeout=timeout)
+                    self.backend.track_branch(path, 'origin', ref)
+            except CalledProcessError:
+                self.backend.fetch(
+                    path, url, ['+refs/heads/*:refs/remotes/origin/*'],
+                    args=(['--unshallow'] if self.is_shallow(path) else [])
+                         + ['--tags'],
+                    timeout=timeout)
+        self.failover(path, fetch_from)
+        return (ref if self.checkout_commit(path, ref)
+                else self.rev_parse(path, 'FETCH_HEAD'))
+
+    def rev_parse(self, path, rev='HEAD'):
+        return self.backend.resolve(path, rev)
+
+    def has_commit(self, path, commit):
+        return self.backend.resolve(path, commit) is not None
+
+    def checkout_commit(self, path, rev):
+        '''
+        Returns the commit that checking out the given revision would check
+        out, which may be a branch that's only been fetched from `origin`.
+        '''
+        return (self.backend.resolve(path, rev)
+                or self.backend.resolve(path, 'refs/remotes/origin/' + rev))
 
-    def checkout(self, path, s):
-        self.call(['git', 'checkout', s], cwd=path)
+    def read_file(self, path, rev, name):
+        return self.backend.read_file(path, rev, str(name))
 
 
@@ -0,0 +1,175 @@
+
+# Copyright 2014  Malcolm Inglis <http://minglis.id.au>
+#
+# This file is part of Puck.
+#
+# Puck is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Puck is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Puck. If not, see <https://gnu.org/licenses/>.
+
+
+import heapq
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Scheduler:
+
+    '''
+    Runs a set of jobs, each of which may require that other jobs in the set
+    are done before it starts, with up to `jobs` of them running at once.
+    Ready jobs are started in the order they were given, so with a single
+    worker they run in exactly that order. Given the predicted cost of each
+    job, several workers start the ready job with the costliest chain of
+    jobs depending on it first instead, so that the critical path isn't left
+    until the end. With a `Jobserver`, each job also holds one of its tokens
+    while it runs.
+    '''
+
+    def __init__(self, jobs=1, jobserver=None):
+        self.jobs = max(1, jobs)
+        self.jobserver = jobserver
+
+    def __str__(self):
+        return '{}(jobs={})'.format(self.__class__.__name__, self.jobs)
+
+    def graph(self, keys, requires):
+        '''
+        Returns the keys in the order they were given, the set of keys each
+        one waits for, and the list of keys waiting for each one.
+        '''
+        keys = list(keys)
+        known = set(keys)
+        waiting = {k: set(r for r in requires.get(k, ()) if r in known)
+                   for k in keys}
+        dependents = {k: [] for k in keys}
+        for k in keys:
+            for r in waiting[k]:
+                dependents[r].append(k)
+        return keys, waiting, dependents
+
+    def levels(self, keys, requires, costs):
+        '''
+        Returns, for each key, the predicted cost of its job and of the
+        costliest chain of jobs that depend on it, directly or not.
+        '''
+        keys, waiting, dependents = self.graph(keys, requires)
+        order = [k for k in keys if not waiting[k]]
+        for k in order:     # grows into a topological order
+            for d in dependents[k]:
+                waiting[d].discard(k)
+                if not waiting[d]:
+                    order.append(d)
+        levels = dict()
+        for k in reversed(order):
+            levels[k] = costs[k] + max((levels[d] for d in dependents[k]),
+                                       default=0)
+        return levels
+
+    def critical_path(self, keys, requires, costs):
+        '''
+        Returns the costliest chain of jobs, from one that requires no others
+        to one that no others require.
+        '''
+        keys, waiting, dependents = self.graph(keys, requires)
+        levels = self.levels(keys, requires, costs)
+        path = []
+        candidates = [k for k in keys if not waiting[k]]
+        while candidates:
+            k = max(candidates, key=lambda c: levels[c])
+            path.append(k)
+            candidates = dependents[k]
+        return path
+
+    def predict(self, keys, requires, costs):
+        '''
+        Returns how long running the jobs would take with this scheduler's
+        workers if each took exactly its predicted cost.
+        '''
+        keys, waiting, dependents = self.graph(keys, requires)
+        priority = self.priority(keys, requires, costs)
+        ready = [(priority[k], k) for k in keys if not waiting[k]]
+        heapq.heapify(ready)
+        running = []
+        now = 0
+        while ready or running:
+            while ready and len(running) < self.jobs:
+                p, k = heapq.heappop(ready)
+                heapq.heappush(running, (now + costs[k], p, k))
+            now, _, k = heapq.heappop(running)
+            for d in dependents[k]:
+                waiting[d].discard(k)
+                if not waiting[d]:
+                    heapq.heappush(ready, (priority[d], d))
+        return now
+
+    def priority(self, keys, requires, costs):
+        keys = list(keys)
+        levels = (self.levels(keys, requires, costs)
+                  if costs is not None and self.jobs > 1 else None)
+        return {k: (-levels[k] if levels else 0, i)
+                for i, k in enumerate(keys)}
+
+    def run(self, keys, requires, f, costs=None):
+        '''
+        Calls `f(key)` for each of `keys` once all of `requires[key]` are done,
+        preferring the critical path if the predicted `costs` of the keys are
+        given. If a call raises, no more jobs are started, the running ones
+        are waited for, and the exception is re-raised.
+        '''
+        keys, waiting, dependents = self.graph(keys, requires)
+        priority = self.priority(keys, requires, costs)
+        ready = [(priority[k], k) for k in keys if not waiting[k]]
+        heapq.heapify(ready)
+
+        if self.jobserver:
+            f = self.with_token(f)
+
+        def release(k):
+            for d in dependents[k]:
+                waiting[d].discard(k)
+                if not waiting[d]:
+                    heapq.heappush(ready, (priority[d], d))
+
+        if self.jobs == 1:
+            while ready:
+                _, k = heapq.heappop(ready)
+                f(k)
+                release(k)
+            return
+
+        error = None
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            running = dict()
+            while ready or running:
+                while ready and error is None and len(running) < self.jobs:
+                    _, k = heapq.heappop(ready)
+                    running[pool.submit(f, k)] = k
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    k = running.pop(future)
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                    else:
+                        release(k)
+        if error is not None:
+            raise error
+
+    def with_token(self, f):
+        def run(k):
+            token = self.jobserver.acquire()
+            try:
+                return f(k)
+            finally:
+                self.jobserver.release(token)
+        return run
@@ -0,0 +1,219 @@
+
+# Copyright 2014  Malcolm Inglis <http://minglis.id.au>
+#
+# This file is part of Puck.
+#
+# Puck is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Puck is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Puck. If not, see <https://gnu.org/licenses/>.
+
+
+import os
+import json
+import array
+import socket
+import traceback
+from pathlib import Path
+
+from .util import default_caller
+from .package import Package
+from .snapshot import ManifestCache
+from .backend import BACKENDS
+from .errors import ServerError
+
+
+class Server:
+
+    '''
+    A long-lived process serving the Puck invocations of one workspace over
+    a Unix socket in its dependencies directory, one at a time. Clients pass
+    their output files along with their arguments, so the output of an
+    invocation goes where it would have gone without the server. Between
+    invocations, the server keeps the parsed manifests, the Git backend and
+    the resolved dependency graph in memory; the graph is resolved again
+    once any of the manifests or checkouts it was resolved from changes.
+    '''
+
+    SOCKET_PATH = Path('.puck.sock')
+
+    @classmethod
+    def socket_path_for(cls, path):
+        return Path(path) / Package.DEPS_DIR / cls.SOCKET_PATH
+
+    def __init__(self, path, backend='subprocess', observers=None):
+        self.path = path
+        self.socket_path = self.__class__.socket_path_for(path)
+        self.own_observers = observers or list()
+        self.observers = list()     # those of the invocation being served
+        self.current_caller = default_caller
+        self.out_fd = self.err_fd = None
+        self.manifests = ManifestCache()
+        self.backend = BACKENDS[backend](observers=self.observers,
+                                         caller=self.caller)
+        self.graphs = dict()        # dev -> (fingerprint, DependencyGraph)
+        self.running = False
+
+    def __str__(self):
+        return '{}(socket_path={})'.format(self.__class__.__name__,
+                                           self.socket_path)
+
+    def event(self, event, *args, **kwargs):
+        for o in self.own_observers:
+            o.notify(event, *args, **kwargs)
+
+    def caller(self, args, **kwargs):
+        return self.current_caller(args, **kwargs)
+
+    def redirect(self, args, output=False, **kwargs):
+        # subprocesses write to the files of the invocation being served
+        kwargs.setdefault('stderr', self.err_fd)
+        if not output:
+            kwargs.setdefault('stdout', self.out_fd)
+        return default_caller(args, output=output, **kwargs)
+
+    def begin(self, observers, caller=None):
+        '''
+        Makes the objects kept between invocations report to the given
+        observers, and run subprocesses with the given caller.
+        '''
+        self.observers[:] = observers
+        self.current_caller = caller or self.redirect
+
+    def graph(self, package, dev=False):
+        cached = self.graphs.get(dev)
+        if cached and cached[0] == self.fingerprint(package, cached[1]):
+            return cached[1]
+        graph = package.graph(dev=dev)
+        self.graphs[dev] = (self.fingerprint(package, graph), graph)
+        return graph
+
+    def invalidate(self):
+        self.graphs.clear()
+
+    def fingerprint(self, package, graph):
+        paths = [package.path / Package.JSON_PATH]
+        for dep in graph:
+            paths += [dep.full_path / Package.JSON_PATH,
+                      dep.full_path / '.git' / 'HEAD']
+        return [stat_key(p) for p in paths]
+
+    def serve(self):
+        if self.socket_path.exists():
+            if request(self.path, ping=True) is not None:
+                self.event('server-running', path=self.socket_path)
+                raise ServerError()
+            self.socket_path.unlink()   # left behind by a server that died
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        with sock:
+            sock.bind(str(self.socket_path))
+            sock.listen(16)
+            self.event('serve', path=self.socket_path)
+            self.running = True
+            try:
+                while self.running:
+                    conn, _ = sock.accept()
+                    with conn:
+                        self.handle(conn)
+            finally:
+                self.socket_path.unlink()
+                self.backend.close()
+
+    def handle(self, conn):
+        fds = recv_fds(conn, 2)
+        try:
+            request = json.loads(conn.makefile('rb').readline().decode())
+            if request.get('stop'):
+                self.running = False
+            if request.get('argv') and len(fds) == 2:
+                self.event('serve-request', argv=request['argv'])
+                code = self.run(request, *fds)
+            else:
+                code = 0
+        finally:
+            for fd in fds:
+                os.close(fd)
+        conn.sendall(json.dumps({'exit': code}).encode() + b'\n')
+
+    def run(self, request, out_fd, err_fd):
+        from .main import main  # which imports this module
+        self.out_fd, self.err_fd = out_fd, err_fd
+        with open(os.dup(out_fd), 'w') as out, \
+                open(os.dup(err_fd), 'w') as err:
+            try:
+                return main(request['argv'], request['env'], self.path,
+                            outfile=out, errfile=err, server=self)
+            except SystemExit as e:
+                return e.code if isinstance(e.code, int) else 1
+            except Exception:
+                err.write(traceback.format_exc())
+                return 1
+
+
+def stat_key(path):
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def request(path, argv=None, env=None, outfile=None, errfile=None,
+            stop=False, ping=False):
+    '''
+    Runs an invocation on the server of the workspace containing the given
+    path, and returns its exit status, or `None` if the server isn't
+    running. With `stop`, the server exits afterwards; with `ping`, nothing
+    is run.
+    '''
+    root = Package.root_path(Path(path))
+    if root is None:
+        return None
+    socket_path = Server.socket_path_for(root)
+    if not (socket_path.exists() and hasattr(socket.socket, 'sendmsg')):
+        return None
+    if not ping and not stop and (outfile is None or errfile is None):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with sock:
+        try:
+            sock.connect(str(socket_path))
+        except OSError:
+            return None # e.g. the socket of a server that died
+        fds = [] if ping or stop else [outfile.fileno(), errfile.fileno()]
+        for f in (outfile, errfile):
+            if f:
+                f.flush()
+        send_fds(sock, fds)
+        sock.sendall(json.dumps({'argv': None if ping or stop else argv,
+                                 'env': env, 'stop': stop}).encode()
+                     + b'\n')
+        reply = sock.makefile('rb').readline()
+    return json.loads(reply.decode())['exit'] if reply else 1
+
+
+# like `socket.send_fds` and `socket.recv_fds`, which need Python 3.9
+
+def send_fds(sock, fds):
+    sock.sendmsg([b'\0'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                            array.array('i', fds))] if fds else [])
+
+
+def recv_fds(sock, maxfds):
+    fds = array.array('i')
+    _, ancdata, _, _ = sock.recvmsg(
+                           1, socket.CMSG_SPACE(maxfds * fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    return list(fds)
+
@@ -0,0 +1,170 @@
+
+# Copyright 2014  Malcolm Inglis <http://minglis.id.au>
+#
+# This file is part of Puck.
+#
+# Puck is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Puck is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Puck. If not, see <https://gnu.org/licenses/>.
+
+
+import os
+import threading
+from pathlib import Path
+
+from .util import load_json, dump_json
+
+
+class ManifestCache:
+
+    '''
+    Caches the parsed `Package.json` files of a dependency tree and the
+    dependency graphs resolved from them, and persists both to a snapshot
+    file in the dependencies directory. A cached manifest is only read again
+    when its modification time or size has changed, and a cached graph is
+    only used while none of the manifests it was resolved from has changed.
+    '''
+
+    SNAPSHOT_PATH = Path('.puck-graph')
+    VERSION = 2
+
+    def __init__(self):
+        self.snapshot_path = None
+        self.manifests = dict()     # str(json_path) -> [mtime, size, data]
+        self.graphs = dict()        # whether dev -> the graph's snapshot
+        self.changed = False
+        self.loaded = set()         # the keys of manifests loaded this time
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return '{}(snapshot_path={})'.format(self.__class__.__name__,
+                                             self.snapshot_path)
+
+    def open(self, deps_dir):
+        '''
+        Loads the snapshot in the given dependencies directory, if any, which
+        is also where `save` will write it.
+        '''
+        self.snapshot_path = deps_dir / self.__class__.SNAPSHOT_PATH
+        try:
+            snapshot = load_json(self.snapshot_path)
+        except (OSError, ValueError):
+            return
+        if snapshot.get('version') == self.__class__.VERSION:
+            with self.lock:
+                # manifests that were already loaded are more recent
+                for key, cached in snapshot.get('manifests', dict()).items():
+                    self.manifests.setdefault(key, cached)
+                for key, graph in snapshot.get('graphs', dict()).items():
+                    self.graphs.setdefault(key, graph)
+
+    def begin(self):
+        '''
+        Starts recording the manifests loaded by a new invocation, which are
+        the only ones that `save` keeps.
+        '''
+        with self.lock:
+            self.loaded.clear()
+
+    def save(self):
+        with self.lock:
+            if not (self.changed and self.snapshot_path
+                    and self.snapshot_path.parent.is_dir()):
+                return
+            # only keep the manifests of the tree that was just loaded
+            manifests = {k: v for k, v in self.manifests.items()
+                              if k in self.loaded}
+            graphs = {k: g for k, g in self.graphs.items()
+                           if all(m in manifests
+                                  for m, st in g['manifests'].items() if st)}
+            dump_json(self.snapshot_path,
+                      {'version': self.__class__.VERSION,
+                       'manifests': manifests, 'graphs': graphs},
+                      compact=True)
+            self.changed = False
+
+    def load(self, json_path):
+        '''
+        Returns the parsed JSON of the given manifest, or raises
+        `FileNotFoundError` if it doesn't exist.
+        '''
+        key = os.path.abspath(str(json_path))
+        try:
+            st = json_path.stat()
+        except FileNotFoundError:
+            with self.lock:
+                if self.manifests.pop(key, None) is not None:
+                    self.changed = True
+            raise
+        with self.lock:
+            self.loaded.add(key)
+            cached = self.manifests.get(key)
+        if cached and cached[:2] == [st.st_mtime_ns, st.st_size]:
+            return cached[2]
+        data = load_json(json_path)
+        with self.lock:
+            self.manifests[key] = [st.st_mtime_ns, st.st_size, data]
+            self.changed = True
+        return data
+
+    def cached(self, json_path):
+        '''
+        Returns the cached JSON of the given manifest without checking
+        whether it has changed, or an empty object if it didn't exist.
+        '''
+        with self.lock:
+            cached = self.manifests.get(os.path.abspath(str(json_path)))
+        return cached[2] if cached else dict()
+
+    def graph(self, dev):
+        '''
+        Returns the snapshot of the graph stored by `store_graph`, provided
+        that every manifest it was resolved from is unchanged (and that those
+        that were missing are still missing from an existing directory), or
+        else `None`.
+        '''
+        with self.lock:
+            graph = self.graphs.get(str(bool(dev)))
+        if graph is None:
+            return None
+        for key, stat in graph['manifests'].items():
+            try:
+                st = os.stat(key)
+            except FileNotFoundError:
+                if stat is None and os.path.isdir(os.path.dirname(key)):
+                    continue
+                return None
+            with self.lock:
+                cached = self.manifests.get(key)
+            if not (stat and cached and cached[:2] == stat
+                    and stat == [st.st_mtime_ns, st.st_size]):
+                return None
+        with self.lock:
+            self.loaded.update(k for k, st in graph['manifests'].items()
+                                 if st)
+        return graph
+
+    def store_graph(self, dev, graph, json_paths):
+        '''
+        Stores the snapshot of a graph resolved from the manifests at the
+        given paths, which must have been loaded through this cache.
+        '''
+        with self.lock:
+            manifests = dict()
+            for json_path in json_paths:
+                key = os.path.abspath(str(json_path))
+                cached = self.manifests.get(key)
+                manifests[key] = cached[:2] if cached else None
+            graph = dict(graph, manifests=manifests)
+            if self.graphs.get(str(bool(dev))) != graph:
+                self.graphs[str(bool(dev))] = graph
+                self.changed = True
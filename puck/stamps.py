@@ -0,0 +1,95 @@
+
+# Copyright 2014  Malcolm Inglis <http://minglis.id.au>
+#
+# This file is part of Puck.
+#
+# Puck is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Puck is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Puck. If not, see <https://gnu.org/licenses/>.
+
+
+import json
+import hashlib
+import threading
+from pathlib import Path
+
+from .util import load_json, dump_json
+from .jobserver import strip_jobserver
+
+
+def stable_env(env, ignored):
+    '''
+    Returns the sorted variables of the environment that aren't `ignored`,
+    leaving the jobserver out of `MAKEFLAGS`.
+    '''
+    return sorted((k, strip_jobserver(v) if k == 'MAKEFLAGS' else v)
+                  for k, v in env.items() if k not in ignored)
+
+
+class StampStore:
+
+    '''
+    Records, for one command, the stamp of each package the command last
+    succeeded for, in a file in the dependencies directory. A stamp is a
+    digest of everything the command's result depends on, so the command
+    needn't be executed again while its stamp is unchanged.
+    '''
+
+    JSON_PATH = Path('.puck-stamps.json')
+
+    # shell variables that change between invocations without affecting builds
+    IGNORED_ENV = frozenset(['_', 'OLDPWD', 'PWD', 'SHLVL'])
+
+    def __init__(self, deps_dir, command):
+        self.json_path = deps_dir / self.__class__.JSON_PATH
+        self.command = command
+        try:
+            self.all_stamps = load_json(self.json_path)
+        except (OSError, ValueError):
+            self.all_stamps = dict()
+        if not isinstance(self.all_stamps, dict):
+            self.all_stamps = dict()
+        self.stamps = self.all_stamps.setdefault(command, dict())
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return '{}(json_path={}, command={})'.format(
+                   self.__class__.__name__, self.json_path, self.command)
+
+    def get(self, key):
+        with self.lock:
+            return self.stamps.get(key)
+
+    def set(self, key, stamp):
+        with self.lock:
+            if stamp is None:
+                self.stamps.pop(key, None)
+            else:
+                self.stamps[key] = stamp
+
+    def save(self):
+        with self.lock:
+            self.json_path.parent.mkdir(parents=True, exist_ok=True)
+            dump_json(self.json_path, self.all_stamps)
+
+    def stamp(self, state, handler, env, inputs):
+        '''
+        Returns the stamp for a package with the given tree state, command
+        handler, environment and stamps of the packages it depends on, or
+        `None` if the tree state is unknown.
+        '''
+        if state is None:
+            return None
+        env = stable_env(env, self.__class__.IGNORED_ENV)
+        return hashlib.sha1(json.dumps([state, handler, env, inputs])
+                            .encode()).hexdigest()
+
@@ -0,0 +1,93 @@
+
+# Copyright 2014  Malcolm Inglis <http://minglis.id.au>
+#
+# This file is part of Puck.
+#
+# Puck is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Puck is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Puck. If not, see <https://gnu.org/licenses/>.
+
+
+from collections import namedtuple
+
+
+class DependencyStatus(namedtuple('DependencyStatus', [
+        'path', 'full_path', 'commit', 'branch', 'ahead_behind', 'changed',
+        'untracked', 'locked', 'target'])):
+
+    '''
+    The state of a dependency's checkout: the commit and branch checked out
+    (`None` if it's missing, or the `HEAD` is detached), the commits it's
+    ahead of and behind its upstream branch, its numbers of changed tracked
+    files and of untracked files, and the commits that `Package.lock` and its
+    tag or reference would check out, if known.
+    '''
+
+    __slots__ = ()
+
+    @property
+    def missing(self):
+        return self.commit is None
+
+    def states(self):
+        '''
+        Returns a short description of each way the checkout differs from a
+        clean checkout of its locked and targeted commit.
+        '''
+        if self.missing:
+            return ['missing']
+        states = []
+        if self.changed:
+            states.append('dirty ({})'.format(self.changed))
+        if self.untracked:
+            states.append('untracked ({})'.format(self.untracked))
+        if self.branch is None:
+            states.append('detached')
+        ahead, behind = self.ahead_behind or (0, 0)
+        if behind:
+            states.append('behind upstream ({})'.format(behind))
+        if ahead:
+            states.append('ahead of upstream ({})'.format(ahead))
+        if self.locked and self.locked != self.commit:
+            states.append('not at lock ({})'.format(self.locked[:12]))
+        if self.target and self.target[1] != self.commit:
+            states.append('not at {} ({})'.format(self.target[0],
+                                                  (self.target[1]
+                                                   or 'unknown')[:12]))
+        return states
+
+    def to_json(self):
+        return {
+            'commit': self.commit,
+            'branch': self.branch,
+            'ahead': self.ahead_behind and self.ahead_behind[0],
+            'behind': self.ahead_behind and self.ahead_behind[1],
+            'changed': self.changed,
+            'untracked': self.untracked,
+            'locked': self.locked,
+            'target': self.target and {'rev': self.target[0],
+                                       'commit': self.target[1]},
+            'states': self.states()
+        }
+
+
+def format_table(statuses):
+    '''
+    Returns a table of the given statuses, one line per dependency.
+    '''
+    rows = [('PATH', 'COMMIT', 'STATE')]
+    rows.extend((str(s.full_path), (s.commit or '-')[:12],
+                 ', '.join(s.states()) or 'clean')
+                for s in statuses)
+    width = max(len(r[0]) for r in rows)
+    return '\n'.join('{:<{}}  {:<12}  {}'.format(path, width, commit, state)
+                     for path, commit, state in rows)
@@ -0,0 +1,128 @@
+
+# Copyright 2014  Malcolm Inglis <http://minglis.id.au>
+#
+# This file is part of Puck.
+#
+# Puck is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Puck is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Puck. If not, see <https://gnu.org/licenses/>.
+
+
+import os
+import time
+import threading
+from pathlib import Path
+
+from .util import load_json, dump_json
+
+
+class TimingStore:
+
+    '''
+    Records how long each package's command has taken when it succeeded,
+    weighted towards the latest run, in a file in the dependencies directory,
+    by observing the commands that are executed. A timing is only kept while
+    the package's handler for the command is unchanged, and is used to
+    predict how long the command will take to execute again.
+    '''
+
+    JSON_PATH = Path('.puck-timings.json')
+    VERSION = 1
+    SMOOTHING = 0.5         # the weight of a new duration against the old
+
+    def __init__(self):
+        self.json_path = None
+        self.root = None
+        self.timings = dict()   # path -> command -> {handler, seconds}
+        self.started = dict()   # (path, command) -> the time it started
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return '{}(json_path={})'.format(self.__class__.__name__,
+                                         self.json_path)
+
+    def open(self, deps_dir, root):
+        '''
+        Reads the timings of the packages of the given root package, whose
+        dependencies directory is `deps_dir`.
+        '''
+        self.json_path = deps_dir / self.__class__.JSON_PATH
+        self.root = os.path.abspath(str(root))
+        try:
+            timings = load_json(self.json_path)
+        except (OSError, ValueError):
+            timings = dict()
+        self.timings = (timings.get('paths', dict())
+                        if timings.get('version') == self.__class__.VERSION
+                        else dict())
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            self.json_path.parent.mkdir(parents=True, exist_ok=True)
+            dump_json(self.json_path, {'version': self.__class__.VERSION,
+                                       'paths': self.timings})
+            self.changed = False
+
+    def key(self, package):
+        return os.path.relpath(os.path.abspath(str(package.path)), self.root)
+
+    def notify(self, event, package=None, command=None, failed=False,
+                     **kwargs):
+        if self.root is None or package is None:
+            return
+        if event == 'execute':
+            with self.lock:
+                self.started[(self.key(package), command)] = time.monotonic()
+        elif event == 'execute-end':
+            with self.lock:
+                start = self.started.pop((self.key(package), command), None)
+            if start is not None and not failed:
+                self.record(package, command, time.monotonic() - start)
+
+    def record(self, package, command, seconds):
+        handler = package.commands.get(command)
+        with self.lock:
+            commands = self.timings.setdefault(self.key(package), dict())
+            entry = commands.get(command)
+            if entry and entry['handler'] == handler:
+                seconds = (self.__class__.SMOOTHING * seconds
+                           + (1 - self.__class__.SMOOTHING)
+                           * entry['seconds'])
+            commands[command] = {'handler': handler,
+                                 'seconds': round(seconds, 3)}
+            self.changed = True
+
+    def estimate(self, package, command):
+        '''
+        Returns the predicted number of seconds that executing the command
+        for the package will take, or `None` if it's unknown.
+        '''
+        if command not in package.commands:
+            return 0
+        with self.lock:
+            entry = self.timings.get(self.key(package), dict()).get(command)
+        if entry and entry['handler'] == package.commands[command]:
+            return entry['seconds']
+        return None
+
+    def costs(self, packages, command):
+        '''
+        Returns the estimate for each of the given packages (by key), where
+        unknown estimates are the mean of the known ones.
+        '''
+        costs = {k: self.estimate(p, command) for k, p in packages.items()}
+        known = [c for c in costs.values() if c]
+        default = sum(known) / len(known) if known else 0
+        return {k: default if c is None else c for k, c in costs.items()}
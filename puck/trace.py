@@ -0,0 +1,149 @@
+
+# Copyright 2014  Malcolm Inglis <http://minglis.id.au>
+#
+# This file is part of Puck.
+#
+# Puck is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Puck is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Puck. If not, see <https://gnu.org/licenses/>.
+
+
+import os
+import json
+import time
+import threading
+from collections import defaultdict
+
+
+class Tracer:
+
+    '''
+    An observer that times the calls, dependency updates, command executions
+    and manifest loads of an invocation from their begin and end events. It
+    writes them to a file in the Chrome trace-event format, which can be
+    opened with `chrome://tracing` or Perfetto, and summarises where the
+    time went.
+    '''
+
+    SPANS = ('call', 'plan', 'update', 'execute', 'load-manifest')
+    SUMMARY_ROWS = 10
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.events = []        # Chrome trace events
+        self.spans = []         # (category, key, seconds)
+        self.stacks = dict()    # thread -> [(category, key, begin)]
+        self.threads = dict()   # thread ident -> small thread ID
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return '{}(events={})'.format(self.__class__.__name__,
+                                      len(self.events))
+
+    def notify(self, event, **kwargs):
+        now = time.monotonic()
+        if event in self.__class__.SPANS:
+            category, phase = event, 'B'
+        elif event[:-len('-end')] in self.__class__.SPANS:
+            category, phase = event[:-len('-end')], 'E'
+        else:
+            return
+        name, key, args = self.describe(category, **kwargs)
+        with self.lock:
+            tid = self.threads.setdefault(threading.get_ident(),
+                                          len(self.threads) + 1)
+            self.events.append({'name': name, 'cat': category, 'ph': phase,
+                                'ts': round((now - self.start) * 1e6),
+                                'pid': os.getpid(), 'tid': tid,
+                                'args': args})
+            stack = self.stacks.setdefault(tid, [])
+            if phase == 'B':
+                stack.append((category, key, now))
+            elif stack:
+                category, key, begin = stack.pop()
+                self.spans.append((category, key, now - begin))
+
+    def describe(self, category, args=None, cwd=None, dependency=None,
+                       package=None, command=None, path=None, failed=None):
+        '''
+        Returns the name of an event, the key that its time is summed under,
+        and its arguments in the trace file.
+        '''
+        if category == 'call':
+            if isinstance(args, str):
+                return args, (args.split() or [''])[0], {'cwd': cwd}
+            name = ' '.join(args[:2])
+            return name, name, {'args': ' '.join(args), 'cwd': cwd}
+        elif category in ('plan', 'update'):
+            path = str(dependency.full_path)
+            return path, path, {}
+        elif category == 'execute':
+            path = str(package.path)
+            return '{} {}'.format(path, command), path, {'command': command}
+        else:
+            return str(path), str(path.parent), {}
+
+    def write(self, path):
+        with path.open('w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'},
+                      f)
+            f.write('\n')
+
+    def totals(self, categories):
+        counts = defaultdict(int)
+        seconds = defaultdict(float)
+        for category, key, duration in self.spans:
+            if category in categories:
+                counts[key] += 1
+                seconds[key] += duration
+        rows = sorted(seconds, key=seconds.get, reverse=True)
+        return [(key, counts[key], seconds[key]) for key in rows]
+
+    def summarize(self):
+        '''
+        Returns the total time of the invocation, and `(key, count, seconds)`
+        for each phase and for the dependencies and subprocesses that took
+        the longest.
+        '''
+        n = self.__class__.SUMMARY_ROWS
+        phases = defaultdict(lambda: [0, 0.0])
+        for category, _, duration in self.spans:
+            phases[category][0] += 1
+            phases[category][1] += duration
+        return {'seconds': time.monotonic() - self.start,
+                'phases': [(c, phases[c][0], phases[c][1])
+                           for c in self.__class__.SPANS if c in phases],
+                'dependencies':
+                    self.totals(('plan', 'update', 'execute'))[:n],
+                'subprocesses': self.totals(('call',))[:n]}
+
+    def summary(self, out):
+        '''
+        Prints the total time of each phase, and the dependencies and
+        subprocesses that took the longest, with `out`.
+        '''
+        summary = self.summarize()
+        out('\n### Trace summary: {:.3f} s in total'
+              .format(summary['seconds']))
+        for title, rows in (('Phase', summary['phases']),
+                            ('Slowest dependencies',
+                             summary['dependencies']),
+                            ('Subprocesses', summary['subprocesses'])):
+            if not rows:
+                continue
+            width = max(len(title), max(len(r[0]) for r in rows))
+            out('\n{:<{}}  {:>6}  {:>9}'.format(title, width, 'Count',
+                                                'Seconds'))
+            for key, count, seconds in rows:
+                out('{:<{}}  {:>6}  {:>9.3f}'.format(key, width, count,
+                                                     seconds))
+
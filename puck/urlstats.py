@@ -0,0 +1,144 @@
+
+# Copyright 2014  Malcolm Inglis <http://minglis.id.au>
+#
+# This file is part of Puck.
+#
+# Puck is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Puck is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Puck. If not, see <https://gnu.org/licenses/>.
+
+
+import os
+import math
+import time
+import threading
+from pathlib import Path
+from subprocess import CalledProcessError, TimeoutExpired, DEVNULL
+
+from .util import (default_caller, call_method, load_json, dump_json,
+                   parallel_map)
+
+
+class UrlStats:
+
+    '''
+    Records how quickly each repository URL has answered and how many times
+    in a row it has failed, in a file in Puck's user-level cache. Repositories
+    with several URLs probe those without recent stats concurrently, and are
+    then cloned and fetched from the fastest healthy URL first.
+    '''
+
+    STATS_PATH = Path('url-stats.json')
+    VERSION = 1
+    MAX_AGE = 3600          # seconds until a URL is probed again
+    PROBE_TIMEOUT = 10      # seconds until a probed URL counts as failed
+    SMOOTHING = 0.5         # the weight of a new latency against the old
+
+    def __init__(self, path, observers=None, caller=None):
+        self.path = (Path(os.path.abspath(str(path)))
+                     / self.__class__.STATS_PATH)
+        self.observers = observers or list()
+        self.caller = caller or default_caller
+        self.stats = None       # url -> {'latency', 'failures', 'checked'}
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return '{}(path={})'.format(self.__class__.__name__, str(self.path))
+
+    def event(self, event, *args, **kwargs):
+        for o in self.observers:
+            o.notify(event, *args, **kwargs)
+
+    call = call_method
+
+    def entries(self):
+        # must be called with the lock held
+        if self.stats is None:
+            try:
+                stats = load_json(self.path)
+            except (OSError, ValueError):
+                stats = dict()
+            self.stats = (stats.get('urls', dict())
+                          if stats.get('version') == self.__class__.VERSION
+                          else dict())
+        return self.stats
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            dump_json(self.path, {'version': self.__class__.VERSION,
+                                  'urls': self.stats})
+            self.changed = False
+
+    def get(self, url):
+        with self.lock:
+            return dict(self.entries().get(url) or dict())
+
+    def record(self, url, latency=None, failed=False):
+        '''
+        Records that the given URL failed, or else that it succeeded, in
+        `latency` seconds if that was measured.
+        '''
+        with self.lock:
+            entry = self.entries().setdefault(
+                        url, {'latency': None, 'failures': 0, 'checked': 0})
+            entry['checked'] = time.time()
+            if failed:
+                entry['failures'] += 1
+            else:
+                entry['failures'] = 0
+                if latency is not None:
+                    entry['latency'] = (latency if entry['latency'] is None
+                                        else self.__class__.SMOOTHING * latency
+                                        + (1 - self.__class__.SMOOTHING)
+                                        * entry['latency'])
+            self.changed = True
+
+    def probe(self, url):
+        start = time.monotonic()
+        try:
+            self.call(['git', 'ls-remote', '--heads', url], cwd='.',
+                      output=True, stderr=DEVNULL,
+                      timeout=self.__class__.PROBE_TIMEOUT)
+        except (CalledProcessError, TimeoutExpired, OSError):
+            self.record(url, failed=True)
+            self.event('probe-url', url=url, latency=None)
+            return
+        latency = time.monotonic() - start
+        self.record(url, latency=latency)
+        self.event('probe-url', url=url, latency=latency)
+
+    def order(self, urls):
+        '''
+        Returns the given URLs sorted from the fastest healthy URL to the one
+        that has failed the most times in a row, after concurrently probing
+        those that haven't been checked recently. URLs with the same stats
+        keep their configured order.
+        '''
+        urls = list(urls)
+        if len(urls) <= 1:
+            return urls
+        now = time.time()
+        stale = [url for url in urls
+                     if now - self.get(url).get('checked', 0)
+                        > self.__class__.MAX_AGE]
+        parallel_map(self.probe, stale, jobs=len(stale))
+        def key(url):
+            entry = self.get(url)
+            latency = entry.get('latency')
+            return (entry.get('failures', 0),
+                    math.inf if latency is None else latency)
+        return sorted(urls, key=key)
+
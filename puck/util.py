@@ -17,9 +17,13 @@
 # along with Puck. If not, see <https://gnu.org/licenses/>.
 
 
+import os
 import json
 import re
+import threading
 import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 
 def load_json(path):
@@ -27,19 +31,129 @@ def load_json(path):
         return json.load(f)
 
 
+@contextmanager
+def replacing(path):
+    '''
+    Yields a temporary path next to the given one, to write in the block, and
+    then replaces the given path with it. Other processes, which may be
+    replacing it at the same time, never see a partly written file.
+    '''
+    tmp_path = path.with_suffix('.tmp{}-{}'.format(os.getpid(),
+                                                   threading.get_ident()))
+    try:
+        yield tmp_path
+    except BaseException:
+        if tmp_path.exists():
+            tmp_path.unlink()
+        raise
+    os.replace(str(tmp_path), str(path))
+
+
+def dump_json(path, value, compact=False):
+    with replacing(path) as tmp_path, tmp_path.open('w') as f:
+        if compact:
+            json.dump(value, f, separators=(',', ':'))
+        else:
+            json.dump(value, f, indent=4, sort_keys=True)
+            f.write('\n')
+
+
+SIZE_REGEX = re.compile(r'(\d+(?:\.\d+)?)([KMGT]?)(?:i?B)?', re.IGNORECASE)
+SIZE_UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+def parse_size(s):
+    '''
+    Parses a size in bytes with an optional binary unit, like `750M` or `5G`.
+    '''
+    m = SIZE_REGEX.fullmatch(s.strip())
+    if not m:
+        raise ValueError('invalid size: {}'.format(s))
+    return int(float(m.group(1)) * SIZE_UNITS[m.group(2).upper()])
+
+
+def format_size(n):
+    for unit in ('', 'K', 'M', 'G', 'T'):
+        if n < 1024 or unit == 'T':
+            break
+        n /= 1024
+    return '{:.1f}{}'.format(n, unit) if unit else str(n)
+
+
+NUMBERS_REGEX = re.compile(r'(\d+)')
+PRERELEASE_REGEX = re.compile(r'(.*?\d)-([A-Za-z].*)')
+
+def natural_key(s):
+    parts = NUMBERS_REGEX.split(s)
+    parts[1::2] = map(int, parts[1::2])
+    return parts
+
+def version_key(s):
+    '''
+    Returns a key ordering version strings by their numeric parts, so that
+    `v2.10.0 > v2.9.0`, and with pre-releases like `v2.0.0-rc1` coming
+    before their release.
+    '''
+    m = PRERELEASE_REGEX.fullmatch(s)
+    if m:
+        return (natural_key(m.group(1)), 0, natural_key(m.group(2)))
+    return (natural_key(s), 1, [])
+
+
 DERIVE_PATH_REGEX = re.compile(r'(.*[/:])|(\.git$)|(/$)')
 
 def derive_path(url):
     return DERIVE_PATH_REGEX.sub('', url)
 
 
-def default_caller(args, output=False, check=True, **kwargs):
-    if output:
+SCP_LIKE_URL_REGEX = re.compile(r'[^/]+:')
+
+def absolute_url(url):
+    '''
+    Returns the given repository URL, but with local paths made absolute
+    relative to the current directory, like `git clone` does.
+    '''
+    if '://' in url or SCP_LIKE_URL_REGEX.match(url):
+        return url
+    return os.path.abspath(url)
+
+
+def forward_errors(text, stderr=None):
+    '''
+    Writes the error output captured from a subprocess to where it would
+    otherwise have gone: the given file or file descriptor, or our own.
+    '''
+    if text and stderr != subprocess.DEVNULL:
+        os.write(2 if stderr is None
+                   else stderr if isinstance(stderr, int)
+                   else stderr.fileno(),
+                 text.encode())
+
+
+def default_caller(args, output=False, check=True, errors=False, **kwargs):
+    if errors:
+        # capture the error output to tell why it failed, and pass it on
+        stderr = kwargs.pop('stderr', None)
+        timeout = kwargs.pop('timeout', None)
+        if output:
+            kwargs['stdout'] = subprocess.PIPE
+        with subprocess.Popen(args, stderr=subprocess.PIPE,
+                              universal_newlines=True, **kwargs) as process:
+            try:
+                out, err = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                raise
+        forward_errors(err, stderr)
+        if process.returncode and (output or check):
+            raise subprocess.CalledProcessError(process.returncode, args,
+                                                output=out, stderr=err)
+        return out if output else process.returncode
+    elif output:
         return subprocess.check_output(args, universal_newlines=True, **kwargs)
     elif check:
-        subprocess.check_call(args, **kwargs)
+        return subprocess.check_call(args, **kwargs)
     else:
-        subprocess.call(args, **kwargs)
+        return subprocess.call(args, **kwargs)
 
 
 def call_method(self, args, **kwargs):
@@ -47,6 +161,22 @@ def call_method(self, args, **kwargs):
         kwargs['cwd'] = str(kwargs['cwd'])
 
     self.event('call', args=args, cwd=kwargs.get('cwd'))
-    return self.caller(args, **kwargs)
+    try:
+        return self.caller(args, **kwargs)
+    finally:
+        self.event('call-end', args=args, cwd=kwargs.get('cwd'))
 
 
+def parallel_map(f, xs, jobs=1):
+    '''
+    Applies `f` to each of `xs` with up to `jobs` worker threads, returning
+    the results in the order of `xs`. Every call is allowed to finish before
+    the first exception (in the order of `xs`) is raised, so that failures
+    are reported deterministically.
+    '''
+    xs = list(xs)
+    if jobs <= 1 or len(xs) <= 1:
+        return [f(x) for x in xs]
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(f, x) for x in xs]
+    return [future.result() for future in futures]
@@ -0,0 +1,434 @@
+
+# Copyright 2014  Malcolm Inglis <http://minglis.id.au>
+#
+# This file is part of Puck.
+#
+# Puck is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Puck is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Puck. If not, see <https://gnu.org/licenses/>.
+
+
+import os
+import time
+import errno
+import select
+import signal
+import struct
+import ctypes
+import threading
+from subprocess import Popen, PIPE, CalledProcessError, TimeoutExpired
+
+from .util import forward_errors
+from .errors import PuckError
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Watcher:
+
+    '''
+    Watches directories, each under a key, for changes to the files under
+    them, except those under `.git` or the `exclude`d directories. Changes
+    made under a muted key are forgotten rather than reported.
+    '''
+
+    def __init__(self, dirs, exclude=()):
+        self.dirs = dict(dirs)          # key -> Path
+        self.exclude = {os.path.abspath(str(p)) for p in exclude}
+        self.lock = threading.Lock()
+        self.muted = set()
+        self.changed = set()
+
+    def __str__(self):
+        return '{}(dirs={})'.format(self.__class__.__name__, len(self.dirs))
+
+    def walk(self, path):
+        for top, dirs, _ in os.walk(str(path)):
+            dirs[:] = [d for d in dirs if not self.excluded(top, d)]
+            yield top
+
+    def excluded(self, top, name):
+        return (name == '.git'
+                or os.path.abspath(os.path.join(top, name)) in self.exclude)
+
+    def mute(self, key):
+        with self.lock:
+            self.muted.add(key)
+
+    def unmute(self, key):
+        with self.lock:
+            self.settle(key)
+            self.muted.discard(key)
+
+    def forget(self, key):
+        '''
+        Forgets the changes made under the given key so far.
+        '''
+        with self.lock:
+            self.settle(key)
+
+    def wait(self, timeout=None):
+        '''
+        Returns the keys with changes since the last call, waiting up to
+        `timeout` seconds (or forever) for there to be any.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                self.read()
+                if self.changed:
+                    changed, self.changed = self.changed, set()
+                    return changed
+            remaining = (None if deadline is None
+                         else deadline - time.monotonic())
+            if remaining is not None and remaining <= 0:
+                return set()
+            self.sleep(remaining)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(Watcher):
+
+    '''
+    Watches every directory with Linux's inotify, through the C library.
+    '''
+
+    name = 'inotify'
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+            | IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, dirs, exclude=()):
+        super().__init__(dirs, exclude=exclude)
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise self.error()
+        self.watches = dict()       # watch descriptor -> (key, directory)
+        try:
+            for key, path in self.dirs.items():
+                self.add(key, path)
+        except OSError:
+            self.close()
+            raise
+
+    def error(self, path=None):
+        e = ctypes.get_errno()
+        return OSError(e, os.strerror(e), path)
+
+    def add(self, key, path):
+        for d in self.walk(path):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(d),
+                                             self.__class__.MASK)
+            if wd < 0:
+                if ctypes.get_errno() == errno.ENOENT:
+                    continue # removed since it was listed
+                raise self.error(d)
+            self.watches[wd] = (key, d)
+
+    def read(self):
+        cls = self.__class__
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, size = cls.EVENT.unpack_from(data, offset)
+                offset += cls.EVENT.size
+                name = os.fsdecode(data[offset:offset + size].rstrip(b'\0'))
+                offset += size
+                if mask & cls.IN_Q_OVERFLOW:
+                    self.changed.update(k for k in self.dirs
+                                        if k not in self.muted)
+                    continue
+                if wd not in self.watches:
+                    continue # e.g. the watch of a removed directory
+                key, top = self.watches[wd]
+                if name and self.excluded(top, name):
+                    continue
+                if mask & cls.IN_ISDIR and mask & (cls.IN_CREATE
+                                                  | cls.IN_MOVED_TO):
+                    self.add(key, os.path.join(top, name))
+                if key not in self.muted:
+                    self.changed.add(key)
+
+    def settle(self, key):
+        # the events of changes that were already made are queued, so
+        # reading them while the key is muted drops them
+        self.read()
+
+    def sleep(self, timeout):
+        select.select([self.fd], [], [], timeout)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(Watcher):
+
+    '''
+    Watches by comparing the modification time, size and inode of every file
+    every `INTERVAL` seconds, for systems without inotify.
+    '''
+
+    name = 'polling'
+
+    INTERVAL = 0.5
+
+    def __init__(self, dirs, exclude=()):
+        super().__init__(dirs, exclude=exclude)
+        self.states = {key: self.scan(path)
+                       for key, path in self.dirs.items()}
+
+    def scan(self, path):
+        state = dict()
+        for top in self.walk(path):
+            try:
+                entries = list(os.scandir(top))
+            except OSError:
+                continue # removed since it was listed
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                state[entry.path] = (st.st_mtime_ns, st.st_size, st.st_ino)
+        return state
+
+    def read(self):
+        for key, path in self.dirs.items():
+            if key in self.muted:
+                continue
+            state = self.scan(path)
+            if state != self.states[key]:
+                self.states[key] = state
+                self.changed.add(key)
+
+    def settle(self, key):
+        self.states[key] = self.scan(self.dirs[key])
+
+    def sleep(self, timeout):
+        cls = self.__class__
+        time.sleep(cls.INTERVAL if timeout is None
+                   else min(cls.INTERVAL, timeout))
+
+
+def create_watcher(dirs, exclude=(), polling=False):
+    '''
+    Returns an inotify watcher where it's available, or a polling one.
+    '''
+    if not polling:
+        try:
+            return InotifyWatcher(dirs, exclude=exclude)
+        except (OSError, AttributeError):
+            pass # e.g. not Linux, or out of inotify watches
+    return PollingWatcher(dirs, exclude=exclude)
+
+
+class Watch:
+
+    '''
+    Executes a command for the dependency tree of a package, and then, until
+    interrupted, executes it again for each dependency whose checkout
+    changes and for the dependencies that depend on it, in the same order.
+    Changes are collected until there are none for `DEBOUNCE` seconds. An
+    execution still in progress when more changes are collected is
+    cancelled, killing its subprocesses, and is restarted along with them.
+
+    This is also an observer of the execution: the changes a package's own
+    command makes to its checkout (e.g. its build outputs) are ignored.
+    '''
+
+    DEBOUNCE = 0.2
+
+    def __init__(self, observers=None):
+        self.observers = observers or list()
+        self.lock = threading.Lock()
+        self.processes = set()
+        self.cancelled = False
+        self.watcher = None
+        self.keys = dict()          # absolute directory -> key
+        self.done = set()
+
+    def __str__(self):
+        return '{}(watcher={})'.format(self.__class__.__name__,
+                                       self.watcher)
+
+    def event(self, event, *args, **kwargs):
+        for o in self.observers:
+            o.notify(event, *args, **kwargs)
+
+    def caller(self, args, output=False, check=True, timeout=None,
+                     errors=False, **kwargs):
+        '''
+        Runs a subprocess like `default_caller`, but in its own session, so
+        that it can be killed along with its children by `cancel`.
+        '''
+        stderr = kwargs.pop('stderr', None) if errors else None
+        if output:
+            kwargs.update(stdout=PIPE, universal_newlines=True)
+        if errors:
+            kwargs.update(stderr=PIPE, universal_newlines=True)
+        with self.lock:
+            if self.cancelled:
+                raise Cancelled()
+            process = Popen(args, start_new_session=True, **kwargs)
+            self.processes.add(process)
+        try:
+            out, err = process.communicate(timeout=timeout)
+        except TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+            raise
+        finally:
+            with self.lock:
+                self.processes.discard(process)
+        if self.cancelled:
+            raise Cancelled()
+        if errors:
+            forward_errors(err, stderr)
+        if process.returncode and (output or check):
+            raise CalledProcessError(process.returncode, args, output=out,
+                                     stderr=err)
+        return out if output else process.returncode
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            for process in self.processes:
+                try:
+                    os.killpg(process.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+    def notify(self, event, package=None, **kwargs):
+        key = self.key(package)
+        if key is False:
+            return
+        if event == 'execute':
+            self.watcher.mute(key)
+        elif event == 'execute-end':
+            self.watcher.unmute(key)
+            if not self.cancelled:
+                self.done.add(key)
+        elif event == 'restore-outputs':
+            self.watcher.forget(key)
+            self.done.add(key)
+
+    def key(self, package):
+        if package is None or self.watcher is None:
+            return False
+        return self.keys.get(os.path.abspath(str(package.path)), False)
+
+    def run(self, package, command, graph=None, root=False, dev=False,
+                  polling=False, **kwargs):
+        '''
+        Watches the checkouts of the package's dependencies (and the package
+        itself, if `root`), passing the other arguments to
+        `Package.execute`.
+        '''
+        graph = graph or package.graph(dev=dev)
+        dirs = {path: dep.full_path for path, dep in graph.nodes.items()}
+        if root:
+            dirs[None] = package.path
+        self.keys = {os.path.abspath(str(d)): k for k, d in dirs.items()}
+        self.watcher = create_watcher(dirs, exclude=[package.deps_dir],
+                                      polling=polling)
+        self.event('watch', paths=list(dirs.values()),
+                   method=self.watcher.name)
+        dirty = set(dirs)
+        thread = None
+        try:
+            while True:
+                self.cancelled = False
+                self.done = set()
+                thread = threading.Thread(target=self.execute,
+                                          args=(package, command, graph,
+                                                dirty),
+                                          kwargs=kwargs, daemon=True)
+                thread.start()
+                changed = self.changes()
+                self.event('watch-changes',
+                           paths=[dirs[k] for k in dirs if k in changed])
+                if thread.is_alive():
+                    # what the cancelled execution didn't finish is redone
+                    self.event('watch-cancel')
+                    self.cancel()
+                    thread.join()
+                    changed |= dirty - self.done
+                dirty = self.affected(graph, changed)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if thread:
+                self.cancel()
+                thread.join()
+            self.watcher.close()
+
+    def changes(self):
+        changed = self.watcher.wait()
+        while True:
+            more = self.watcher.wait(self.__class__.DEBOUNCE)
+            if not more:
+                return changed
+            changed |= more
+
+    def affected(self, graph, changed):
+        '''
+        Returns the given keys with those of every dependency that depends
+        on them, and the root's if it's watched and anything changed.
+        '''
+        dependents = {path: set() for path in graph.nodes}
+        for path, edges in graph.edges.items():
+            for e in edges:
+                dependents[e].add(path)
+        affected = set(changed)
+        queue = [k for k in changed if k is not None]
+        while queue:
+            for d in dependents[queue.pop()]:
+                if d not in affected:
+                    affected.add(d)
+                    queue.append(d)
+        if affected and None in self.keys.values():
+            affected.add(None)
+        return affected
+
+    def execute(self, package, command, graph, dirty, **kwargs):
+        try:
+            package.execute(command, graph=graph, root=None in dirty,
+                            paths={k for k in dirty if k is not None},
+                            **kwargs)
+        except Cancelled:
+            return
+        except (PuckError, CalledProcessError):
+            pass # the failure was already reported
+        if not self.cancelled:
+            self.event('watch-idle')
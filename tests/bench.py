@@ -0,0 +1,278 @@
+#!/bin/env python3
+
+# Copyright 2014  Malcolm Inglis <http://minglis.id.au>
+#
+# This file is part of Puck.
+#
+# Puck is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Puck is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Puck. If not, see <https://gnu.org/licenses/>.
+
+
+'''
+Measures how Puck scales by generating a synthetic dependency tree of local
+bare repositories, and timing `puck update` and `puck execute` on it.
+
+    ./bench.py --shape diamond --nodes 1000 --tags 50 --jobs 8
+
+The repositories are generated into `.bench/` (and reused while the shape
+options stay the same), and reached through `file://` URLs. Each scenario
+records its wall time, the number of subprocesses Puck ran (from its
+`--trace` output) and the peak resident memory of Puck and its
+subprocesses. The results are written to a JSON file in `.bench/` named
+after the current commit, which `--compare` can compare with an earlier
+one.
+'''
+
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import shlex
+import shutil
+import platform
+from argparse import ArgumentParser
+from subprocess import Popen, check_output, DEVNULL
+
+
+GIT_ENV = dict(os.environ,
+               GIT_AUTHOR_NAME='bench',
+               GIT_AUTHOR_EMAIL='bench@localhost',
+               GIT_COMMITTER_NAME='bench',
+               GIT_COMMITTER_EMAIL='bench@localhost',
+               GIT_AUTHOR_DATE='2014-01-01T00:00:00Z',
+               GIT_COMMITTER_DATE='2014-01-01T00:00:00Z')
+
+
+def git(args, cwd, input=None):
+    return check_output(['git'] + args, cwd=cwd, env=GIT_ENV, input=input,
+                        universal_newlines=True).strip()
+
+
+def node_name(i):
+    return 'n{:05d}'.format(i)
+
+
+def shape_edges(shape, nodes, fanout, seed):
+    '''
+    Returns the roots of a tree of the given shape, and a mapping of each
+    node to the nodes it depends on.
+    '''
+    edges = {i: [] for i in range(nodes)}
+    if shape == 'wide':
+        return list(range(nodes)), edges
+    if shape == 'deep':
+        for i in range(nodes - 1):
+            edges[i] = [i + 1]
+        return [0], edges
+    # diamond: layers of about sqrt(nodes) nodes, each depending on
+    # `fanout` nodes of the next layer, so most nodes have several parents
+    rng = random.Random(seed)
+    width = max(2, round(math.sqrt(nodes)))
+    layers = [list(range(i, min(i + width, nodes)))
+              for i in range(0, nodes, width)]
+    for layer, below in zip(layers, layers[1:]):
+        for i in layer:
+            edges[i] = rng.sample(below, min(fanout, len(below)))
+        for j, k in enumerate(below):
+            parent = layer[j % len(layer)]
+            if k not in edges[parent]:
+                edges[parent].append(k)
+    return layers[0], edges
+
+
+def manifest(deps, repos_dir):
+    return json.dumps({
+        'dependencies': [{'repo': 'file://{}/{}.git'.format(repos_dir,
+                                                            node_name(d)),
+                          'tag': 'v1.*'}
+                         for d in sorted(deps)],
+        'commands': {'build': 'true'}
+    }, indent=4) + '\n'
+
+
+def make_repo(path, text, tags):
+    '''
+    Creates a bare repository with one commit of the given `Package.json`,
+    tagged `v1.0.0` up to `v1.<tags - 1>.0`, without a working tree.
+    '''
+    git(['init', '--quiet', '--bare', str(path)], cwd='.')
+    blob = git(['hash-object', '-w', '--stdin'], cwd=path, input=text)
+    tree = git(['mktree'], cwd=path,
+               input='100644 blob {}\tPackage.json\n'.format(blob))
+    commit = git(['commit-tree', tree, '-m', 'Commit 1'], cwd=path)
+    git(['update-ref', '--stdin'], cwd=path,
+        input=''.join(['create refs/heads/master {}\n'.format(commit)]
+                      + ['create refs/tags/v1.{}.0 {}\n'.format(t, commit)
+                         for t in range(tags)]))
+    git(['symbolic-ref', 'HEAD', 'refs/heads/master'], cwd=path)
+
+
+def generate(bench_dir, spec):
+    spec_path = os.path.join(bench_dir, 'spec.json')
+    try:
+        with open(spec_path) as f:
+            if json.load(f) == spec:
+                return
+    except (OSError, ValueError):
+        pass
+    repos_dir = os.path.join(bench_dir, 'repos')
+    root_dir = os.path.join(bench_dir, 'root')
+    # keep the results of earlier runs
+    for d in (repos_dir, root_dir):
+        shutil.rmtree(d, ignore_errors=True)
+    os.makedirs(repos_dir)
+    os.makedirs(root_dir)
+    roots, edges = shape_edges(spec['shape'], spec['nodes'], spec['fanout'],
+                               spec['seed'])
+    print('Generating {} repositories in {}...'.format(spec['nodes'],
+                                                       repos_dir))
+    for i, deps in edges.items():
+        make_repo(os.path.join(repos_dir, node_name(i) + '.git'),
+                  manifest(deps, repos_dir), spec['tags'])
+    with open(os.path.join(root_dir, 'Package.json'), 'w') as f:
+        f.write(manifest(roots, repos_dir))
+    with open(spec_path, 'w') as f:
+        json.dump(spec, f)
+
+
+def run(puck, args, cwd, log):
+    '''
+    Runs Puck with the given arguments, appending its output to `log`, and
+    returns its wall time, the number of subprocesses it ran, the peak
+    resident memory of it and its subprocesses in KiB, and its exit status.
+    '''
+    trace = os.path.join(cwd, '.bench-trace.json')
+    start = time.monotonic()
+    process = Popen(puck + ['--trace', trace] + args, cwd=cwd,
+                    stdout=log, stderr=log)
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.monotonic() - start
+    process.returncode = (os.WEXITSTATUS(status) if os.WIFEXITED(status)
+                          else -os.WTERMSIG(status))
+    with open(trace) as f:
+        events = json.load(f)['traceEvents']
+    os.remove(trace)
+    return {'wall': wall,
+            'subprocesses': sum(1 for e in events
+                                  if e['cat'] == 'call' and e['ph'] == 'B'),
+            'peak_rss_kib': usage.ru_maxrss,
+            'status': process.returncode}
+
+
+def scenarios(jobs):
+    jobs = ['--jobs', str(jobs)]
+    update = ['update', '--no-verify'] + jobs
+    incremental = ['execute', 'build', '--incremental'] + jobs
+    return [('update-cold', update, True),
+            ('update-warm', update, False),
+            ('execute', ['execute', 'build'] + jobs, False),
+            ('execute-incremental', incremental, False),
+            ('execute-noop', incremental, False)]
+
+
+def compare(old_path, results):
+    with open(old_path) as f:
+        old = {r['scenario']: r for r in json.load(f)['results']}
+    print('\n{:<20} {:>10} {:>10} {:>8}'.format('Scenario', 'Old s',
+                                               'New s', 'Ratio'))
+    for r in results:
+        o = old.get(r['scenario'])
+        if o:
+            print('{:<20} {:>10.3f} {:>10.3f} {:>8.2f}'
+                    .format(r['scenario'], o['wall'], r['wall'],
+                            r['wall'] / o['wall'] if o['wall'] else math.inf))
+
+
+def main():
+    p = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    p.add_argument('--shape', choices=['wide', 'deep', 'diamond'],
+                   default='diamond')
+    p.add_argument('--nodes', type=int, default=200)
+    p.add_argument('--tags', type=int, default=20,
+                   help='The number of tags in each repository.')
+    p.add_argument('--fanout', type=int, default=2,
+                   help='The dependencies of each node of a diamond tree.')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--jobs', type=int, default=1)
+    p.add_argument('--repeat', type=int, default=1,
+                   help='Run every scenario this many times, keeping the '
+                        'fastest run.')
+    p.add_argument('--puck', default='puck',
+                   help='The command to run Puck with.')
+    p.add_argument('--dir', default='.bench',
+                   help='The directory to generate the repositories in.')
+    p.add_argument('--output',
+                   help='The results file; defaults to '
+                        '`bench-<commit>.json` in the --dir directory.')
+    p.add_argument('--compare', metavar='RESULTS',
+                   help='An earlier results file to compare with.')
+    args = p.parse_args()
+
+    spec = {'shape': args.shape, 'nodes': args.nodes, 'tags': args.tags,
+            'fanout': args.fanout, 'seed': args.seed}
+    bench_dir = os.path.abspath(args.dir)
+    generate(bench_dir, spec)
+    root_dir = os.path.join(bench_dir, 'root')
+    puck = shlex.split(args.puck)
+
+    best = dict()
+    log_path = os.path.join(bench_dir, 'puck.log')
+    with open(log_path, 'w') as log:
+        for _ in range(args.repeat):
+            for name, puck_args, cold in scenarios(args.jobs):
+                if cold:
+                    shutil.rmtree(os.path.join(root_dir, 'deps'),
+                                  ignore_errors=True)
+                log.write('### {}\n'.format(name))
+                log.flush()
+                result = run(puck, puck_args, root_dir, log)
+                if result['status'] != 0:
+                    print('{} failed with status {}; see {}'
+                            .format(name, result['status'], log_path))
+                    return 1
+                if (name not in best
+                        or result['wall'] < best[name]['wall']):
+                    best[name] = dict(result, scenario=name)
+
+    results = [best[name] for name, _, _ in scenarios(args.jobs)]
+    try:
+        commit = check_output(['git', 'rev-parse', 'HEAD'], stderr=DEVNULL,
+                              universal_newlines=True).strip()
+    except Exception:
+        commit = None
+    output = args.output or os.path.join(
+                 args.dir, 'bench-{}.json'.format((commit or 'unknown')[:12]))
+    with open(output, 'w') as f:
+        json.dump({'commit': commit, 'spec': spec, 'jobs': args.jobs,
+                   'python': platform.python_version(),
+                   'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                   'results': results}, f, indent=4, sort_keys=True)
+        f.write('\n')
+
+    print('\n{:<20} {:>10} {:>13} {:>13}'.format('Scenario', 'Seconds',
+                                                 'Subprocesses', 'Peak KiB'))
+    for r in results:
+        print('{:<20} {:>10.3f} {:>13} {:>13}'
+                .format(r['scenario'], r['wall'], r['subprocesses'],
+                        r['peak_rss_kib']))
+    print('\nResults written to {}'.format(output))
+    if args.compare:
+        compare(args.compare, results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
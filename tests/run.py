@@ -19,7 +19,12 @@
 
 
 import os
-from subprocess import check_call, DEVNULL
+import json
+import time
+import shutil
+import signal
+from subprocess import (Popen, check_call, check_output, DEVNULL, PIPE,
+                        STDOUT)
 
 
 def read_file(path):
@@ -36,6 +41,29 @@ def call(args, **kwargs):
     check_call(args, **kwargs)
 
 
+def fake_git(script=''):
+    '''
+    Writes a `git` into `.fakegit` that logs its arguments to `.fakegit/log`
+    and runs the given shell script before the real `git`, and returns the
+    log's path and an environment with it first on the `PATH`.
+    '''
+    log = os.path.abspath('.fakegit/log')
+    os.makedirs('.fakegit', exist_ok=True)
+    with open('.fakegit/git', 'w') as f:
+        f.write('#!/bin/sh\n'
+                'echo "$*" >> {}\n'
+                '{}\n'
+                'exec {} "$@"\n'.format(log, script, shutil.which('git')))
+    os.chmod('.fakegit/git', 0o755)
+    return log, dict(os.environ, PATH=os.path.abspath('.fakegit') + os.pathsep
+                                      + os.environ['PATH'])
+
+
+def logged_fetches(log):
+    return [line.split() for line in read_file(log).splitlines()
+            if line.split()[0] in ('clone', 'fetch', 'ls-remote')]
+
+
 TEST_SEP = '###############################################'
 def test(f):
     def wrap():
@@ -58,6 +86,7 @@ def test_package1():
     assert read_file('package1/output') == 'default package1 var\n'
 
     call(['puck', 'execute', 'foobar'], cwd=cwd)
+    assert not exists('package1/deps')
 
 
 @test
@@ -123,9 +152,716 @@ def test_package5():
     call(['puck', 'execute', 'foobar'], cwd=cwd)
 
 
+@test
+def test_package5_jobs():
+    cwd = 'package5'
+
+    shutil.rmtree('package5/deps')
+    call(['puck', 'update', '--no-verify', '--jobs', '4'], cwd=cwd)
+    assert all([
+        exists('package5/deps/package1'),
+        exists('package5/deps/package2'),
+        exists('package5/deps/package3'),
+        exists('package5/deps/package4')
+    ])
+
+    call(['puck', 'execute', 'build', '--jobs', '4', '--check'], cwd=cwd)
+    assert all([
+        read_file('package5/deps/package1/output') == 'default package1 var\n',
+        read_file('package5/deps/package2/output') == 'second commit: set!\n',
+        read_file('package5/deps/package3/output') == 'building package 3\n',
+        read_file('package5/deps/package4/output') == 'building package 4\n',
+    ])
+
+
+@test
+def test_package5_frozen():
+    cwd = 'package5'
+
+    call(['puck', 'update', '--no-verify'], cwd=cwd)
+    with open('package5/Package.lock') as f:
+        lock = json.load(f)
+    assert sorted(lock.keys()) == ['package1', 'package2', 'package3',
+                                   'package4']
+
+    call(['git', 'checkout', 'v2.0.0'], cwd='package5/deps/package2')
+    call(['puck', 'update', '--frozen'], cwd=cwd)
+    assert all(
+        check_output(['git', 'rev-parse', 'HEAD'], cwd='package5/deps/' + path,
+                     universal_newlines=True).strip() == entry['commit']
+        for path, entry in lock.items())
+
+
+@test
+def test_package5_fetches():
+    cwd = 'package5'
+    log, env = fake_git()
+
+    def fetches(*args):
+        if exists(log):
+            os.remove(log)
+        call(['puck', 'update', '--no-verify'] + list(args), cwd=cwd,
+             env=env)
+        return logged_fetches(log)
+
+    call(['puck', 'update', '--no-verify'], cwd=cwd)
+
+    # an existing clone only fetches the branch or tags it depends on
+    fetched = fetches()
+    assert len(fetched) == 4
+    assert all(f[0] == 'fetch' and len(f) == 3 for f in fetched)
+    assert sorted(f[2] for f in fetched) == [
+               '+refs/heads/master:refs/remotes/origin/master',
+               'refs/tags/v1.*:refs/tags/v1.*',
+               'refs/tags/v2.*:refs/tags/v2.*',
+               'refs/tags/v2.1.*:refs/tags/v2.1.*']
+
+    # locked commits, or commits a dependency is pinned to, aren't fetched
+    assert fetches('--frozen') == []
+    manifest = read_file('package5/Package.json')
+    commit = check_output(['git', 'rev-parse', 'HEAD'],
+                          cwd='package5/deps/package4',
+                          universal_newlines=True).strip()
+    try:
+        with open('package5/Package.json', 'w') as f:
+            f.write(manifest.replace('"../package4"',
+                                     '"../package4", "ref": "{}"'
+                                     .format(commit)))
+        assert not any('package4' in f[1] for f in fetches())
+    finally:
+        with open('package5/Package.json', 'w') as f:
+            f.write(manifest)
+    shutil.rmtree('.fakegit')
+
+
+@test
+def test_package5_trace():
+    cwd = 'package5'
+
+    for sub in (['update', '--no-verify'], ['execute', 'build']):
+        out = check_output(['puck', '--trace', 'trace.json'] + sub, cwd=cwd,
+                           universal_newlines=True)
+        print(out, end='')
+        assert 'Trace summary' in out and 'Slowest dependencies' in out
+        with open('package5/trace.json') as f:
+            events = json.load(f)['traceEvents']
+        phases = [e['ph'] for e in events]
+        assert phases.count('B') == phases.count('E') > 0
+        assert {'call', sub[0]} <= set(e['cat'] for e in events)
+
+    # the summary of a JSON log is an event like any other
+    out = check_output(['puck', '--log-format', 'jsonl', '--trace',
+                        'trace.json', 'execute', 'build'], cwd=cwd,
+                       universal_newlines=True)
+    records = [json.loads(line) for line in out.splitlines()]
+    summary = records[-1]
+    assert summary['event'] == 'trace-summary'
+    assert 'execute' in [phase[0] for phase in summary['phases']]
+
+
+@test
+def test_package5_capture():
+    cwd = 'package5'
+    logs = 'package5/deps/.puck-logs/'
+
+    out = check_output(['puck', '--capture', 'execute', 'build'], cwd=cwd,
+                       universal_newlines=True)
+    print(out, end='')
+    assert 'default package1 var' not in out
+    assert 'package1 (execute): done' in out
+    assert 'default package1 var' in read_file(logs + 'package1.log')
+
+    out = check_output(['puck', '--log-format', 'jsonl', 'update',
+                        '--no-verify'], cwd=cwd, universal_newlines=True)
+    print(out, end='')
+    events = [json.loads(line)['event'] for line in out.splitlines()]
+    assert events.count('update') == events.count('update-end') == 4
+
+    with open('package5/deps/package2/build.sh', 'w') as f:
+        f.write('echo "build failed!"\nexit 1\n')
+    out = check_output(['puck', '--capture', '--compress-logs', 'execute',
+                        'build'], cwd=cwd, universal_newlines=True,
+                       stderr=STDOUT)
+    print(out, end='')
+    assert 'package2 (execute): failed' in out and 'build failed!' in out
+    assert exists(logs + 'package2.log.gz')
+    call(['git', 'checkout', 'build.sh'], cwd='package5/deps/package2')
+
+
+@test
+def test_package5_prune():
+    cwd = 'package5'
+    deps = 'package5/deps/'
+
+    for orphan in ('orphan1', 'orphan2', 'orphan3'):
+        call(['git', 'clone', '--quiet', '../package1', 'deps/' + orphan],
+             cwd=cwd)
+    with open(deps + 'orphan2/f1', 'w') as f:
+        f.write('changed\n')
+
+    call(['puck', 'prune', '--archive'], cwd=cwd)
+    assert all([
+        not exists(deps + 'orphan1'),
+        exists(deps + '.puck-archive/orphan1/.git'),
+        exists(deps + 'orphan2'),   # skipped with uncommitted changes
+        not exists(deps + 'orphan3'),
+        exists(deps + 'package1'),
+        exists(deps + 'package4'),
+    ])
+
+    call(['puck', 'prune', '--force', '--gc', '--jobs', '4'], cwd=cwd)
+    assert not exists(deps + 'orphan2') and exists(deps + 'package2')
+
+    call(['git', 'clone', '--quiet', '../package1', 'deps/orphan4'],
+         cwd=cwd)
+    call(['puck', 'update', '--no-verify', '--prune'], cwd=cwd)
+    assert not exists(deps + 'orphan4') and exists(deps + 'package3')
+
+
+@test
+def test_package5_serve():
+    cwd = 'package5'
+
+    with open('package5/serve.log', 'w') as log:
+        server = Popen(['puck', 'serve'], cwd=cwd, stdout=log, stderr=log)
+    for _ in range(100):
+        if exists('package5/deps/.puck.sock'):
+            break
+        time.sleep(0.1)
+
+    def listed(cwd=cwd):
+        out = check_output(['puck', 'list'], cwd=cwd, universal_newlines=True)
+        return out.split()
+    assert listed() == ['package4', 'package3', 'package2', 'package1']
+    # the server is found from a subdirectory of the workspace too
+    os.mkdir('package5/sub')
+    assert listed('package5/sub') == listed()
+    os.remove('package5/deps/package1/output')
+    call(['puck', 'execute', 'build'], cwd=cwd)
+    assert read_file('package5/deps/package1/output') == \
+               'default package1 var\n'
+
+    # the graph is resolved again once a manifest changes
+    with open('package5/Package.json') as f:
+        manifest = json.load(f)
+    with open('package5/Package.json', 'w') as f:
+        json.dump(dict(manifest, dependencies=manifest['dependencies'][1:]),
+                  f)
+    assert listed() == ['package3', 'package1', 'package2']
+    with open('package5/Package.json', 'w') as f:
+        json.dump(manifest, f)
+
+    call(['puck', 'serve', '--stop'], cwd=cwd)
+    assert server.wait(timeout=10) == 0
+    assert not exists('package5/deps/.puck.sock')
+    assert read_file('package5/serve.log').count('### Serving: puck ') == 5
+    assert listed() == ['package4', 'package3', 'package2', 'package1']
+    assert listed('package5/sub') == listed()
+    os.rmdir('package5/sub')
+
+
+@test
+def test_package5_watch():
+    cwd = 'package5'
+
+    def wait_for(condition):
+        for _ in range(100):
+            if condition():
+                return
+            time.sleep(0.1)
+        assert condition()
+
+    def log():
+        return read_file('package5/watch.log')
+
+    with open('package5/watch.log', 'w') as f:
+        watch = Popen(['puck', 'execute', '--watch', 'build'], cwd=cwd,
+                      stdout=f, stderr=STDOUT)
+    wait_for(lambda: '### Waiting for changes' in log())
+    assert log().count('[deps/package1] make') == 1
+
+    # only the changed dependency and those depending on it are executed,
+    # and the outputs they write don't trigger another execution
+    os.remove('package5/deps/package3/output')
+    wait_for(lambda: log().count('### Waiting for changes') == 2)
+    assert read_file('package5/deps/package3/output') == \
+               'building package 3\n'
+    assert log().count('[deps/package3] echo') == 2
+    assert log().count('[deps/package4] echo') == 2
+    assert log().count('[deps/package1] make') == 1
+    assert log().count('### Changed: ') == 1
+
+    watch.send_signal(signal.SIGINT)
+    assert watch.wait(timeout=10) == 0
+
+
+@test
+def test_package5_jobserver():
+    cwd = 'package5'
+
+    def makeflags():
+        return read_file('package5/makeflags').split()
+
+    with open('package5/Package.json') as f:
+        manifest = json.load(f)
+    with open('package5/Package.json', 'w') as f:
+        json.dump(dict(manifest, commands=dict(manifest['commands'],
+                           flags='echo "$MAKEFLAGS" > makeflags',
+                           par='make -f par.mk')),
+                  f)
+    # each target records how many others are running
+    with open('package5/par.mk', 'w') as f:
+        f.write('all: a b c d\n'
+                'a b c d:\n'
+                '\t@mkdir -p running\n'
+                '\t@ls running | wc -l >> counts\n'
+                '\t@touch running/$@ && sleep 0.2 && rm running/$@\n')
+
+    call(['puck', 'execute', '--root', 'flags'], cwd=cwd)
+    assert makeflags() == []
+    call(['puck', 'execute', '--root', '--jobs', '3', 'flags'], cwd=cwd)
+    assert '-j3' in makeflags()
+    assert any(w.startswith('--jobserver-auth=') for w in makeflags())
+
+    # the handler's `make` runs its targets within Puck's two jobs
+    call(['puck', 'execute', '--root', '--jobs', '2', 'par'], cwd=cwd)
+    counts = [int(n) for n in read_file('package5/counts').split()]
+    assert len(counts) == 4 and max(counts) <= 1
+
+    # a parent `make`'s jobserver is joined and passed on
+    with open('package5/jobs.mk', 'w') as f:
+        f.write('all:\n\t+puck execute --root flags\n')
+    call(['make', '-s', '-j2', '-f', 'jobs.mk'], cwd=cwd,
+         env=dict(os.environ, MAKEFLAGS=''))
+    assert '-j2' in makeflags()
+    assert any(w.startswith('--jobserver-auth=') for w in makeflags())
+
+    with open('package5/Package.json', 'w') as f:
+        json.dump(manifest, f)
+
+
+@test
+def test_package5_schedule():
+    cwd = 'package5'
+    timings_path = 'package5/deps/.puck-timings.json'
+
+    if exists(timings_path):
+        os.remove(timings_path)
+    call(['puck', 'execute', '--root', '--no-output-cache', 'build'],
+         cwd=cwd)
+    with open(timings_path) as f:
+        timings = json.load(f)
+    assert set(timings['paths']) == {'.', 'deps/package1', 'deps/package2',
+                                     'deps/package3', 'deps/package4'}
+    assert (timings['paths']['deps/package2']['build']['handler']
+            == './build.sh')
+
+    # package1 is on the critical path once its build is the slowest
+    timings['paths']['deps/package1']['build']['seconds'] = 10
+    timings['paths']['deps/package2']['build']['seconds'] = 1
+    with open(timings_path, 'w') as f:
+        json.dump(timings, f)
+    out = check_output(['puck', 'execute', '--root', '--explain-schedule',
+                        '--jobs', '2', 'build'],
+                       cwd=cwd, universal_newlines=True).splitlines()
+    assert 'executing' not in ''.join(out)
+    assert [l.split()[-1] for l in out[1:5]] == [
+               'deps/package1', 'deps/package3', 'deps/package4', '.']
+    assert out[-1].split()[2:] == ['2', 'jobs', '(--jobs)']
+    assert float(out[-1].split()[0]) < float(out[-2].split()[0])
+
+    # a changed handler has no timing history
+    with open('package5/Package.json') as f:
+        manifest = json.load(f)
+    with open('package5/Package.json', 'w') as f:
+        json.dump(dict(manifest, commands={'build': 'true'}), f)
+    out = check_output(['puck', 'execute', '--root', '--explain-schedule',
+                        'build'],
+                       cwd=cwd, universal_newlines=True)
+    assert '### No timing history for 1 package(s)' in out
+    with open('package5/Package.json', 'w') as f:
+        json.dump(manifest, f)
+
+
+@test
+def test_package5_resume():
+    cwd = 'package5'
+    ok = os.path.abspath('.fakegit/ok')
+
+    # a `git` that runs `fail` instead of cloning package1 until `ok` exists
+    def failing_git(fail):
+        return fake_git('case "$*" in *clone*package1*) [ -e {} ] || {};; '
+                        'esac'.format(ok, fail))
+
+    def failed_update(*args):
+        shutil.rmtree('package5/deps')
+        update = Popen(['puck', 'update', '--no-verify'] + list(args),
+                       cwd=cwd, env=env, stdout=DEVNULL, stderr=PIPE,
+                       universal_newlines=True)
+        _, err = update.communicate()
+        assert update.returncode != 0
+        assert exists('package5/deps/.puck-update.jsonl')
+        return err
+
+    # only clones and fetches that timed out or failed because of the
+    # network are retried
+    log, env = failing_git('exit 128')
+    assert 'retrying' not in failed_update()
+    failing_git('{ echo "fatal: Could not resolve host: x" >&2; exit 128; }')
+    err = failed_update('--retries', '1')
+    assert 'Could not resolve host' in err
+    assert 'retrying in 1 s (retry 1 of 1)' in err
+    failing_git('exec sleep 10')
+    err = failed_update('--retries', '1', '--timeout', '1')
+    assert 'retrying in 1 s (retry 1 of 1)' in err
+
+    # only the dependency that failed is fetched when resuming
+    os.remove(log)
+    open(ok, 'w').close()
+    call(['puck', 'update', '--no-verify', '--resume'], cwd=cwd, env=env)
+    fetches = logged_fetches(log)
+    assert len(fetches) == 1 and 'package1' in ' '.join(fetches[0])
+    assert exists('package5/deps/package1/Makefile')
+    assert not exists('package5/deps/.puck-update.jsonl')
+    shutil.rmtree('.fakegit')
+
+
+@test
+def test_package5_status():
+    cwd = 'package5'
+
+    def status():
+        return json.loads(check_output(['puck', 'status', '--format',
+                                        'json'],
+                                       cwd=cwd, universal_newlines=True))
+
+    # tags are checked out on a detached `HEAD`
+    assert {p: s['states'] for p, s in status().items()} == {
+        'package1': ['detached'], 'package2': ['detached'],
+        'package3': ['detached'], 'package4': []}
+
+    with open('package5/deps/package1/f1', 'w') as f:
+        f.write('changed')
+    shutil.rmtree('package5/deps/package2')
+    states = {p: s['states'] for p, s in status().items()}
+    assert states['package1'] == ['dirty (1)', 'detached']
+    assert states['package2'] == ['missing']
+    table = check_output(['puck', 'status'], cwd=cwd,
+                         universal_newlines=True).splitlines()
+    assert table[0].split() == ['PATH', 'COMMIT', 'STATE']
+    assert 'deps/package2  -             missing' in table
+
+    call(['git', 'checkout', 'f1'], cwd='package5/deps/package1')
+    call(['puck', 'update', '--no-verify'], cwd=cwd)
+
+
+@test
+def test_package5_backend():
+    cwd = 'package5'
+
+    def locked():
+        with open('package5/Package.lock') as f:
+            return json.load(f)
+
+    call(['puck', 'update', '--no-verify'], cwd=cwd)
+    lock = locked()
+
+    shutil.rmtree('package5/deps')
+    call(['puck', '--backend', 'batch', 'update', '--no-verify'], cwd=cwd)
+    assert locked() == lock
+
+    # tags read from `packed-refs` rather than loose ref files
+    call(['git', 'pack-refs', '--all'], cwd='package5/deps/package1')
+    call(['puck', '--backend', 'batch', 'update', '--no-verify'], cwd=cwd)
+    assert locked() == lock
+
+
+@test
+def test_package5_plan():
+    cwd = 'package5'
+
+    def plan():
+        return check_output(['puck', 'update', '--dry-run', '--no-verify'],
+                            cwd=cwd, universal_newlines=True)
+
+    shutil.rmtree('package5/deps')
+    assert '### deps/package1: clone, and check out v1.10.0 at ' in plan()
+    assert not exists('package5/deps/package1')
+    call(['puck', 'update', '--no-verify'], cwd=cwd)
+    assert exists('package5/deps/package1/Makefile')
+    assert not exists('package5/deps/.puck-staging')
+    assert '### deps/package1: up to date at v1.10.0 (' in plan()
+
+    # every conflict is reported before anything is checked out
+    with open('package5/Package.json') as f:
+        manifest = json.load(f)
+    with open('package5/Package.json', 'w') as f:
+        json.dump(dict(manifest, dependencies=manifest['dependencies'] + [
+                           {'repo': '../package1', 'tag': 'v1.0.*'},
+                           {'repo': '../package2', 'tag': 'v2.0.*'}]),
+                  f)
+    shutil.rmtree('package5/deps')
+    update = Popen(['puck', 'update', '--no-verify'], cwd=cwd, stdout=DEVNULL,
+                   stderr=PIPE, universal_newlines=True)
+    _, err = update.communicate()
+    assert update.returncode != 0
+    assert 'dependencies at path `package1`' in err
+    assert 'dependencies at path `package2`' in err
+    assert not exists('package5/deps/package1')
+
+    # so is a reference that doesn't name a commit
+    with open('package5/Package.json', 'w') as f:
+        json.dump(dict(manifest, dependencies=manifest['dependencies'] + [
+                           {'repo': '../package7', 'ref': 'missing'}]),
+                  f)
+    for args in ([], ['--dry-run']):
+        update = Popen(['puck', 'update', '--no-verify'] + args, cwd=cwd,
+                       stdout=DEVNULL, stderr=PIPE, universal_newlines=True)
+        _, err = update.communicate()
+        assert update.returncode != 0
+        assert '`missing` doesn\'t name a commit' in err
+        assert not exists('package5/deps/package1')
+    with open('package5/Package.json', 'w') as f:
+        json.dump(manifest, f)
+
+
+@test
+def test_package4_mirror():
+    cwd = 'package4'
+    cache = ['puck', '--cache-dir', '../.cache']
+
+    shutil.rmtree('package4/deps')
+    call(cache + ['update', '--no-verify', '--mirror'], cwd=cwd)
+    assert all([
+        exists('package4/deps/package1'),
+        exists('package4/deps/package2'),
+        exists('package4/deps/package3'),
+        len(os.listdir('.cache/mirrors')) == 6  # 3 mirrors and their locks
+    ])
+
+    call(cache + ['update', '--no-verify', '--mirror'], cwd=cwd)
+    call(['puck', 'execute', 'build'], cwd=cwd)
+    assert read_file('package4/deps/package3/output') == 'building package 3\n'
+
+    call(cache + ['cache', 'list'], cwd=cwd)
+    call(cache + ['cache', 'evict'], cwd=cwd)
+    assert not any(f.endswith('.git') for f in os.listdir('.cache/mirrors'))
+
+
+@test
+def test_package6_urls():
+    cwd = 'package6'
+    cache = ['puck', '--cache-dir', '../.cache']
+
+    call(cache + ['update', '--no-verify'], cwd=cwd)
+    assert exists('package6/deps/package1')
+    with open('.cache/url-stats.json') as f:
+        stats = json.load(f)['urls']
+    missing, package1 = (stats[os.path.abspath(url)]
+                         for url in ('missing/package1', 'package1'))
+    assert missing['failures'] == 1 and missing['latency'] is None
+    assert package1['failures'] == 0 and package1['latency'] is not None
+
+    # the healthy URL is now fetched from first, without probing again
+    out = check_output(cache + ['update', '--no-verify'], cwd=cwd,
+                       universal_newlines=True)
+    print(out, end='')
+    assert 'ls-remote' not in out and 'missing' not in out
+
+
+@test
+def test_package5_incremental():
+    cwd = 'package5'
+
+    def executed(args):
+        out = check_output(args, cwd=cwd, universal_newlines=True)
+        print(out, end='')
+        return set(line.split(':')[0][len('### deps/'):]
+                   for line in out.splitlines()
+                   if line.endswith('executing command `build`...'))
+
+    args = ['puck', 'execute', 'build', '--incremental']
+    assert executed(args) == {'package1', 'package2', 'package3', 'package4'}
+    assert executed(args) == set()
+
+    with open('package5/deps/package3/f1', 'w') as f:
+        f.write('changed\n')
+    assert executed(args) == {'package3', 'package4'}
+    assert executed(args) == set()
+
+    # a truncated stamp file is treated as empty
+    with open('package5/deps/.puck-stamps.json', 'w') as f:
+        f.write('{"build": {')
+    assert executed(args) == {'package1', 'package2', 'package3', 'package4'}
+    assert executed(args) == set()
+
+
+@test
+def test_package5_graph():
+    cwd = 'package5'
+
+    listed = check_output(['puck', 'list'], cwd=cwd, universal_newlines=True)
+    assert listed.split() == ['package4', 'package3', 'package2', 'package1']
+
+    graph = json.loads(check_output(['puck', 'graph', '--format', 'json'],
+                                    cwd=cwd, universal_newlines=True))
+    assert graph['roots'] == ['package4', 'package3']
+    assert graph['nodes']['package4']['dependencies'] == ['package2',
+                                                          'package3']
+
+    call(['puck', 'graph'], cwd=cwd)
+
+    # with a JSON log, the results are logged as events
+    def events(*args):
+        out = check_output(['puck', '--log-format', 'jsonl'] + list(args),
+                           cwd=cwd, universal_newlines=True)
+        return [json.loads(line) for line in out.splitlines()]
+    assert [e['dependency'] for e in events('list')
+            if e['event'] == 'list-dependency'] == listed.split()
+    graph, = [e['graph'] for e in events('graph')
+              if e['event'] == 'dependency-graph']
+    assert graph['roots'] == ['package4', 'package3']
+    statuses, = [e['statuses'] for e in events('status')
+                 if e['event'] == 'dependency-status']
+    assert sorted(statuses) == sorted(listed.split())
+
+
+@test
+def test_package5_snapshot():
+    cwd = 'package5'
+    path = 'package5/deps/package3/Package.json'
+
+    def listed():
+        return check_output(['puck', 'list'], cwd=cwd,
+                            universal_newlines=True).split()
+
+    expected = listed()
+    assert exists('package5/deps/.puck-graph')
+    manifest = read_file(path)
+    st = os.stat(path)
+    try:
+        # an unchanged manifest (same mtime and size) is not read again
+        with open(path, 'w') as f:
+            f.write('!' * len(manifest))
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        assert listed() == expected
+
+        # a manifest whose size changed is parsed again
+        with open(path, 'w') as f:
+            f.write('!')
+        listing = Popen(['puck', 'list'], cwd=cwd, stdout=DEVNULL,
+                        stderr=DEVNULL)
+        assert listing.wait() != 0
+    finally:
+        with open(path, 'w') as f:
+            f.write(manifest)
+    assert listed() == expected
+
+
+@test
+def test_package6_outputs():
+    cwd = 'package6'
+    cache = ['puck', '--cache-dir', '../.cache']
+
+    def execute(*args):
+        out = check_output(cache + ['execute', 'build'] + list(args),
+                           cwd=cwd, universal_newlines=True)
+        print(out, end='')
+        return out
+
+    assert 'restored' not in execute()
+    os.remove('package6/deps/package1/output')
+    assert 'restored the outputs' in execute()
+    assert read_file('package6/deps/package1/output') == \
+               'default package1 var\n'
+    assert 'restored' not in execute('--no-output-cache')
+
+    assert 'outputs' in check_output(cache + ['cache', 'list'], cwd=cwd,
+                                     universal_newlines=True)
+    call(cache + ['cache', 'evict'], cwd=cwd)
+    assert os.listdir('.cache/outputs') == []
+
+
+@test
+def test_package8_sparse():
+    cwd = 'package8'
+
+    call(['puck', 'update', '--no-verify'], cwd=cwd)
+    assert exists('package8/deps/package7/lib/f1')
+    assert not exists('package8/deps/package7/docs')
+    # the manifest at the top level is still checked out and read
+    assert exists('package8/deps/package7/Package.json')
+    assert exists('package8/deps/package1/Makefile')
+    call(['puck', 'execute', 'build'], cwd=cwd)
+    assert read_file('package8/deps/package7/output') == 'lib\n'
+
+    # the checkout follows changes to the sparse directories
+    with open('package8/Package.json') as f:
+        manifest = json.load(f)
+    dep = manifest['dependencies'][0]
+    for sparse, present in ((['docs', 'lib'], True), (None, True),
+                            (['lib'], False)):
+        with open('package8/Package.json', 'w') as f:
+            json.dump(dict(manifest, dependencies=[
+                               dict(dep, sparse=sparse) if sparse else
+                               {k: v for k, v in dep.items()
+                                     if k != 'sparse'}]),
+                      f)
+        call(['puck', 'update', '--no-verify'], cwd=cwd)
+        assert exists('package8/deps/package7/docs/f1') == present
+        assert exists('package8/deps/package7/lib/f1')
+
+
+@test
+def test_shallow():
+    cwd = '.shallow'
+
+    def git(repo, *args):
+        return check_output(['git', '-C', repo] + list(args),
+                            universal_newlines=True).strip()
+
+    # plain paths are cloned locally, which ignores `--depth`
+    def url(package):
+        return 'file://' + os.path.abspath(package)
+
+    commit = git('package3', 'rev-parse', 'v1.0.0^{commit}')
+    shutil.rmtree(cwd, ignore_errors=True)
+    os.mkdir(cwd)
+    with open('.shallow/Package.json', 'w') as f:
+        json.dump({'dependencies': [
+                      {'repo': url('package1'), 'tag': 'v1.1.*',
+                       'clone': {'depth': 1}},
+                      {'repo': url('package2'), 'ref': 'branch1',
+                       'clone': {'single-branch': True}},
+                      {'repo': url('package3'), 'ref': commit,
+                       'clone': {'depth': 1}}]},
+                  f)
+    for _ in range(2):
+        call(['puck', 'update', '--no-verify'], cwd=cwd)
+
+        # the tag isn't at the tip, so it's fetched, keeping the depth
+        package1 = '.shallow/deps/package1'
+        assert git(package1, 'rev-parse', '--is-shallow-repository') == 'true'
+        assert git(package1, 'rev-list', '--count', 'HEAD') == '1'
+        assert git(package1, 'rev-parse', 'HEAD') == \
+                   git('package1', 'rev-parse', 'v1.1.0^{commit}')
+
+        # the branch isn't the one cloned, so it's fetched and checked out
+        package2 = '.shallow/deps/package2'
+        assert git(package2, 'symbolic-ref', 'HEAD') == 'refs/heads/branch1'
+        assert git(package2, 'rev-parse', 'HEAD') == \
+                   git('package2', 'rev-parse', 'branch1')
+
+        # so is a commit that isn't at the tip of a branch
+        package3 = '.shallow/deps/package3'
+        assert git(package3, 'rev-list', '--count', 'HEAD') == '1'
+        assert git(package3, 'rev-parse', 'HEAD') == commit
+    shutil.rmtree(cwd)
+
+
 def main():
     if not all(exists(d) for d in
-               ('package' + str(n) for n in range(1, 6))):
+               ('package' + str(n) for n in range(1, 9))):
         print('Please run `./setup.bash` first.')
         return 1
 
@@ -133,6 +869,28 @@ def main():
     test_package3()
     test_package4()
     test_package5()
+    test_package5_jobs()
+    test_package5_frozen()
+    test_package5_fetches()
+    test_package5_incremental()
+    test_package5_graph()
+    test_package5_snapshot()
+    test_package5_trace()
+    test_package5_capture()
+    test_package5_prune()
+    test_package5_serve()
+    test_package5_watch()
+    test_package5_jobserver()
+    test_package5_schedule()
+    test_package5_resume()
+    test_package5_status()
+    test_package5_backend()
+    test_package5_plan()
+    test_package4_mirror()
+    test_package6_urls()
+    test_package6_outputs()
+    test_package8_sparse()
+    test_shallow()
     return 0
 
 
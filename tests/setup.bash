@@ -35,6 +35,8 @@ setup_package1() {
     git add .
     git commit --message "Commit 2"
     git tag --annotate v1.1.0 --message ""
+    # the highest of package1's tags as a string, but not as a version
+    git tag --annotate v1.9.0 --message ""
     cat > Package.json <<EOF
 {
     "commands": { "build": "make" }
@@ -48,6 +50,7 @@ EOF
     git add .
     git commit --message "Commit 3"
     git tag --annotate v1.2.0 --message ""
+    git tag --annotate v1.10.0 --message ""
     cd ..
 }
 
@@ -166,12 +169,78 @@ EOF
 }
 
 
+setup_package6() {
+    mkdir package6
+    cd package6
+    git init
+    cat > Package.json <<EOF
+{
+    "dependencies": [
+        { "repo": [ "../missing/package1", "../package1" ],
+          "tag": "v1.*",
+          "outputs": { "build": [ "output" ] } }
+    ]
+}
+EOF
+    git add .
+    git commit --message "Commit 1"
+    cd ..
+}
+
+
+setup_package7() {
+    mkdir package7
+    cd package7
+    git init
+    mkdir lib docs
+    echo "lib" > lib/f1
+    echo "docs" > docs/f1
+    cat > Package.json <<EOF
+{
+    "dependencies": [
+        { "repo": "../package1",
+          "tag": "v1.*" }
+    ],
+    "commands": {
+        "build": "cat lib/f1 > output"
+    }
+}
+EOF
+    git add .
+    git commit --message "Commit 1"
+    git tag --annotate v1.0.0 --message ""
+    cd ..
+}
+
+
+setup_package8() {
+    mkdir package8
+    cd package8
+    git init
+    cat > Package.json <<EOF
+{
+    "dependencies": [
+        { "repo": "../package7",
+          "tag": "v1.*",
+          "sparse": [ "lib" ] }
+    ]
+}
+EOF
+    git add .
+    git commit --message "Commit 1"
+    cd ..
+}
+
+
 main() {
     setup_package1
     setup_package2
     setup_package3
     setup_package4
     setup_package5
+    setup_package6
+    setup_package7
+    setup_package8
 }
 
 